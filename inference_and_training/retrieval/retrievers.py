@@ -19,17 +19,23 @@ class Retriever(ABC):
     def _search(self, query, top_k=5):
         pass
 
+    def _search_page(self, query, offset, limit):
+        # results [offset, offset + limit) of the ranking; retrievers without
+        # server-side pagination re-retrieve the top offset + limit and slice
+        results = self._search(query, offset + limit)
+        return results[offset:] if results else results
+
     def search_next(self, query, cache_k=20):
         if query in self.cache and len(self.cache[query]) > 0:
             # print(f"Cache has {len(self.cache[query])} documents for query: {query}")
             return self.cache[query].pop(0)
 
-        # Get current top_k served; default to base top_k
-        current_top_k = self.cached_top_k.get(query, self.default_top_k)
-        new_top_k = current_top_k + cache_k
-        # print(f"Fetching results {current_top_k} to {new_top_k}")
+        # Number of results already fetched; the first page also covers the base top_k
+        fetched = self.cached_top_k.get(query, 0)
+        page_size = cache_k if fetched else self.default_top_k + cache_k
+        # print(f"Fetching results {fetched} to {fetched + page_size}")
 
-        results = self._search(query, new_top_k)
+        results = self._search_page(query, fetched, page_size)
         if not results:
             # print(f"No results returned from _search for query: {query}")
             return None
@@ -51,7 +57,7 @@ class Retriever(ABC):
                 self.doc_ids.add(new_id)
 
         self.cache[query] = results
-        self.cached_top_k[query] = new_top_k
+        self.cached_top_k[query] = fetched + len(results)
 
         # print(f"Cache updated for query: {query} with {len(self.cache[query])} new documents.")
         return self.cache[query].pop(0) if self.cache[query] else None
@@ -71,9 +77,14 @@ class SparseRetriever(Retriever):
         self.threshold = execute_config['threshold']
 
     def _search(self, query, top_k):
+        return self._search_page(query, 0, top_k)
+
+    def _search_page(self, query, offset, limit):
+        # the server keeps the ranked list and only returns the requested slice
         payload = {
             "query": query,
-            "top_k": top_k,
+            "top_k": limit,
+            "offset": offset,
             "threshold": self.threshold
         }
         # print("payload:", payload)
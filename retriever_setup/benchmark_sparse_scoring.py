@@ -0,0 +1,186 @@
+"""Micro-benchmark of the sparse scoring kernels, on a synthetic collection or on an existing CSR index.
+
+    python benchmark_sparse_scoring.py --n_docs 1000000 --n_queries 200
+    python benchmark_sparse_scoring.py --index_dir /path/to/index --n_queries 200
+"""
+import argparse
+import time
+
+import numba
+import numpy as np
+
+from scaling_retriever.utils.inverted_index import IndexCSRArray
+from scaling_retriever.utils.posting_codec import pack_doc_ids
+from scaling_retriever.utils.sparse_scoring import (numba_score_float, numba_score_csr, numba_maxscore_topk,
+                                                   numba_score_topk_csr, numba_score_batch_topk_csr,
+                                                   numba_score_topk_packed)
+
+
+def synthetic_index(n_docs, dim_voc, doc_l0, seed=0):
+    """zipf-like term distribution, roughly what the learned sparse encoder produces
+    """
+    rng = np.random.default_rng(seed)
+    term_probs = 1.0 / np.arange(1, dim_voc + 1) ** 0.8
+    term_probs /= term_probs.sum()
+    rows = np.repeat(np.arange(n_docs, dtype=np.int32), doc_l0)
+    cols = rng.choice(dim_voc, size=len(rows), p=term_probs).astype(np.int32)
+    values = rng.exponential(0.5, size=len(rows)).astype(np.float32)
+    # a term appears at most once per document
+    keys = np.unique(cols.astype(np.int64) * n_docs + rows)
+    cols, rows = (keys // n_docs).astype(np.int32), (keys % n_docs).astype(np.int32)
+    values = values[:len(keys)]
+    offsets = np.zeros(dim_voc + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.bincount(cols, minlength=dim_voc))
+    return IndexCSRArray(offsets, rows, values, n_docs), term_probs
+
+
+def sample_queries(dim_voc, term_probs, n_queries, query_l0, seed=1):
+    rng = np.random.default_rng(seed)
+    queries = []
+    for _ in range(n_queries):
+        col = np.unique(rng.choice(dim_voc, size=query_l0, p=term_probs)).astype(np.int32)
+        queries.append((col, rng.exponential(0.5, size=len(col)).astype(np.float32)))
+    return queries
+
+
+def select_topk(filtered_indexes, scores, k):
+    if len(filtered_indexes) > k:
+        top = np.argpartition(-scores, k)[:k]
+        filtered_indexes, scores = filtered_indexes[top], scores[top]
+    order = np.argsort(-scores, kind="stable")
+    return filtered_indexes[order], scores[order]
+
+
+def to_typed_dict(index):
+    ids, values = numba.typed.Dict(), numba.typed.Dict()
+    for key in range(len(index)):
+        doc_ids, doc_values = index.posting(key)
+        ids[key] = np.ascontiguousarray(doc_ids)
+        values[key] = np.ascontiguousarray(doc_values)
+    return ids, values
+
+
+def run(name, score_fn, queries, topk, setup_time=0.0):
+    score_fn(*queries[0])  # jit warmup
+    latencies, results = [], []
+    for col, values in queries:
+        start = time.perf_counter()
+        results.append(select_topk(*score_fn(col, values), k=topk))
+        latencies.append(time.perf_counter() - start)
+    latencies = np.array(latencies) * 1000
+    print(f"{name:>12} | setup {setup_time:7.2f}s | mean {latencies.mean():8.3f}ms | "
+          f"p50 {np.percentile(latencies, 50):8.3f}ms | p99 {np.percentile(latencies, 99):8.3f}ms | "
+          f"{1000 / latencies.mean():8.1f} qps")
+    return results
+
+
+def run_batched(name, queries, batch_size, score_batch_fn):
+    """time the queries in batches, reported per query so it compares with `run`
+    """
+    def to_batch(batch):
+        batch_offsets = np.zeros(len(batch) + 1, dtype=np.int64)
+        batch_offsets[1:] = np.cumsum([len(col) for col, _ in batch])
+        return (batch_offsets, np.concatenate([col for col, _ in batch]),
+                np.concatenate([values for _, values in batch]))
+
+    batches = [to_batch(queries[i:i + batch_size]) for i in range(0, len(queries), batch_size)]
+    score_batch_fn(*batches[0])  # jit warmup
+    results = []
+    start = time.perf_counter()
+    for batch in batches:
+        ids, scores, sizes = score_batch_fn(*batch)
+        results.extend((ids[q, :sizes[q]], scores[q, :sizes[q]]) for q in range(len(sizes)))
+    elapsed = (time.perf_counter() - start) * 1000
+    print(f"{name:>12} | batch {batch_size:4d} | mean {elapsed / len(queries):8.3f}ms per query | "
+          f"{1000 * len(queries) / elapsed:8.1f} qps")
+    return results
+
+
+def check_same(reference, results, name):
+    """top-k sets may only differ on docs tied (up to float rounding) with the k-th score
+    """
+    mismatches = 0
+    for (ref_ids, ref_scores), (ids, scores) in zip(reference, results):
+        if len(ref_ids) != len(ids) or not np.allclose(ref_scores, scores, rtol=1e-5, atol=1e-6):
+            mismatches += 1
+        elif set(ref_ids.tolist()) != set(ids.tolist()):
+            kth = ref_scores[-1]
+            differing = set(ref_ids.tolist()) ^ set(ids.tolist())
+            all_scores = dict(zip(ref_ids.tolist(), ref_scores.tolist()))
+            all_scores.update(zip(ids.tolist(), scores.tolist()))
+            mismatches += any(not np.isclose(all_scores[d], kth, rtol=1e-5) for d in differing)
+    print(f"{name}: {mismatches} / {len(reference)} queries differ from the reference top-k")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--index_dir", default=None, type=str)
+    parser.add_argument("--n_docs", default=200_000, type=int)
+    parser.add_argument("--dim_voc", default=128_256, type=int)
+    parser.add_argument("--doc_l0", default=200, type=int)
+    parser.add_argument("--query_l0", default=40, type=int)
+    parser.add_argument("--n_queries", default=100, type=int)
+    parser.add_argument("--topk", default=100, type=int)
+    parser.add_argument("--batch_sizes", default=[8, 32], type=int, nargs="+")
+    args = parser.parse_args()
+
+    if args.index_dir is not None:
+        index = IndexCSRArray.load(args.index_dir)
+        df = np.diff(index.offsets).astype(np.float64) + 1
+        term_probs = df / df.sum()
+    else:
+        index, term_probs = synthetic_index(args.n_docs, args.dim_voc, args.doc_l0)
+    print(f"{index.nb_docs()} docs, {len(index)} terms, {len(index.doc_ids)} postings")
+    queries = sample_queries(len(index), term_probs, args.n_queries, args.query_l0)
+    n_docs = index.nb_docs()
+
+    start = time.perf_counter()
+    dict_ids, dict_values = to_typed_dict(index)
+    dict_setup = time.perf_counter() - start
+    reference = run("dict", lambda c, v: numba_score_float(dict_ids, dict_values, c, v, 0.0, n_docs),
+                    queries, args.topk, setup_time=dict_setup)
+
+    results = run("csr", lambda c, v: numba_score_csr(index.offsets, index.doc_ids, index.doc_values,
+                                                      c, v, 0.0, n_docs),
+                  queries, args.topk)
+    check_same(reference, results, "csr")
+
+    scores_buffer = np.zeros(n_docs, dtype=np.float32)
+    touched_buffer = np.empty(n_docs, dtype=np.int32)
+    results = run("fused", lambda c, v: numba_score_topk_csr(index.offsets, index.doc_ids, index.doc_values,
+                                                             c, v, 0.0, args.topk, scores_buffer, touched_buffer),
+                  queries, args.topk)
+    check_same(reference, results, "fused")
+
+    start = time.perf_counter()
+    packed = pack_doc_ids(index.offsets, index.doc_ids, 128)
+    pack_setup = time.perf_counter() - start
+    print(f"packed doc ids: {sum(a.nbytes for a in packed[1:]) / 2 ** 20:.1f}MB "
+          f"instead of {index.doc_ids.nbytes / 2 ** 20:.1f}MB")
+    results = run("packed", lambda c, v: numba_score_topk_packed(index.offsets, *packed, 128, index.doc_values,
+                                                                 c, v, 0.0, args.topk, scores_buffer, touched_buffer),
+                  queries, args.topk, setup_time=pack_setup)
+    check_same(reference, results, "packed")
+
+    for batch_size in args.batch_sizes:
+        tile_size = max(4096, (1 << 18) // batch_size)
+        results = run_batched("batched", queries, batch_size,
+                              lambda o, t, v: numba_score_batch_topk_csr(index.offsets, index.doc_ids,
+                                                                         index.doc_values, o, t, v, 0.0,
+                                                                         args.topk, n_docs, tile_size,
+                                                                         numba.get_num_threads()))
+        check_same(reference, results, f"batched ({batch_size})")
+
+    start = time.perf_counter()
+    index.ensure_block_max()
+    block_max_setup = time.perf_counter() - start
+    results = run("maxscore", lambda c, v: numba_maxscore_topk(index.offsets, index.doc_ids, index.doc_values,
+                                                               index.term_max, index.block_offsets, index.block_max,
+                                                               index.block_last_doc, index.block_size,
+                                                               c, v, 0.0, args.topk),
+                  queries, args.topk, setup_time=block_max_setup)
+    check_same(reference, results, "maxscore")
+
+
+if __name__ == "__main__":
+    main()
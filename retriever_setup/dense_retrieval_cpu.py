@@ -0,0 +1,235 @@
+"""CPU dense retrieval server for LlamaBiDense models, with the /search and /batch_search contract of
+sparse_retrieval_cpu.py (SparseRetriever can point at either one).
+
+    python -m scaling_retriever.utils.dense_index --embs_dir /path/to/embs --n_lists 1024
+    DENSE_MODEL_PATH=/path/to/lora DENSE_INDEX_DIR=/path/to/embs uvicorn dense_retrieval_cpu:app --port 8000
+
+The index is the IVF layout built offline from the store_embs chunks (the server refuses to start without it),
+a query scans RETRIEVER_NPROBE lists.
+With RETRIEVER_DENSE_CODES=sq8 (or pq), lists are scanned on the compressed codes written offline by
+`dense_index --quantize` and only the RETRIEVER_RERANK_FACTOR * top_k best candidates are re-scored
+with the float vectors.
+"""
+import os
+import json
+import logging
+import traceback
+from typing import Optional, List
+
+import numpy as np
+import torch
+from fastapi import FastAPI, HTTPException, Response
+from pydantic import BaseModel
+from torch.utils.data import DataLoader
+from transformers import AutoTokenizer
+from concurrent.futures import ThreadPoolExecutor
+
+from scaling_retriever.dataset.data_collator import LlamaSparseCollectionCollator
+from scaling_retriever.modeling.llm_encoder import LlamaBiDense
+from scaling_retriever.utils.dense_index import DenseIVFIndex, DENSE_CODES_FILE, dense_index_exists
+from scaling_retriever.utils.query_batcher import QueryBatcher
+from scaling_retriever.utils.query_cache import QueryVectorCache
+from scaling_retriever.utils.ranking_cache import RankingCache
+from scaling_retriever.utils.metrics import Metrics
+from scaling_retriever.utils.doc_store import DocStore, doc_store_exists
+from scaling_retriever.utils.utils import supports_bfloat16
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s — %(levelname)s — %(name)s — %(message)s",
+    handlers=[
+        logging.FileHandler("dense_retriever_server.log"),
+        logging.StreamHandler()
+    ]
+)
+logger = logging.getLogger("dense_retriever")
+
+app = FastAPI()
+
+
+class QueryRequest(BaseModel):
+    query: str
+    top_k: Optional[int] = 5
+    # results [offset, offset + top_k) of the ranking, later pages are sliced from a server-side ranked list
+    offset: Optional[int] = 0
+    threshold: Optional[float] = 0.0
+
+class BatchQueryRequest(BaseModel):
+    queries: List[str]
+    top_k: Optional[int] = 5
+    threshold: Optional[float] = 0.0
+
+
+class DenseRetrieval:
+    def __init__(self, model, config, device, q_collator):
+        self.model = model
+        self.model.eval()
+        self.q_collator = q_collator
+        self.device = device
+        self.model.to(device)
+        self.nprobe = config.get("nprobe", 16)
+        self.query_cache = QueryVectorCache(max_size=config.get("query_cache_size", 10000))
+        self.ranking_cache = RankingCache(ttl_seconds=config.get("ranking_cache_ttl", 300.0))
+        self.min_ranking_depth = config.get("min_ranking_depth", 50)
+        self.metrics = Metrics(prefix="dense_retriever")
+        self.metrics.describe("stage_seconds", "wall time of each request stage")
+        self.executor = ThreadPoolExecutor(max_workers=config.get("scoring_threads", 8))
+
+        # the index is built offline, several workers building it at startup would race on the same files
+        if not dense_index_exists(config["index_dir"]):
+            raise FileNotFoundError(f"no ivf index in {config['index_dir']}, build it first with: python -m "
+                                    f"scaling_retriever.utils.dense_index --embs_dir <store_embs dir> "
+                                    f"--index_dir {config['index_dir']}")
+        codes = config.get("codes")
+        if codes:
+            name = "sq8" if codes == "sq8" else "pq{}".format(config.get("pq_m", 64))
+            if not os.path.exists(os.path.join(config["index_dir"], DENSE_CODES_FILE.format(name))):
+                raise FileNotFoundError(f"no {name} codes in {config['index_dir']}, write them first with: python -m "
+                                        f"scaling_retriever.utils.dense_index --quantize {config['index_dir']} "
+                                        f"--codes {codes} --pq_m {config.get('pq_m', 64)}")
+            codes = name
+        self.index = DenseIVFIndex.load(config["index_dir"], codes=codes, rerank_factor=config.get("rerank_factor", 4))
+        logger.info(f"Loaded ivf index with {len(self.index)} vectors in {self.index.n_lists} lists"
+                    f"{f', scanned on {codes} codes' if codes else ''}")
+
+        store_dir = config.get("doc_store_dir") or os.path.join(config["index_dir"], "doc_store")
+        if doc_store_exists(store_dir):
+            self.doc_store = DocStore(store_dir)
+        else:
+            logger.warning(f"No doc store at {store_dir}, results will have empty texts. Build it with: "
+                           f"python -m scaling_retriever.utils.doc_store --corpus_path "
+                           f"{config.get('document_chunks_file') or '<chunks.jsonl>'} --store_dir {store_dir}")
+            self.doc_store = {}
+
+    def encode_queries_uncached(self, queries):
+        """run the encoder on every query and store the vectors in the query cache
+        """
+        q_loader = DataLoader([(f"q{i}", query) for i, query in enumerate(queries)], batch_size=len(queries),
+                              shuffle=False, collate_fn=self.q_collator)
+        query_vecs = []
+        with torch.inference_mode():
+            for batch in q_loader:
+                inputs = {k: v.to(self.device) for k, v in batch.items() if k not in {"ids"}}
+                dtype = torch.bfloat16 if supports_bfloat16() else torch.float32
+                with self.metrics.timer("encode"), \
+                        torch.amp.autocast(self.device, dtype=dtype, enabled=dtype != torch.float32):
+                    query_vecs.extend(self.model.encode(**inputs).float().cpu().numpy())
+        for query, vec in zip(queries, query_vecs):
+            self.query_cache.put(query, (vec,))
+        return query_vecs
+
+    def encode_queries(self, queries):
+        query_vecs = [self.query_cache.get(query) for query in queries]
+        missing = [i for i, vec in enumerate(query_vecs) if vec is None]
+        if missing:
+            for i, vec in zip(missing, self.encode_queries_uncached([queries[i] for i in missing])):
+                query_vecs[i] = (vec,)
+        return [vec for vec, in query_vecs]
+
+    def search(self, query_vecs, threshold=0., topk=5):
+        """(doc ids, scores) of the top-k of every query vector
+        """
+        with self.metrics.timer("score"):
+            results = self.executor.submit(self.index.search, np.stack(query_vecs), topk, self.nprobe,
+                                           threshold).result()
+        return [([str(self.index.ids[p]) for p in positions], scores) for positions, scores in results]
+
+    def _ranked_page(self, query, encode_fn, offset=0, limit=5, threshold=0.):
+        """docs [offset, offset + limit) of the ranking of `query`, see SparseRetrieval._ranked_page
+        """
+        key = (QueryVectorCache.normalize(query), float(threshold))
+        needed = offset + limit
+        cached = self.ranking_cache.get(key, needed)
+        self.metrics.inc("ranking_cache_lookups_total", hit=cached is not None)
+        if cached is None:
+            depth = max(needed, 2 * self.ranking_cache.previous_depth(key), self.min_ranking_depth)
+            doc_ids, scores = self.search([encode_fn(query)], threshold=threshold, topk=depth)[0]
+            self.ranking_cache.put(key, doc_ids, scores, depth)
+        else:
+            doc_ids, scores, _ = cached
+        return doc_ids[offset:needed], scores[offset:needed]
+
+
+MODEL_PATH = os.environ["DENSE_MODEL_PATH"]
+INDEX_DIR = os.environ["DENSE_INDEX_DIR"]
+CHUNK_FILE = "/content/drive/MyDrive/mRAG_and_MSRS_source/chunked_data/story_corpus_chunked.jsonl"
+MAX_BATCH_SIZE = int(os.environ.get("RETRIEVER_MAX_BATCH_SIZE", 16))
+MAX_WAIT_MS = float(os.environ.get("RETRIEVER_MAX_WAIT_MS", 5))
+
+device = "cpu"
+# DecoderOnlyBiDense.encode mean-pools the last `length` positions, queries are padded on the left
+tokenizer = AutoTokenizer.from_pretrained(MODEL_PATH, padding_side="left")
+model = LlamaBiDense.load_from_lora(MODEL_PATH)
+q_collator = LlamaSparseCollectionCollator(tokenizer=tokenizer, max_length=512)
+config = {"index_dir": INDEX_DIR, "document_chunks_file": CHUNK_FILE,
+          "nprobe": int(os.environ.get("RETRIEVER_NPROBE", 16)),
+          # "sq8" / "pq" to scan compressed codes, empty to scan the float32 vectors
+          "codes": os.environ.get("RETRIEVER_DENSE_CODES", "") or None,
+          "pq_m": int(os.environ.get("RETRIEVER_PQ_M", 64)),
+          "rerank_factor": int(os.environ.get("RETRIEVER_RERANK_FACTOR", 4)),
+          "query_cache_size": int(os.environ.get("RETRIEVER_QUERY_CACHE_SIZE", 10000)),
+          "ranking_cache_ttl": float(os.environ.get("RETRIEVER_RANKING_CACHE_TTL", 300)),
+          "doc_store_dir": os.environ.get("RETRIEVER_DOC_STORE_DIR", None),
+          "scoring_threads": int(os.environ.get("RETRIEVER_SCORING_THREADS", 8))}
+
+retriever = DenseRetrieval(model=model, config=config, device=device, q_collator=q_collator)
+query_batcher = QueryBatcher(retriever.encode_queries_uncached, max_batch_size=MAX_BATCH_SIZE, max_wait_ms=MAX_WAIT_MS)
+
+def encode_query(query):
+    cached = retriever.query_cache.get(query)
+    return cached[0] if cached is not None else query_batcher.encode(query)
+
+@app.get("/")
+def root():
+    return {"message": "Dense Retriever is live!", "n_docs": len(retriever.index),
+            "n_lists": retriever.index.n_lists, "nprobe": retriever.nprobe,
+            "query_cache": retriever.query_cache.stats()}
+
+@app.get("/metrics")
+def metrics():
+    return Response(content=retriever.metrics.render(), media_type="text/plain; version=0.0.4")
+
+@app.post("/search")
+def search(request: QueryRequest):
+    retriever.metrics.inc("requests_total", endpoint="search")
+    try:
+        logger.info(f"Received query: {request.query}")
+        with retriever.metrics.timer("search"):
+            doc_ids, scores = retriever._ranked_page(request.query, encode_query, offset=request.offset,
+                                                     limit=request.top_k, threshold=request.threshold)
+            response = [{"query_id": "q0", "id": doc_id, "doc_id": doc_id, "score": float(score),
+                         "text": retriever.doc_store.get(doc_id, "")}
+                        for doc_id, score in zip(doc_ids, scores)]
+        if not response:
+            logger.warning("No documents found for query.")
+            raise HTTPException(status_code=404, detail="No documents found matching the query.")
+        return Response(content=json.dumps(response), media_type="application/json")
+
+    except Exception as e:
+        retriever.metrics.inc("request_errors_total", endpoint="search")
+        logger.error("Error occurred in /search endpoint:")
+        logger.error(traceback.format_exc())
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/batch_search")
+def batch_search(request: BatchQueryRequest):
+    retriever.metrics.inc("requests_total", endpoint="batch_search")
+    try:
+        logger.info(f"Received batch of {len(request.queries)} queries")
+        with retriever.metrics.timer("batch_search"):
+            results = retriever.search(retriever.encode_queries(request.queries),
+                                       threshold=request.threshold, topk=request.top_k)
+            response = [{"query_id": f"q{q}", "id": doc_id, "doc_id": doc_id, "score": float(score),
+                         "text": retriever.doc_store.get(doc_id, "")}
+                        for q, (doc_ids, scores) in enumerate(results)
+                        for doc_id, score in zip(doc_ids, scores)]
+        if not response:
+            logger.warning("No documents found for any of the queries.")
+            raise HTTPException(status_code=404, detail="No documents found matching any of the queries.")
+        return Response(content=json.dumps(response), media_type="application/json")
+
+    except Exception as e:
+        retriever.metrics.inc("request_errors_total", endpoint="batch_search")
+        logger.error("Error occurred in /batch_search endpoint:")
+        logger.error(traceback.format_exc())
+        raise HTTPException(status_code=500, detail=str(e))
@@ -0,0 +1,54 @@
+"""Parity and CPU latency of the query encoder backends against the float32 torch model.
+
+    python eval_cpu_encoders.py --onnx_dir /path/to/index/onnx_encoder --backends torch onnx int8
+
+For each backend, on the test.json questions: ms/query at each --batch_sizes, mean cosine and max absolute
+difference of the query vectors to the float32 ones, jaccard of their non-zero terms and L0.
+The backend is served with RETRIEVER_ENCODER_BACKEND. The onnx export is written to --onnx_dir when it is missing.
+"""
+import argparse
+import json
+import os
+
+import torch
+
+from eval_quantized_index import load_query_encoder
+from scaling_retriever.modeling.cpu_encoders import (CPU_ENCODER_BACKENDS, ONNX_ENCODER_FILE, load_cpu_encoder,
+                                                     encode_dense, encode_latency, export_onnx, query_parity)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--onnx_dir", type=str, default="onnx_encoder")
+    parser.add_argument("--model_name_or_path", default="hzeng/Lion-SP-1B-llama3-marco-mntp", type=str)
+    parser.add_argument("--test_path", default="../train_test_jsons/test.json", type=str)
+    parser.add_argument("--backends", default=CPU_ENCODER_BACKENDS, type=str, nargs="+", choices=CPU_ENCODER_BACKENDS)
+    parser.add_argument("--batch_sizes", default=[1, 8], type=int, nargs="+")
+    parser.add_argument("--num_threads", default=None, type=int)
+    parser.add_argument("--vocab_chunk_size", default=16384, type=int)
+    args = parser.parse_args()
+
+    if args.num_threads:
+        torch.set_num_threads(args.num_threads)
+    with open(args.test_path, "r") as f:
+        questions = [e["question"] for e in json.load(f)]
+
+    model, collator = load_query_encoder(args.model_name_or_path, vocab_chunk_size=args.vocab_chunk_size)
+    reference = encode_dense(model, collator, questions)
+    if "onnx" in args.backends and not os.path.exists(os.path.join(args.onnx_dir, ONNX_ENCODER_FILE)):
+        export_onnx(model, args.onnx_dir)
+    # int8 quantizes the model in place, so it is built last
+    for backend in sorted(set(args.backends), key=CPU_ENCODER_BACKENDS.index):
+        encoder = load_cpu_encoder(model, backend, onnx_dir=args.onnx_dir, num_threads=args.num_threads)
+        parity = query_parity(reference, encode_dense(encoder, collator, questions))
+
+        line = f"{backend:>6}"
+        for batch_size in args.batch_sizes:
+            line += f" | bz {batch_size} {encode_latency(encoder, collator, questions, batch_size=batch_size):8.2f}ms/query"
+        line += (f" | cosine {parity['cosine']:.4f} max_abs_diff {parity['max_abs_diff']:.4f}"
+                 f" | jaccard {parity['term_jaccard']:.4f} | L0 {parity['L0_candidate']:6.1f}")
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""Recall@k and latency of the IVF dense index against exact brute-force search.
+
+    python eval_dense_ann.py --index_dir /path/to/embs --model_name_or_path /path/to/lora --nprobe 4 16 64
+    python eval_dense_ann.py --index_dir /path/to/embs --n_doc_queries 1000 --codes float sq8 pq64
+
+Queries are the test.json questions encoded with the dense model, or with --n_doc_queries N,
+N stored doc vectors (no model needed). recall@k is the share of the exact top-k found by the IVF top-k.
+--codes compares scanning the float vectors with scanning codes written by
+`dense_index --quantize` (re-ranked exactly), next to the bytes each one keeps per vector.
+"""
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+from scaling_retriever.utils.dense_index import DenseIVFIndex, DENSE_CODES_FILE
+
+
+def encode_questions(model_name_or_path, questions, batch_size=8):
+    import torch
+    from transformers import AutoTokenizer
+    from scaling_retriever.dataset.data_collator import LlamaSparseCollectionCollator
+    from scaling_retriever.modeling.llm_encoder import LlamaBiDense
+
+    tokenizer = AutoTokenizer.from_pretrained(model_name_or_path, padding_side="left")
+    collator = LlamaSparseCollectionCollator(tokenizer=tokenizer, max_length=512)
+    model = LlamaBiDense.load_from_lora(model_name_or_path)
+    model.eval()
+    query_vecs = []
+    with torch.inference_mode():
+        for start in range(0, len(questions), batch_size):
+            batch = collator([(f"q{i}", q) for i, q in enumerate(questions[start:start + batch_size])])
+            inputs = {k: v for k, v in batch.items() if k not in {"ids"}}
+            query_vecs.append(model.encode(**inputs).float().numpy())
+    return np.concatenate(query_vecs)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--index_dir", type=str, required=True)
+    parser.add_argument("--model_name_or_path", default=None, type=str)
+    parser.add_argument("--test_path", default="../train_test_jsons/test.json", type=str)
+    parser.add_argument("--n_doc_queries", default=0, type=int)
+    parser.add_argument("--nprobe", default=[4, 16, 64], type=int, nargs="+")
+    parser.add_argument("--topk", default=[5, 10, 50], type=int, nargs="+")
+    parser.add_argument("--codes", default=["float"], type=str, nargs="+", help="float, sq8, pq{m}")
+    parser.add_argument("--rerank_factor", default=4, type=int)
+    args = parser.parse_args()
+
+    index = DenseIVFIndex.load(args.index_dir)
+    if args.n_doc_queries > 0:
+        rows = np.sort(np.random.default_rng(1).choice(len(index), args.n_doc_queries, replace=False))
+        queries = np.asarray(index.vectors[rows], dtype=np.float32)
+    else:
+        assert args.model_name_or_path is not None, "--model_name_or_path or --n_doc_queries is required"
+        with open(args.test_path, "r") as f:
+            queries = encode_questions(args.model_name_or_path, [e["question"] for e in json.load(f)])
+    max_k = max(args.topk)
+    # scores can be negative, nothing is thresholded away
+    threshold = -np.inf
+
+    start = time.perf_counter()
+    exact = [index.exact_search(query, topk=max_k, threshold=threshold)[0] for query in queries]
+    print(f" exact | {1000 * (time.perf_counter() - start) / len(queries):8.2f}ms/query")
+
+    for codes in args.codes:
+        if codes == "float":
+            scanned, bytes_per_vector = index, 4 * index.vectors.shape[1]
+        else:
+            scanned = DenseIVFIndex.load(args.index_dir, codes=codes, rerank_factor=args.rerank_factor)
+            bytes_per_vector = np.load(os.path.join(args.index_dir, DENSE_CODES_FILE.format(codes)),
+                                       mmap_mode="r").shape[1]
+        for nprobe in args.nprobe:
+            evaluate(scanned, queries, exact, nprobe, args.topk, threshold,
+                     f"{codes:>6} {bytes_per_vector:5d}B | nprobe {nprobe:4d}")
+
+
+def evaluate(index, queries, exact, nprobe, topks, threshold, label):
+    max_k = max(topks)
+    index.search(queries[:1], topk=max_k, nprobe=nprobe, threshold=threshold)  # warmup
+    start = time.perf_counter()
+    approx = [index.search(query, topk=max_k, nprobe=nprobe, threshold=threshold)[0] for query in queries]
+    line = f"{label} | {1000 * (time.perf_counter() - start) / len(queries):8.2f}ms/query"
+    for k in topks:
+        recall = np.mean([len(set(a[:k].tolist()) & set(e[:k].tolist())) / max(1, len(e[:k]))
+                          for (a, _), (e, _) in zip(approx, exact)])
+        line += f" | recall@{k} {recall:.4f}"
+    print(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""Retrieval quality of quantized csr impacts against the float32 index, on the gold documents of test.json.
+
+    python -m scaling_retriever.utils.inverted_index --quantize /path/to/index --quantize_dtype uint8
+    python eval_quantized_index.py --index_dir /path/to/index --dtypes float32 uint8 uint16
+
+A retrieved chunk "STORY_3#2" counts as a hit for the gold document "STORY_3".
+"""
+import argparse
+import json
+import os
+import pickle
+import time
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+from transformers import AutoTokenizer
+
+from scaling_retriever.dataset.data_collator import LlamaSparseCollectionCollator
+from scaling_retriever.modeling.llm_encoder import LlamaBiSparse
+from scaling_retriever.utils.inverted_index import (IndexCSRArray, CSR_DOC_VALUES_FILE, CSR_QUANTIZED_VALUES_FILE)
+from scaling_retriever.utils.sparse_scoring import numba_score_topk_csr
+from scaling_retriever.utils.utils import supports_bfloat16, sparsify
+
+
+def load_query_encoder(model_name_or_path, max_length=512, vocab_chunk_size=None):
+    tokenizer = AutoTokenizer.from_pretrained(model_name_or_path)
+    model = LlamaBiSparse.load_from_lora(model_name_or_path)
+    model.vocab_chunk_size = vocab_chunk_size
+    model.eval()
+    return model, LlamaSparseCollectionCollator(tokenizer=tokenizer, max_length=max_length)
+
+
+def encode_questions(model, collator, questions, batch_size=8, top_k=None, min_weight=0.):
+    loader = DataLoader([(f"q{i}", q) for i, q in enumerate(questions)], batch_size=batch_size,
+                        shuffle=False, collate_fn=collator)
+    sparse_query_vecs = []
+    with torch.inference_mode():
+        for batch in loader:
+            inputs = {k: v for k, v in batch.items() if k not in {"ids"}}
+            with torch.amp.autocast("cpu", dtype=torch.bfloat16 if supports_bfloat16() else torch.float32):
+                batch_sparse_reps = model.encode(**inputs)
+            batch_sparse_reps = sparsify(batch_sparse_reps, top_k=top_k, min_weight=min_weight)
+            for sparse_rep in batch_sparse_reps:
+                col = torch.nonzero(sparse_rep, as_tuple=True)[0]
+                sparse_query_vecs.append((col.cpu().numpy().astype(np.int32),
+                                          sparse_rep[col].float().cpu().numpy().astype(np.float32)))
+    return sparse_query_vecs
+
+
+def retrieve(index, sparse_query_vecs, topk):
+    scores_buffer = np.zeros(index.nb_docs(), dtype=np.float32)
+    touched_buffer = np.empty(index.nb_docs(), dtype=np.int32)
+    numba_score_topk_csr(index.offsets, index.doc_ids, index.doc_values, *sparse_query_vecs[0],
+                         0.0, topk, scores_buffer, touched_buffer)  # jit warmup
+    results, latencies = [], []
+    for col, values in sparse_query_vecs:
+        start = time.perf_counter()
+        ids, _ = numba_score_topk_csr(index.offsets, index.doc_ids, index.doc_values,
+                                      col, index.scale_query(col, values), 0.0, topk,
+                                      scores_buffer, touched_buffer)
+        latencies.append(time.perf_counter() - start)
+        results.append(ids)
+    return results, 1000 * np.mean(latencies)
+
+
+def gold_recall(retrieved_chunk_ids, gold_documents):
+    hits = {chunk_id.split("#")[0] for chunk_id in retrieved_chunk_ids}
+    return len(hits & set(gold_documents)) / len(gold_documents)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--index_dir", type=str, required=True)
+    parser.add_argument("--model_name_or_path", default="hzeng/Lion-SP-1B-llama3-marco-mntp", type=str)
+    parser.add_argument("--test_path", default="../train_test_jsons/test.json", type=str)
+    parser.add_argument("--dtypes", default=["float32", "uint8"], type=str, nargs="+")
+    parser.add_argument("--topk", default=[5, 10, 50], type=int, nargs="+")
+    args = parser.parse_args()
+
+    with open(args.test_path, "r") as f:
+        examples = json.load(f)
+    doc_ids = pickle.load(open(os.path.join(args.index_dir, "doc_ids.pkl"), "rb"))
+    model, collator = load_query_encoder(args.model_name_or_path)
+    sparse_query_vecs = encode_questions(model, collator, [e["question"] for e in examples])
+    max_k = max(args.topk)
+
+    reference = None
+    for dtype in args.dtypes:
+        index = IndexCSRArray.load(args.index_dir, values_dtype=dtype)
+        values_file = CSR_DOC_VALUES_FILE if dtype == "float32" else CSR_QUANTIZED_VALUES_FILE.format(dtype)
+        size_mb = os.path.getsize(os.path.join(args.index_dir, values_file)) / 2 ** 20
+        results, latency = retrieve(index, sparse_query_vecs, max_k)
+        if reference is None:
+            reference = results
+
+        line = f"{dtype:>8} | values {size_mb:8.1f}MB | {latency:7.2f}ms/query"
+        for k in args.topk:
+            recall = np.mean([gold_recall([str(doc_ids[i]) for i in ids[:k]], e["gold_documents"])
+                              for ids, e in zip(results, examples)])
+            overlap = np.mean([len(set(ids[:k].tolist()) & set(ref[:k].tolist())) / max(1, len(ref[:k]))
+                               for ids, ref in zip(results, reference)])
+            line += f" | recall@{k} {recall:.4f} overlap@{k} {overlap:.4f}"
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""Quality and latency of inference-free query encoding against the LlamaBiSparse query encoder.
+
+    python eval_query_encoders.py --index_dir /path/to/index
+
+Compares, on the gold documents of test.json:
+    model        the encoder forward pass (the default query path of the server)
+    idf          tokenizer + BM25 idf of the index
+    distilled    tokenizer + per-token weights fitted on the encoder outputs of the train.json questions
+    model@k      the encoder forward pass, keeping the k largest query weights (--query_top_k), to tune
+                 RETRIEVER_QUERY_TOP_K against recall
+The distilled table is written to {index_dir}/term_weights_distilled.npy, to be served with
+RETRIEVER_TERM_WEIGHTS=distilled.
+"""
+import argparse
+import json
+import os
+import pickle
+import time
+
+import numpy as np
+
+from eval_quantized_index import load_query_encoder, encode_questions, gold_recall
+from scaling_retriever.utils.index_scorer import IndexScorer
+from scaling_retriever.utils.inverted_index import IndexCSRArray
+from scaling_retriever.utils.term_weights import (InferenceFreeQueryEncoder, TERM_WEIGHTS_FILE, idf_weights,
+                                                  fit_term_weights)
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--index_dir", type=str, required=True)
+    parser.add_argument("--model_name_or_path", default="hzeng/Lion-SP-1B-llama3-marco-mntp", type=str)
+    parser.add_argument("--train_path", default="../train_test_jsons/train.json", type=str)
+    parser.add_argument("--test_path", default="../train_test_jsons/test.json", type=str)
+    parser.add_argument("--topk", default=[5, 10, 50], type=int, nargs="+")
+    parser.add_argument("--query_top_k", default=[], type=int, nargs="*")
+    args = parser.parse_args()
+
+    with open(args.train_path, "r") as f:
+        train_questions = [e["question"] for e in json.load(f)]
+    with open(args.test_path, "r") as f:
+        examples = json.load(f)
+    questions = [e["question"] for e in examples]
+
+    sparse_index = IndexCSRArray.load(args.index_dir)
+    sparse_index.ensure_block_max()
+    scorer = IndexScorer(sparse_index)
+    doc_ids = pickle.load(open(os.path.join(args.index_dir, "doc_ids.pkl"), "rb"))
+
+    model, collator = load_query_encoder(args.model_name_or_path)
+    tokenizer = collator.tokenizer
+    train_vecs = encode_questions(model, collator, train_questions)
+    idf_encoder = InferenceFreeQueryEncoder(tokenizer, idf_weights(sparse_index))
+    distilled = fit_term_weights(idf_encoder.tokenize(train_questions), train_vecs, idf_encoder.weights)
+    np.save(os.path.join(args.index_dir, TERM_WEIGHTS_FILE.format("distilled")), distilled)
+    distilled_encoder = InferenceFreeQueryEncoder(tokenizer, distilled)
+
+    encoders = {
+        # one query per forward pass, as a lone /search request would see it
+        "model": lambda qs: encode_questions(model, collator, qs, batch_size=1),
+        "idf": idf_encoder.encode,
+        "distilled": distilled_encoder.encode,
+    }
+    for query_top_k in args.query_top_k:
+        encoders[f"model@{query_top_k}"] = (lambda qs, query_top_k=query_top_k:
+                                            encode_questions(model, collator, qs, batch_size=1, top_k=query_top_k))
+    max_k = max(args.topk)
+    reference = None
+    for name, encode in encoders.items():
+        encode(questions[:1])  # warmup
+        sparse_query_vecs, encode_time = timed(encode, questions)
+        results, score_time = timed(lambda: [scorer.score(col, values, topk=max_k)[0]
+                                             for col, values in sparse_query_vecs])
+        if reference is None:
+            reference = results
+
+        line = (f"{name:>10} | encode {1000 * encode_time / len(questions):9.3f}ms/query"
+                f" | score {1000 * score_time / len(questions):7.2f}ms/query"
+                f" | L0 {np.mean([len(col) for col, _ in sparse_query_vecs]):6.1f}")
+        for k in args.topk:
+            recall = np.mean([gold_recall([str(doc_ids[i]) for i in ids[:k]], e["gold_documents"])
+                              for ids, e in zip(results, examples)])
+            overlap = np.mean([len(set(ids[:k].tolist()) & set(ref[:k].tolist())) / max(1, len(ref[:k]))
+                               for ids, ref in zip(results, reference)])
+            line += f" | recall@{k} {recall:.4f} overlap@{k} {overlap:.4f}"
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
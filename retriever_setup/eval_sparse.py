@@ -3,22 +3,29 @@ import torch.distributed
 import ujson 
 from dataclasses import field, dataclass
 from transformers import AutoTokenizer, HfArgumentParser
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, BatchSampler, SequentialSampler
 import torch
+import numpy as np
 from torch.utils.data.distributed import DistributedSampler
 from huggingface_hub import hf_hub_download
 
 from huggingface_hub import login
 
-from scaling_retriever.dataset.dataset import CollectionDataset
+from scaling_retriever.dataset.dataset import CollectionDataset, StreamingCollectionDataset
 from scaling_retriever.dataset.data_collator import LlamaSparseCollectionCollator
+from scaling_retriever.dataset.sampler import (LengthBucketBatchSampler, ResumeBatchSampler, tokenized_lengths,
+                                              padding_ratio)
+from scaling_retriever.dataset.token_cache import (TokenizedCollectionDataset, PreTokenizedCollectionCollator,
+                                                   build_token_cache, token_cache_dir, token_cache_exists)
 from scaling_retriever.modeling.llm_encoder import LlamaBiSparse
 from scaling_retriever.indexer import SparseIndexer
+from scaling_retriever.utils.utils import is_first_worker
 import constants
 
 def ddp_setup(args):
     if "RANK" in os.environ and "WORLD_SIZE" in os.environ:
-        torch.distributed.init_process_group(backend="nccl")
+        # gloo lets CPU-only machines index with one worker process per shard (torchrun --nproc_per_node N)
+        torch.distributed.init_process_group(backend="nccl" if torch.cuda.is_available() else "gloo")
         args.local_rank = int(os.environ.get("LOCAL_RANK", 0))
         args.world_size = torch.distributed.get_world_size()
         print(f"Initialized DDP on Rank {args.local_rank}, World Size: {args.world_size}")
@@ -36,26 +43,52 @@ class SparseArguments:
     eval_batch_size: int = field(default=128)
     doc_max_length: int = field(default=192)
     task_name: str = field(default="indexing")     
+    # > 0 to max-pool the lm_head logits vocab_chunk_size vocabulary rows at a time
+    vocab_chunk_size: int = field(default=0)
+    # keep at most doc_top_k terms with weight > doc_min_weight per document, 0 to keep all of them
+    doc_top_k: int = field(default=0)
+    doc_min_weight: float = field(default=0.)
+    # > 0 to spill sorted posting runs to disk every max_postings_in_memory postings and merge them at the end,
+    # rerunning a crashed build with the same arguments resumes from its spilled runs
+    max_postings_in_memory: int = field(default=0)
+    # intra-op threads of each worker on CPU, 0 to split the cores evenly between the workers of a node
+    num_threads: int = field(default=0)
+    # batch documents of similar tokenized length instead of random ones, to cut the padding
+    length_bucketing: bool = field(default=False)
+    # root of the pre-tokenized corpus caches (keyed by tokenizer, doc_max_length and corpus), empty to
+    # tokenize in the collator. Built on the first run, later runs skip parsing and tokenizing the corpus
+    token_cache_dir: str = field(default="")
+    # read the corpus lazily, split between ranks and DataLoader workers by byte ranges, instead of
+    # loading it all in memory first. Documents then come in file order, without length bucketing
+    streaming: bool = field(default=False)
         
 def sparse_index(args, model_type):
     ddp_setup(args)
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    if device == "cpu":
+        # the cores of a node are split between the workers of that node, not of the whole run
+        local_world_size = int(os.environ.get("LOCAL_WORLD_SIZE", args.world_size))
+        torch.set_num_threads(args.num_threads or max(1, os.cpu_count() // local_world_size))
+        print(f"Rank {args.local_rank} encodes on cpu with {torch.get_num_threads()} threads")
     tokenizer = AutoTokenizer.from_pretrained(args.model_name_or_path)
-    d_collection = CollectionDataset(corpus_path=args.corpus_path, 
+    if args.streaming:
+        assert not args.token_cache_dir, "--streaming reads the raw corpus, drop --token_cache_dir"
+        d_collection = StreamingCollectionDataset(corpus_path=args.corpus_path,
+                                                  data_source=constants.corpus_datasource[args.corpus_path])
+    elif args.token_cache_dir:
+        d_collection = load_token_cache(args, tokenizer)
+    else:
+        d_collection = CollectionDataset(corpus_path=args.corpus_path, 
                                          data_source=constants.corpus_datasource[args.corpus_path])
 
     if model_type == "llama":
         print("eval_sparse", args.model_name_or_path)
-        model = LlamaBiSparse.load_from_lora(args.model_name_or_path).to("cuda")
-        d_collator = LlamaSparseCollectionCollator(tokenizer=tokenizer, max_length=args.doc_max_length)
-
-    # Only use DistributedSampler if running distributed training
-    if args.world_size > 1:
-        sampler = DistributedSampler(d_collection, shuffle=False)
-    else:
-        sampler = None
-
-    d_loader = DataLoader(d_collection, batch_size=args.eval_batch_size, shuffle=(sampler is None),
-                          collate_fn=d_collator, num_workers=2, sampler=sampler)
+        model = LlamaBiSparse.load_from_lora(args.model_name_or_path).to(device)
+        model.vocab_chunk_size = args.vocab_chunk_size
+        if args.token_cache_dir:
+            d_collator = PreTokenizedCollectionCollator(tokenizer=tokenizer, dataset=d_collection)
+        else:
+            d_collator = LlamaSparseCollectionCollator(tokenizer=tokenizer, max_length=args.doc_max_length)
 
     if args.world_size > 1:
         index_dir = args.index_dir.rstrip("/")
@@ -64,9 +97,97 @@ def sparse_index(args, model_type):
         index_dir = args.index_dir
 
     print(index_dir, args.local_rank, model.vocab_size)
+    # the indexer comes first: a build resumed from spilled runs starts its loader after the batches they cover
     indexer = SparseIndexer(model, index_dir=index_dir, compute_stats=True, dim_voc=model.vocab_size,
-                            device="cuda" if torch.cuda.is_available() else "cpu")
+                            device=device,
+                            doc_top_k=args.doc_top_k, doc_min_weight=args.doc_min_weight,
+                            max_postings_in_memory=args.max_postings_in_memory,
+                            build_key=index_build_key(args) if args.max_postings_in_memory else None)
+
+    if args.streaming:
+        # the dataset shards itself between ranks and workers, no sampler
+        d_loader = DataLoader(d_collection, batch_size=args.eval_batch_size, collate_fn=d_collator, num_workers=2)
+    elif args.length_bucketing:
+        if args.token_cache_dir:
+            lengths = d_collection.lengths
+        else:
+            # the sampler only reads the lengths of this rank's slice of the collection
+            lengths = tokenized_lengths(d_collection, tokenizer, args.doc_max_length,
+                                        indices=np.arange(args.local_rank, len(d_collection), args.world_size))
+        batch_sampler = LengthBucketBatchSampler(lengths, args.eval_batch_size,
+                                                 num_replicas=args.world_size, rank=args.local_rank)
+        random_order = np.random.default_rng(0).permutation(np.arange(args.local_rank, len(lengths), args.world_size))
+        random_batches = [random_order[i:i + args.eval_batch_size]
+                          for i in range(0, len(random_order), args.eval_batch_size)]
+        print(f"Rank {args.local_rank} padding ratio: {padding_ratio(lengths, batch_sampler.batches):.3f} "
+              f"with length buckets, {padding_ratio(lengths, random_batches):.3f} with random batches")
+        d_loader = DataLoader(d_collection, batch_sampler=ResumeBatchSampler(batch_sampler, indexer.resume_batches),
+                              collate_fn=d_collator, num_workers=2)
+    else:
+        # Only use DistributedSampler if running distributed training
+        if args.world_size > 1:
+            sampler = DistributedSampler(d_collection, shuffle=False)
+        else:
+            sampler = None
+
+        # spilled runs are resumed by skipping the batches they cover, which needs the same order on restart
+        if indexer.resume_batches:
+            batch_sampler = BatchSampler(sampler if sampler is not None else SequentialSampler(d_collection),
+                                         args.eval_batch_size, drop_last=False)
+            d_loader = DataLoader(d_collection, batch_sampler=ResumeBatchSampler(batch_sampler, indexer.resume_batches),
+                                  collate_fn=d_collator, num_workers=2)
+        else:
+            d_loader = DataLoader(d_collection, batch_size=args.eval_batch_size,
+                                  shuffle=(sampler is None and not args.max_postings_in_memory),
+                                  collate_fn=d_collator, num_workers=2, sampler=sampler)
+
     indexer.index(d_loader)
+    report_throughput(indexer, args.world_size)
+
+
+def index_build_key(args):
+    """what decides the batches of this rank and their postings, recorded with the spilled runs so a build is
+    only resumed with the same ones
+    """
+    stat = os.stat(args.corpus_path)
+    return {"corpus_path": os.path.abspath(args.corpus_path), "corpus_size": stat.st_size,
+            "corpus_mtime_ns": stat.st_mtime_ns, "model_name_or_path": args.model_name_or_path,
+            "eval_batch_size": args.eval_batch_size, "doc_max_length": args.doc_max_length,
+            "doc_top_k": args.doc_top_k, "doc_min_weight": args.doc_min_weight,
+            "vocab_chunk_size": args.vocab_chunk_size, "length_bucketing": args.length_bucketing,
+            "streaming": args.streaming, "token_cache": bool(args.token_cache_dir),
+            "world_size": args.world_size, "rank": torch.distributed.get_rank() if args.world_size > 1 else 0}
+
+
+def load_token_cache(args, tokenizer):
+    """token cache of the corpus for this tokenizer and doc_max_length, the first worker builds it if missing
+    """
+    assert constants.corpus_datasource[args.corpus_path] == "fineweb", args.corpus_path
+    cache_dir = token_cache_dir(args.token_cache_dir, tokenizer, args.doc_max_length, args.corpus_path)
+    if is_first_worker() and not token_cache_exists(cache_dir):
+        build_token_cache(args.corpus_path, tokenizer, args.doc_max_length, cache_dir)
+    if args.world_size > 1:
+        torch.distributed.barrier()
+    print(f"Rank {args.local_rank} reads pre-tokenized corpus from {cache_dir}")
+    return TokenizedCollectionDataset(cache_dir)
+
+
+def report_throughput(indexer, world_size):
+    """docs/sec of the whole run (all workers) and per worker, the run takes as long as its slowest worker
+    """
+    n_docs, seconds = indexer.n_indexed, indexer.index_seconds
+    if world_size > 1:
+        n_docs_t = torch.tensor([n_docs], dtype=torch.float64)
+        seconds_t = torch.tensor([seconds], dtype=torch.float64)
+        if torch.cuda.is_available():
+            n_docs_t, seconds_t = n_docs_t.cuda(), seconds_t.cuda()
+        torch.distributed.all_reduce(n_docs_t, op=torch.distributed.ReduceOp.SUM)
+        torch.distributed.all_reduce(seconds_t, op=torch.distributed.ReduceOp.MAX)
+        n_docs, seconds = int(n_docs_t.item()), seconds_t.item()
+    if is_first_worker():
+        docs_per_sec = n_docs / max(seconds, 1e-9)
+        print(f"Indexed {n_docs} documents in {seconds:.1f}s with {world_size} workers: "
+              f"{docs_per_sec:.1f} docs/sec, {docs_per_sec / world_size:.1f} docs/sec per worker")
 
 def init_main():
     parser = HfArgumentParser(SparseArguments)
@@ -1,5 +1,7 @@
-from torch.utils.data import Dataset
+import os
 import json
+import torch.distributed
+from torch.utils.data import Dataset, IterableDataset, get_worker_info
 
 def get_doc_text(title, text):
         if title is None:
@@ -32,5 +34,42 @@ class CollectionDataset(Dataset):
                 data = json.loads(line)
                 pid_to_doc[data["chunk_id"]] = data["contents"]  
         return pid_to_doc
-    
-    
\ No newline at end of file
+
+
+class StreamingCollectionDataset(IterableDataset):
+    """(pid, text) pairs read lazily from the fineweb jsonl, nothing but the current line is held in memory.
+    The file is split in num_shards = world_size * num_workers contiguous byte ranges, a line belongs to the
+    shard its first byte falls in, so every line is read by exactly one worker of one rank and the pairs of
+    a shard always come in the same order. Unlike CollectionDataset, duplicate chunk_ids are not merged.
+    """
+    def __init__(self, corpus_path, data_source=None, rank=None, world_size=None):
+        if data_source != "fineweb":
+            raise NotImplementedError(f"Unknown data source: {data_source}")
+        self.corpus_path = corpus_path
+        distributed = torch.distributed.is_available() and torch.distributed.is_initialized()
+        self.rank = rank if rank is not None else (torch.distributed.get_rank() if distributed else 0)
+        self.world_size = world_size if world_size is not None else (
+            torch.distributed.get_world_size() if distributed else 1)
+
+    def byte_range(self, shard, num_shards):
+        size = os.path.getsize(self.corpus_path)
+        return size * shard // num_shards, size * (shard + 1) // num_shards
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        num_workers, worker_id = (worker_info.num_workers, worker_info.id) if worker_info is not None else (1, 0)
+        start, end = self.byte_range(self.rank * num_workers + worker_id, self.world_size * num_workers)
+        with open(self.corpus_path, "rb") as f:
+            if start > 0:
+                # the line containing byte start - 1 started in the previous shard (or ends right before start)
+                f.seek(start - 1)
+                f.readline()
+            while f.tell() < end:
+                line = f.readline()
+                if not line:
+                    break
+                if not line.strip():
+                    continue
+                data = json.loads(line)
+                yield data["chunk_id"], data["contents"]
+
@@ -0,0 +1,63 @@
+import itertools
+
+import numpy as np
+from torch.utils.data import Sampler
+from tqdm.auto import tqdm
+
+
+def tokenized_lengths(dataset, tokenizer, max_length, indices=None, chunk_size=10000):
+    """number of tokens of every (id, text) item of `dataset` once truncated to max_length, as the collator sees it.
+    With `indices`, only those items are tokenized (e.g. the slice of one rank), the others are left at 0
+    """
+    lengths = np.zeros(len(dataset), dtype=np.int64)
+    indices = np.arange(len(dataset)) if indices is None else np.asarray(indices)
+    for start in tqdm(range(0, len(indices), chunk_size), desc="tokenizing collection lengths"):
+        chunk = indices[start:start + chunk_size]
+        texts = [dataset[i][1] for i in chunk]
+        input_ids = tokenizer(texts, max_length=max_length, truncation=True)["input_ids"]
+        lengths[chunk] = [len(ids) for ids in input_ids]
+    return lengths
+
+
+def padding_ratio(lengths, batches):
+    """share of the padded [batch, longest] inputs of `batches` that is padding
+    """
+    real = sum(int(lengths[batch].sum()) for batch in batches)
+    padded = sum(int(lengths[batch].max()) * len(batch) for batch in batches)
+    return 1 - real / max(padded, 1)
+
+
+class LengthBucketBatchSampler(Sampler):
+    """batches of documents with similar tokenized lengths, so padding to the longest document of a batch
+    costs little. Documents are split between ranks like an unshuffled DistributedSampler (without its
+    padding duplicates), then sorted by decreasing length in each rank, the longest batches run first
+    so an out-of-memory batch size fails right away. Doc-id bookkeeping only relies on the ids of each
+    batch, which the collator keeps aligned with its rows.
+    """
+    def __init__(self, lengths, batch_size, num_replicas=1, rank=0):
+        lengths = np.asarray(lengths)
+        indices = np.arange(rank, len(lengths), num_replicas)
+        order = indices[np.argsort(-lengths[indices], kind="stable")]
+        self.batches = [order[start:start + batch_size].tolist() for start in range(0, len(order), batch_size)]
+
+    def __iter__(self):
+        return iter(self.batches)
+
+    def __len__(self):
+        return len(self.batches)
+
+
+class ResumeBatchSampler(Sampler):
+    """`batch_sampler` without its first `skip` batches, so a resumed build does not load (and tokenize)
+    the batches its spilled runs already cover. Only the index lists are skipped, not the data
+    """
+    def __init__(self, batch_sampler, skip=0):
+        self.batch_sampler = batch_sampler
+        self.skip = skip
+
+    def __iter__(self):
+        return itertools.islice(iter(self.batch_sampler), self.skip, None)
+
+    def __len__(self):
+        return max(len(self.batch_sampler) - self.skip, 0)
+
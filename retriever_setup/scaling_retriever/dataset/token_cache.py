@@ -0,0 +1,196 @@
+import argparse
+import array
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+from torch.utils.data import Dataset
+from tqdm.auto import tqdm
+
+# token ids of row i are token_ids[offsets[i]:offsets[i + 1]], already truncated to max_length,
+# the cache directory is keyed by the tokenizer, max_length and the corpus file it was built from
+TOKEN_CACHE_META_FILE = "token_cache_meta.json"
+TOKEN_CACHE_IDS_FILE = "token_ids.bin"
+TOKEN_CACHE_OFFSETS_FILE = "token_offsets.npy"
+TOKEN_CACHE_DOC_IDS_FILE = "token_cache_doc_ids.json"
+TOKEN_CACHE_DTYPE = np.uint32
+# part of the cache key, bumped when the rows a build writes change (2: duplicate chunk ids merged)
+TOKEN_CACHE_VERSION = 2
+
+
+def tokenizer_fingerprint(tokenizer):
+    """hash of the tokenization itself (vocab, normalizer, special tokens), not of the checkpoint path,
+    so LoRA checkpoints of the same base model share a cache
+    """
+    if getattr(tokenizer, "is_fast", False):
+        state = tokenizer.backend_tokenizer.to_str()
+    else:
+        state = json.dumps([sorted(tokenizer.get_vocab().items()), tokenizer.all_special_tokens])
+    return hashlib.sha1(state.encode("utf-8")).hexdigest()
+
+
+def token_cache_dir(cache_root, tokenizer, max_length, corpus_path):
+    stat = os.stat(corpus_path)
+    key = json.dumps([TOKEN_CACHE_VERSION, tokenizer_fingerprint(tokenizer), max_length, os.path.abspath(corpus_path),
+                      stat.st_size, stat.st_mtime_ns])
+    name = os.path.splitext(os.path.basename(corpus_path))[0]
+    return os.path.join(cache_root, f"{name}_len{max_length}_{hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]}")
+
+
+def token_cache_exists(cache_dir):
+    return os.path.exists(os.path.join(cache_dir, TOKEN_CACHE_META_FILE))
+
+
+def build_token_cache(corpus_path, tokenizer, max_length, cache_dir, chunk_size=10000):
+    """tokenize the fineweb jsonl corpus once, the way LlamaSparseCollectionCollator does, and write
+    the flat token ids + offsets. Rows are the documents of CollectionDataset in its order: a chunk_id
+    repeated in the corpus is one row, at its first position, with the text of its last line.
+    Written to a temporary directory first, so an interrupted build is never mistaken for a complete cache.
+    """
+    assert len(tokenizer) <= np.iinfo(TOKEN_CACHE_DTYPE).max, len(tokenizer)
+    tmp_dir = cache_dir.rstrip("/") + ".tmp"
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+
+    # chunk_id -> line of its last occurrence, in order of first occurrence like the CollectionDataset dict
+    last_line = {}
+    with open(corpus_path, "r") as f:
+        for i, line in enumerate(tqdm(f, desc="reading chunk ids")):
+            last_line[json.loads(line)["chunk_id"]] = i
+    chunk_ids = list(last_line)
+
+    written_ids = []
+    offsets = array.array("q", [0])
+    pending = []
+
+    def flush(out):
+        input_ids = tokenizer(pending, max_length=max_length, truncation=True)["input_ids"]
+        for ids in input_ids:
+            out.write(np.asarray(ids, dtype=TOKEN_CACHE_DTYPE).tobytes())
+            offsets.append(offsets[-1] + len(ids))
+        pending.clear()
+
+    ids_path = os.path.join(tmp_dir, TOKEN_CACHE_IDS_FILE)
+    with open(corpus_path, "r") as f, open(ids_path, "wb") as out:
+        for i, line in enumerate(tqdm(f, desc="tokenizing corpus")):
+            chunk = json.loads(line)
+            if last_line[chunk["chunk_id"]] != i:
+                continue
+            written_ids.append(chunk["chunk_id"])
+            pending.append(chunk["contents"])
+            if len(pending) == chunk_size:
+                flush(out)
+        if pending:
+            flush(out)
+    offsets = np.frombuffer(offsets, dtype=np.int64)
+
+    if written_ids != chunk_ids:
+        # duplicates were written at their last line, move the rows to their first position
+        print(f"{i + 1 - len(chunk_ids)} duplicate chunk ids, reordering the token cache rows")
+        position = {chunk_id: row for row, chunk_id in enumerate(written_ids)}
+        written = np.memmap(ids_path, dtype=TOKEN_CACHE_DTYPE, mode="r") if offsets[-1] > 0 else None
+        row_offsets = array.array("q", [0])
+        with open(ids_path + ".reordered", "wb") as out:
+            for chunk_id in chunk_ids:
+                row = position[chunk_id]
+                if offsets[row + 1] > offsets[row]:
+                    out.write(written[offsets[row]:offsets[row + 1]].tobytes())
+                row_offsets.append(row_offsets[-1] + int(offsets[row + 1] - offsets[row]))
+        del written
+        os.replace(ids_path + ".reordered", ids_path)
+        offsets = np.frombuffer(row_offsets, dtype=np.int64)
+
+    np.save(os.path.join(tmp_dir, TOKEN_CACHE_OFFSETS_FILE), offsets)
+    with open(os.path.join(tmp_dir, TOKEN_CACHE_DOC_IDS_FILE), "w") as f:
+        json.dump(chunk_ids, f)
+    with open(os.path.join(tmp_dir, TOKEN_CACHE_META_FILE), "w") as f:
+        json.dump({"n_docs": len(chunk_ids), "n_tokens": int(offsets[-1]), "max_length": max_length,
+                   "tokenizer": tokenizer.name_or_path, "corpus_path": os.path.abspath(corpus_path)}, f)
+    if os.path.exists(cache_dir):
+        shutil.rmtree(cache_dir)
+    os.replace(tmp_dir, cache_dir)
+    print(f"token cache with {len(chunk_ids)} chunks and {offsets[-1]} tokens written to {cache_dir}")
+
+
+class TokenizedCollectionDataset(Dataset):
+    """(pid, row) items of a token cache, a drop-in for CollectionDataset with PreTokenizedCollectionCollator.
+    The token ids are memory-mapped lazily, so DataLoader workers map the file themselves
+    instead of receiving a pickled copy of it.
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        with open(os.path.join(cache_dir, TOKEN_CACHE_META_FILE), "r") as f:
+            self.meta = json.load(f)
+        self.offsets = np.load(os.path.join(cache_dir, TOKEN_CACHE_OFFSETS_FILE))
+        with open(os.path.join(cache_dir, TOKEN_CACHE_DOC_IDS_FILE), "r") as f:
+            self.pids = json.load(f)
+        self._token_ids = None
+
+    @property
+    def lengths(self):
+        """tokenized length of every row, what tokenized_lengths computes for a CollectionDataset
+        """
+        return np.diff(self.offsets)
+
+    @property
+    def token_ids(self):
+        if self._token_ids is None:
+            path = os.path.join(self.cache_dir, TOKEN_CACHE_IDS_FILE)
+            if os.path.getsize(path) > 0:
+                self._token_ids = np.memmap(path, dtype=TOKEN_CACHE_DTYPE, mode="r")
+            else:
+                self._token_ids = np.zeros(0, dtype=TOKEN_CACHE_DTYPE)
+        return self._token_ids
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_token_ids"] = None
+        return state
+
+    def __len__(self):
+        return len(self.pids)
+
+    def __getitem__(self, idx):
+        return self.pids[idx], idx
+
+    def get_input_ids(self, idx):
+        return self.token_ids[self.offsets[idx]:self.offsets[idx + 1]].astype(np.int64).tolist()
+
+
+class PreTokenizedCollectionCollator:
+    """LlamaSparseCollectionCollator for (pid, row) items of a TokenizedCollectionDataset: the ids are
+    sliced from the cache and padded to the longest of the batch, nothing is tokenized
+    """
+    def __init__(self, tokenizer, dataset):
+        self.tokenizer = tokenizer
+        self.dataset = dataset
+
+    def __call__(self, batch):
+        ids, rows = [list(xs) for xs in zip(*batch)]
+        tokenized_contexts = self.tokenizer.pad({"input_ids": [self.dataset.get_input_ids(row) for row in rows]},
+                                                padding="longest", return_attention_mask=True, return_tensors="pt")
+        return {
+            **{k: v for k, v in tokenized_contexts.items()},
+            "ids": ids
+        }
+
+
+if __name__ == "__main__":
+    from transformers import AutoTokenizer
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--corpus_path", type=str, required=True)
+    parser.add_argument("--cache_root", type=str, required=True)
+    parser.add_argument("--tokenizer", type=str, required=True)
+    parser.add_argument("--max_length", default=192, type=int)
+    args = parser.parse_args()
+
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer)
+    cache_dir = token_cache_dir(args.cache_root, tokenizer, args.max_length, args.corpus_path)
+    if token_cache_exists(cache_dir):
+        print(f"token cache already built at {cache_dir}")
+    else:
+        build_token_cache(args.corpus_path, tokenizer, args.max_length, cache_dir)
@@ -1,15 +1,17 @@
 import os 
 import pickle
 import logging
+import time
 from collections import defaultdict
 import torch 
+from torch.utils.data import RandomSampler
 from tqdm import tqdm
 from transformers.modeling_utils import unwrap_model
 import numpy as np
 import ujson
 
-from scaling_retriever.utils.utils import is_first_worker, to_list,supports_bfloat16
-from scaling_retriever.utils.inverted_index import IndexDictOfArray
+from scaling_retriever.utils.utils import is_first_worker, to_list,supports_bfloat16, sparsify
+from scaling_retriever.utils.inverted_index import IndexDictOfArray, IndexCSRBuilder
 from scaling_retriever.modeling.losses.regulariaztion import L0
 
 logger = logging.getLogger()
@@ -24,6 +26,7 @@ def store_embs(model, collection_loader, local_rank, index_dir, device,
 
     dtype = torch.bfloat16 if supports_bfloat16() else torch.float32
     print(f"Using {'bfloat16' if dtype == torch.bfloat16 else 'float32'}")
+    device_type = torch.device(device).type
 
     embeddings = []
     embeddings_ids = []
@@ -33,7 +36,7 @@ def store_embs(model, collection_loader, local_rank, index_dir, device,
     for idx, batch in tqdm(enumerate(collection_loader), disable=not is_first_worker(),
                            desc=f"Encoding {len(collection_loader)} sequences", total=len(collection_loader)):
         with torch.inference_mode():
-            with torch.cuda.amp.autocast():  
+            with torch.amp.autocast(device_type, dtype=dtype, enabled=dtype != torch.float32):  
                 inputs = {k: v.to(device) for k, v in batch.items() if k != "ids"}
                 if is_query:
                     raise NotImplementedError 
@@ -77,7 +80,7 @@ def store_embs(model, collection_loader, local_rank, index_dir, device,
         torch.cuda.empty_cache()  
         chunk_idx += 1 
 
-    plan = {"nranks": torch.distributed.get_world_size(),
+    plan = {"nranks": torch.distributed.get_world_size() if torch.distributed.is_initialized() else 1,
             "num_chunks": chunk_idx,
             "index_path": os.path.join(index_dir, "model.index")}
     
@@ -123,20 +126,37 @@ def process_query_for_multiprocess(args):
         
 class SparseIndexer:
     def __init__(self, model, index_dir, device, compute_stats=False, dim_voc=None, force_new=True,
-                 filename="array_index.h5py", **kwargs):
+                 filename="array_index.h5py", doc_top_k=None, doc_min_weight=0., max_postings_in_memory=None,
+                 resume=True, build_key=None, **kwargs):
         self.model = model
         self.model.eval()
         self.index_dir = index_dir
         
-        self.sparse_index = IndexDictOfArray(self.index_dir, dim_voc=dim_voc, force_new=force_new, filename=filename)
+        if max_postings_in_memory:
+            # postings are spilled to sorted runs on disk and merged into the csr index at the end,
+            # build memory no longer grows with the collection (no h5py index is written), with `resume`
+            # the runs left by a crashed build are kept and the batches they cover are skipped, `build_key`
+            # records the inputs that decide the batches (see IndexCSRBuilder)
+            assert self.index_dir is not None, "spilling runs needs an index_dir"
+            self.sparse_index = IndexCSRBuilder(self.index_dir, dim_voc=dim_voc, max_postings=max_postings_in_memory,
+                                                resume=resume, build_key=build_key)
+        else:
+            self.sparse_index = IndexDictOfArray(self.index_dir, dim_voc=dim_voc, force_new=force_new, filename=filename)
         self.compute_stats = compute_stats
-        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")  
+        self.dim_voc = dim_voc
+        # caps on the terms kept per document, they bound the posting list lengths
+        self.doc_top_k = doc_top_k
+        self.doc_min_weight = doc_min_weight
+        self.device = torch.device(device)
         
         if self.compute_stats:
             self.l0 = L0()
         
         self.model.to(self.device)
         
+        # batches of the loader already in the spilled runs of a resumed build
+        self.resume_batches = getattr(self.sparse_index, "n_batches", 0)
+
         self.local_rank = torch.distributed.get_rank() if torch.distributed.is_initialized() else 0
         self.world_size = torch.distributed.get_world_size() if torch.distributed.is_initialized() else 1
         print(f"world_size: {self.world_size}, local_rank: {self.local_rank}")
@@ -148,15 +168,35 @@ class SparseIndexer:
         doc_ids = {}
         stats = defaultdict(float) if self.compute_stats else None
         count = 0
+        n_batches = 0
+        # a loader built with ResumeBatchSampler(..., skip=self.resume_batches) starts after the resumed batches,
+        # any other one (e.g. streaming) still yields them and they are dropped here
+        skipped = getattr(collection_loader.batch_sampler, "skip", 0)
+        assert skipped in (0, self.resume_batches), (skipped, self.resume_batches)
+        if self.resume_batches:
+            # skipping is only sound when the loader yields the same batches in the same order again
+            if isinstance(getattr(collection_loader, "sampler", None), RandomSampler):
+                raise ValueError(f"{self.index_dir} has spilled runs to resume from, but the loader shuffles: "
+                                 f"index in a deterministic order or remove {self.sparse_index.run_dir}")
+            doc_ids = self.sparse_index.resumed_doc_ids()
+            count = self.sparse_index.nb_docs()
+        n_resumed = count
+        start_time = time.perf_counter()
 
         with torch.inference_mode():
-            for t, batch in enumerate(tqdm(collection_loader, disable=not is_first_worker())):
+            for t, batch in enumerate(tqdm(collection_loader, disable=not is_first_worker()), start=skipped):
+                if t < self.resume_batches:
+                    continue
                 print(f"Batch {t}: {len(batch['ids'])} documents")
                 inputs = {k: v.to(self.device) for k, v in batch.items() if k not in {"ids"}}  
                 
-                with torch.amp.autocast("cuda", dtype=dtype):  
+                with torch.amp.autocast(self.device.type, dtype=dtype, enabled=dtype != torch.float32):  
                     batch_documents = self.model.encode(**inputs)  
                 
+                if self.compute_stats:
+                    stats["L0_d_encoder"] += self.l0(batch_documents).item()
+                    stats["padding_ratio"] += 1 - inputs["attention_mask"].float().mean().item()
+                batch_documents = sparsify(batch_documents, top_k=self.doc_top_k, min_weight=self.doc_min_weight)
                 if self.compute_stats:
                     stats["L0_d"] += self.l0(batch_documents).item()
                 
@@ -172,27 +212,44 @@ class SparseIndexer:
                     batch_ids = [id_dict[x] for x in batch_ids]
 
                 unique_g_row = np.sort(np.unique(g_row))
+                batch_doc_ids = {}
                 if len(unique_g_row) == len(batch_ids):
-                    doc_ids.update({int(x): y for x, y in zip(unique_g_row, batch_ids)})
+                    batch_doc_ids.update({int(x): y for x, y in zip(unique_g_row, batch_ids)})
                 else:
                     all_idxes = (count + np.arange(len(batch_ids))) * self.world_size + self.local_rank
                     for _i, _idx in enumerate(all_idxes):
                         if _idx in unique_g_row:
-                            doc_ids[_idx] = batch_ids[_i]
+                            batch_doc_ids[int(_idx)] = batch_ids[_i]
+                doc_ids.update(batch_doc_ids)
 
-                self.sparse_index.add_batch_document(
-                    g_row, col.cpu().numpy(), data.float().cpu().numpy(), n_docs=len(batch_ids)
-                )  
+                if isinstance(self.sparse_index, IndexCSRBuilder):
+                    # the doc ids are spilled with the postings, so a resumed build gets them back
+                    self.sparse_index.add_batch_document(
+                        g_row, col.cpu().numpy(), data.float().cpu().numpy(), n_docs=len(batch_ids),
+                        doc_ids=batch_doc_ids
+                    )
+                else:
+                    self.sparse_index.add_batch_document(
+                        g_row, col.cpu().numpy(), data.float().cpu().numpy(), n_docs=len(batch_ids)
+                    )  
                 count += len(batch_ids)  
+                n_batches += 1
                 if count % 100000 < len(batch_ids):  
                     print(f"Documents indexed so far: {count}")
 
 
+        # documents encoded by this run, those resumed from spilled runs are not part of its throughput
+        self.n_indexed = count - n_resumed
+        self.index_seconds = time.perf_counter() - start_time
+        print(f"Encoded {self.n_indexed} documents in {self.index_seconds:.1f}s "
+              f"({self.n_indexed / max(self.index_seconds, 1e-9):.1f} docs/sec)")
         if self.compute_stats:
-            stats = {key: value / len(collection_loader) for key, value in stats.items()}
+            # streaming loaders have no len(), stats are averaged over the batches actually seen
+            stats = {key: value / max(n_batches, 1) for key, value in stats.items()}
+            stats["docs_per_sec"] = self.n_indexed / max(self.index_seconds, 1e-9)
 
         if self.index_dir is not None:
-            self.sparse_index.save()
+            self.sparse_index.save(dim=self.dim_voc, n_docs=max(doc_ids) + 1 if doc_ids else 0)
             pickle.dump(doc_ids, open(os.path.join(self.index_dir, "doc_ids.pkl"), "wb"))
             print("Indexing complete.")
             print(f"Index contains {len(self.sparse_index)} posting lists")
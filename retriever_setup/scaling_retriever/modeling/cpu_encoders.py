@@ -0,0 +1,180 @@
+"""CPU inference backends of the sparse query encoder, picked with `load_cpu_encoder(model, backend)`:
+    torch   the float32 model as loaded
+    int8    torch dynamic int8 quantization of the decoder linear layers, lm_head stays float32
+    onnx    ONNX Runtime session on an export of the (merged LoRA) model
+Every backend exposes encode(**inputs) -> [bz, vocab_size] like DecoderOnlyBiSparse.
+The onnx export is an offline step, servers only load it:
+
+    python -m scaling_retriever.modeling.cpu_encoders --model_name_or_path /path/to/lora --onnx_dir /path/to/index/onnx_encoder
+"""
+import argparse
+import logging
+import os
+import shutil
+import time
+
+import numpy as np
+import torch
+
+logger = logging.getLogger()
+
+# int8 quantizes the model in place, so it comes last when several backends are built from one model
+CPU_ENCODER_BACKENDS = ["torch", "onnx", "int8"]
+ONNX_ENCODER_FILE = "sparse_encoder.onnx"
+
+# queries encoded by every backend at server start to check it against the float32 model
+PARITY_QUERIES = [
+    "who wrote the letter that the captain found in the lighthouse",
+    "why did the two brothers stop talking to each other",
+    "what happened to the village after the river flooded",
+    "where was the old map hidden",
+    "how did the girl convince the king to let her go",
+    "which character betrayed the travelling merchants",
+    "what does the fox want in exchange for the key",
+    "when did the narrator first see the ship",
+]
+
+
+def _onnxruntime():
+    try:
+        import onnxruntime
+    except ImportError:
+        raise ImportError("the onnx encoder backend needs the `onnxruntime` package: pip install onnxruntime")
+    return onnxruntime
+
+
+class _EncodeModule(torch.nn.Module):
+    """encode() as a forward pass, for tracing"""
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask):
+        return self.model.encode(input_ids=input_ids, attention_mask=attention_mask)
+
+
+def quantize_int8(model):
+    """replace the linear layers of the decoder with dynamically quantized int8 ones, in place.
+    The lm_head projection is left in float32: it is a small share of the compute for short queries
+    and the sparse weights are sensitive to its precision.
+    """
+    decoder = torch.ao.quantization.quantize_dynamic(model.base_model.get_decoder(), {torch.nn.Linear},
+                                                     dtype=torch.qint8, inplace=True)
+    model.base_model.set_decoder(decoder)
+    return model
+
+
+def export_onnx(model, onnx_dir, opset_version=17):
+    """export model.encode with dynamic batch and sequence axes to {onnx_dir}/sparse_encoder.onnx. The export
+    (and its external weight files) is written to a temporary directory renamed at the end, so an onnx_dir
+    always holds a complete export
+    """
+    tmp_dir = onnx_dir.rstrip("/") + ".tmp"
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+    input_ids = torch.ones((2, 8), dtype=torch.long)
+    attention_mask = torch.ones((2, 8), dtype=torch.long)
+    with torch.no_grad():
+        torch.onnx.export(_EncodeModule(model).eval(), (input_ids, attention_mask),
+                          os.path.join(tmp_dir, ONNX_ENCODER_FILE),
+                          input_names=["input_ids", "attention_mask"], output_names=["reps"],
+                          dynamic_axes={"input_ids": {0: "batch", 1: "seq_length"},
+                                        "attention_mask": {0: "batch", 1: "seq_length"},
+                                        "reps": {0: "batch"}},
+                          opset_version=opset_version, do_constant_folding=True)
+    if os.path.exists(onnx_dir):
+        shutil.rmtree(onnx_dir)
+    os.replace(tmp_dir, onnx_dir)
+    logger.info(f"Exported the sparse encoder to {onnx_dir}")
+
+
+class OnnxSparseEncoder:
+    def __init__(self, onnx_path, vocab_size, num_threads=None):
+        ort = _onnxruntime()
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        self.session = ort.InferenceSession(onnx_path, options, providers=["CPUExecutionProvider"])
+        self.vocab_size = vocab_size
+
+    def eval(self):
+        return self
+
+    def to(self, device):
+        assert str(device) == "cpu", device
+        return self
+
+    def encode(self, input_ids, attention_mask, **kwargs):
+        reps = self.session.run(None, {"input_ids": input_ids.cpu().numpy().astype(np.int64),
+                                       "attention_mask": attention_mask.cpu().numpy().astype(np.int64)})[0]
+        return torch.from_numpy(reps)
+
+
+def load_cpu_encoder(model, backend="torch", onnx_dir=None, num_threads=None):
+    """the query encoder for `backend`, the onnx backend loads the export of `export_onnx` from onnx_dir
+    """
+    assert backend in CPU_ENCODER_BACKENDS, backend
+    if backend == "int8":
+        return quantize_int8(model)
+    if backend == "onnx":
+        onnx_path = os.path.join(onnx_dir, ONNX_ENCODER_FILE)
+        if not os.path.exists(onnx_path):
+            raise FileNotFoundError(f"no onnx export at {onnx_path}, export it first with: python -m "
+                                    f"scaling_retriever.modeling.cpu_encoders --onnx_dir {onnx_dir}")
+        return OnnxSparseEncoder(onnx_path, model.vocab_size, num_threads=num_threads)
+    return model
+
+
+def encode_dense(model, collator, queries, batch_size=8):
+    """[n_queries, vocab_size] float32 reps of `queries`
+    """
+    reps = []
+    with torch.inference_mode():
+        for start in range(0, len(queries), batch_size):
+            batch = collator([(f"q{i}", query) for i, query in enumerate(queries[start:start + batch_size])])
+            inputs = {k: v for k, v in batch.items() if k not in {"ids"}}
+            reps.append(model.encode(**inputs).float().cpu())
+    return torch.cat(reps, dim=0)
+
+
+def query_parity(reference, candidate):
+    """agreement of two [n_queries, vocab_size] reps: mean cosine, max absolute weight difference and
+    mean jaccard of the non-zero terms
+    """
+    cosine = torch.nn.functional.cosine_similarity(reference, candidate, dim=-1)
+    ref_terms, cand_terms = reference > 0, candidate > 0
+    jaccard = (ref_terms & cand_terms).sum(dim=-1) / (ref_terms | cand_terms).sum(dim=-1).clamp(min=1)
+    return {"cosine": cosine.mean().item(),
+            "max_abs_diff": (reference - candidate).abs().max().item(),
+            "term_jaccard": jaccard.float().mean().item(),
+            "L0_reference": ref_terms.sum(dim=-1).float().mean().item(),
+            "L0_candidate": cand_terms.sum(dim=-1).float().mean().item()}
+
+
+def encode_latency(model, collator, queries, batch_size=1, warmup=2):
+    """mean encode wall time per query, in ms
+    """
+    encode_dense(model, collator, queries[:warmup * batch_size], batch_size=batch_size)
+    start = time.perf_counter()
+    encode_dense(model, collator, queries, batch_size=batch_size)
+    return 1000 * (time.perf_counter() - start) / len(queries)
+
+
+if __name__ == "__main__":
+    from scaling_retriever.modeling.llm_encoder import LlamaBiSparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_name_or_path", default="hzeng/Lion-SP-1B-llama3-marco-mntp", type=str)
+    parser.add_argument("--onnx_dir", type=str, required=True)
+    # the traced graph max-pools the logits over vocabulary chunks like the server model, 0 to disable
+    parser.add_argument("--vocab_chunk_size", default=16384, type=int)
+    parser.add_argument("--opset_version", default=17, type=int)
+    args = parser.parse_args()
+
+    model = LlamaBiSparse.load_from_lora(args.model_name_or_path)
+    model.vocab_chunk_size = args.vocab_chunk_size
+    model.eval()
+    export_onnx(model, args.onnx_dir, opset_version=args.opset_version)
@@ -170,9 +170,12 @@ class T5Sparse(LLM2Retriever):
 
 
 class DecoderOnlyBiSparse(LLM2Retriever):
-    def __init__(self, base_model):
+    def __init__(self, base_model, vocab_chunk_size=None):
         super().__init__(base_model)
         self.vocab_size = self.base_model.config.vocab_size
+        # when set, encode() projects onto the vocabulary vocab_chunk_size rows of lm_head at a time,
+        # so the [bz, seq_length, vocab_size] logits are never materialized
+        self.vocab_chunk_size = vocab_chunk_size
         
     def rerank_forward(self, **inputs):
         query_reps = self.encode(**inputs["tokenized_queries"])
@@ -181,6 +184,9 @@ class DecoderOnlyBiSparse(LLM2Retriever):
         return logits
     
     def encode(self, **inputs):
+        if self.vocab_chunk_size:
+            return self.chunked_encode(**inputs)
+        
         seq_reps = self.base_model(**inputs, return_dict=True).logits #[bz, seq_length, dim]
         seq_reps *= self.base_model.config.hidden_size**-0.25
         
@@ -192,6 +198,24 @@ class DecoderOnlyBiSparse(LLM2Retriever):
         
         return reps
     
+    def chunked_encode(self, **inputs):
+        # same reps as encode(), but the lm_head projection and the masked max-pooling are done
+        # per vocabulary chunk, peak memory is [bz, seq_length, vocab_chunk_size] instead of [bz, seq_length, vocab_size]
+        hidden_states = self.base_model.get_decoder()(**inputs, return_dict=True).last_hidden_state #[bz, seq_length, hdim]
+        lm_head = self.base_model.get_output_embeddings()
+        mask = (1 - inputs["attention_mask"].unsqueeze(-1)) * -1e6 #[bz, seq_length, 1]
+        scale = self.base_model.config.hidden_size**-0.25
+        
+        reps = []
+        for start in range(0, self.vocab_size, self.vocab_chunk_size):
+            end = min(start + self.vocab_chunk_size, self.vocab_size)
+            bias = lm_head.bias[start:end] if lm_head.bias is not None else None
+            chunk_reps = torch.nn.functional.linear(hidden_states, lm_head.weight[start:end], bias).float() #[bz, seq_length, chunk]
+            chunk_reps *= scale
+            reps.append(torch.log(torch.relu(torch.max(chunk_reps + mask, dim=1)[0]) + 1))
+        
+        return torch.cat(reps, dim=-1) #[bz, vocab_size]
+    
 
 class LlamaBiSparse(DecoderOnlyBiSparse):
     TRANSFORMER_CLS = LlamaBiForMNTP
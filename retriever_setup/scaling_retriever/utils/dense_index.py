@@ -0,0 +1,359 @@
+"""IVF (inverted file) index over the dense doc embeddings written by `indexer.store_embs`.
+
+    python -m scaling_retriever.utils.dense_index --embs_dir /path/to/embs --n_lists 1024
+
+The embeddings are clustered with spherical k-means on a sample, then stored grouped by cluster:
+the vectors of list l are vectors[list_offsets[l]:list_offsets[l + 1]] and `ids` holds their doc ids.
+A query scores the centroids and scans the `nprobe` lists whose centroids score highest.
+Everything is memory-mapped, so loading is near-instant and the page cache is shared between processes.
+
+    python -m scaling_retriever.utils.dense_index --quantize /path/to/embs --codes sq8   (or --codes pq --pq_m 64)
+
+adds compressed codes of the vectors (same order): int8 scalar quantization (1 byte per dimension) or
+product quantization (1 byte per sub-vector). Search then scans the codes with asymmetric distance
+computation (float query against the codes) and re-scores only the best candidates with the float vectors,
+so the float file is read for a handful of rows per query instead of being held in RAM.
+"""
+import argparse
+import json
+import os
+
+import numba
+import numpy as np
+from tqdm.auto import tqdm
+
+from scaling_retriever.utils.utils import obtain_doc_vec_dir_files
+
+DENSE_META_FILE = "dense_meta.json"
+DENSE_CENTROIDS_FILE = "dense_centroids.npy"
+DENSE_LIST_OFFSETS_FILE = "dense_list_offsets.npy"
+DENSE_VECTORS_FILE = "dense_vectors.npy"
+DENSE_IDS_FILE = "dense_ids.npy"
+# sq8: codes [n, dim] uint8, params [2, dim] (min, scale), a vector is min + code * scale
+# pq{m}: codes [n, m] uint8, codebooks [m, 256, dim // m], sub-vector j is codebooks[j, code[j]]
+DENSE_CODES_FILE = "dense_codes_{}.npy"
+DENSE_CODEBOOKS_FILE = "dense_codebooks_{}.npy"
+
+
+def dense_index_exists(index_dir):
+    return all(os.path.exists(os.path.join(index_dir, name))
+               for name in [DENSE_META_FILE, DENSE_CENTROIDS_FILE, DENSE_LIST_OFFSETS_FILE,
+                            DENSE_VECTORS_FILE, DENSE_IDS_FILE])
+
+
+def load_embs_chunks(embs_dir):
+    """memory-mapped (embs [n, dim], ids [n]) of every chunk listed in the plan.json of store_embs
+    """
+    vec_files, id_files = obtain_doc_vec_dir_files(embs_dir)
+    return [(np.load(vec_file, mmap_mode="r"), np.load(id_file, allow_pickle=True))
+            for vec_file, id_file in zip(vec_files, id_files)]
+
+
+def _gather_rows(chunks, chunk_starts, rows):
+    """rows (global row numbers over the concatenated chunks) as a float32 [len(rows), dim] array
+    """
+    out = np.empty((len(rows), chunks[0][0].shape[1]), dtype=np.float32)
+    chunk_of_row = np.searchsorted(chunk_starts, rows, side="right") - 1
+    for c in np.unique(chunk_of_row):
+        mask = chunk_of_row == c
+        out[mask] = chunks[c][0][rows[mask] - chunk_starts[c]]
+    return out
+
+
+def _normalize(x):
+    return x / np.maximum(np.linalg.norm(x, axis=1, keepdims=True), 1e-12)
+
+
+def train_kmeans(sample, n_lists, n_iter=20, seed=1234):
+    """spherical k-means: points go to the centroid of highest inner product, centroids are unit norm
+    """
+    rng = np.random.default_rng(seed)
+    centroids = _normalize(sample[rng.choice(len(sample), n_lists, replace=False)].copy())
+    for _ in tqdm(range(n_iter), desc="training ivf centroids"):
+        assign = np.argmax(sample @ centroids.T, axis=1)
+        counts = np.bincount(assign, minlength=n_lists)
+        order = np.argsort(assign, kind="stable")
+        non_empty = counts > 0
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])[non_empty]
+        centroids[non_empty] = _normalize(np.add.reduceat(sample[order], starts, axis=0))
+        # empty lists restart from random points
+        n_empty = int((~non_empty).sum())
+        if n_empty:
+            centroids[~non_empty] = _normalize(sample[rng.choice(len(sample), n_empty, replace=False)])
+    return centroids.astype(np.float32)
+
+
+def build_ivf(embs_dir, index_dir=None, n_lists=1024, n_iter=20, sample_size=None, chunk_rows=65536, seed=1234):
+    """cluster the store_embs chunks of `embs_dir` and write the IVF layout to `index_dir` (default embs_dir)
+    """
+    index_dir = index_dir if index_dir is not None else embs_dir
+    os.makedirs(index_dir, exist_ok=True)
+    chunks = load_embs_chunks(embs_dir)
+    sizes = np.array([len(embs) for embs, _ in chunks], dtype=np.int64)
+    chunk_starts = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+    n, dim = int(sizes.sum()), chunks[0][0].shape[1]
+    n_lists = min(n_lists, n)
+
+    rng = np.random.default_rng(seed)
+    sample_size = min(n, sample_size or max(64 * n_lists, 10000))
+    sample = _gather_rows(chunks, chunk_starts, np.sort(rng.choice(n, sample_size, replace=False)))
+    centroids = train_kmeans(sample, n_lists, n_iter=n_iter, seed=seed)
+    del sample
+
+    assign = np.empty(n, dtype=np.int32)
+    for start in tqdm(range(0, n, chunk_rows), desc="assigning vectors to lists"):
+        rows = np.arange(start, min(start + chunk_rows, n))
+        assign[rows] = np.argmax(_gather_rows(chunks, chunk_starts, rows) @ centroids.T, axis=1)
+    order = np.argsort(assign, kind="stable")
+    list_offsets = np.zeros(n_lists + 1, dtype=np.int64)
+    list_offsets[1:] = np.cumsum(np.bincount(assign, minlength=n_lists))
+
+    vectors = np.lib.format.open_memmap(os.path.join(index_dir, DENSE_VECTORS_FILE), mode="w+",
+                                        dtype=np.float32, shape=(n, dim))
+    for start in tqdm(range(0, n, chunk_rows), desc="writing ivf lists"):
+        vectors[start:start + chunk_rows] = _gather_rows(chunks, chunk_starts, order[start:start + chunk_rows])
+    vectors.flush()
+    del vectors
+
+    ids = np.concatenate([np.asarray(chunk_ids) for _, chunk_ids in chunks])[order]
+    np.save(os.path.join(index_dir, DENSE_IDS_FILE), ids)
+    np.save(os.path.join(index_dir, DENSE_CENTROIDS_FILE), centroids)
+    np.save(os.path.join(index_dir, DENSE_LIST_OFFSETS_FILE), list_offsets)
+    with open(os.path.join(index_dir, DENSE_META_FILE), "w") as f:
+        json.dump({"n_docs": n, "dim": dim, "n_lists": n_lists}, f)
+    print("done building ivf index with {} lists over {} vectors...".format(n_lists, n))
+
+
+def _read_vectors(index_dir, chunk_rows):
+    vectors = np.load(os.path.join(index_dir, DENSE_VECTORS_FILE), mmap_mode="r")
+    for start in range(0, len(vectors), chunk_rows):
+        yield start, np.asarray(vectors[start:start + chunk_rows], dtype=np.float32)
+
+
+def _sample_vectors(index_dir, sample_size, seed=1234):
+    vectors = np.load(os.path.join(index_dir, DENSE_VECTORS_FILE), mmap_mode="r")
+    rows = np.sort(np.random.default_rng(seed).choice(len(vectors), min(sample_size, len(vectors)), replace=False))
+    return np.asarray(vectors[rows], dtype=np.float32)
+
+
+def train_sq8(index_dir, chunk_rows=65536):
+    """per-dimension min and scale mapping the vectors onto [0, 255]
+    """
+    lo, hi = None, None
+    for _, chunk in tqdm(_read_vectors(index_dir, chunk_rows), desc="sq8 ranges"):
+        lo = chunk.min(axis=0) if lo is None else np.minimum(lo, chunk.min(axis=0))
+        hi = chunk.max(axis=0) if hi is None else np.maximum(hi, chunk.max(axis=0))
+    scale = np.where(hi > lo, (hi - lo) / 255., 1.)
+    return np.stack([lo, scale]).astype(np.float32)
+
+
+def train_pq(sample, pq_m, n_iter=20, seed=1234):
+    """[pq_m, 256, dim // pq_m] codebooks, one L2 k-means per sub-space
+    """
+    n, dim = sample.shape
+    assert dim % pq_m == 0, (dim, pq_m)
+    sub_dim = dim // pq_m
+    n_codes = min(256, n)
+    rng = np.random.default_rng(seed)
+    codebooks = np.zeros((pq_m, 256, sub_dim), dtype=np.float32)
+    for j in tqdm(range(pq_m), desc="training pq codebooks"):
+        sub = sample[:, j * sub_dim:(j + 1) * sub_dim]
+        centroids = sub[rng.choice(n, n_codes, replace=False)].copy()
+        for _ in range(n_iter):
+            assign = _nearest(sub, centroids)
+            counts = np.bincount(assign, minlength=n_codes)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assign, sub)
+            non_empty = counts > 0
+            centroids[non_empty] = sums[non_empty] / counts[non_empty, None]
+        codebooks[j, :n_codes] = centroids
+        # tiny samples fill the unused codes with a duplicate, never nearer than the original
+        codebooks[j, n_codes:] = centroids[0]
+    return codebooks
+
+
+def _nearest(x, centroids):
+    """index of the L2-nearest centroid of every row of x
+    """
+    return np.argmin((centroids ** 2).sum(axis=1)[None, :] - 2 * x @ centroids.T, axis=1)
+
+
+def quantize_dense(index_dir, codes="sq8", pq_m=64, sample_size=65536, chunk_rows=65536):
+    """write the `codes` ("sq8" or "pq") of the ivf vectors of index_dir. The codebooks are saved first and
+    the codes are written to a temporary file renamed at the end, so an existing codes file is always complete
+    """
+    assert codes in ["sq8", "pq"], codes
+    vectors = np.load(os.path.join(index_dir, DENSE_VECTORS_FILE), mmap_mode="r")
+    n, dim = vectors.shape
+    name = "sq8" if codes == "sq8" else "pq{}".format(pq_m)
+    if codes == "sq8":
+        codebooks = train_sq8(index_dir, chunk_rows=chunk_rows)
+    else:
+        codebooks = train_pq(_sample_vectors(index_dir, sample_size), pq_m)
+    np.save(os.path.join(index_dir, DENSE_CODEBOOKS_FILE.format(name)), codebooks)
+
+    codes_path = os.path.join(index_dir, DENSE_CODES_FILE.format(name))
+    tmp_path = codes_path + ".tmp"
+    out = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.uint8, shape=(n, dim if codes == "sq8" else pq_m))
+    if codes == "sq8":
+        for start, chunk in tqdm(_read_vectors(index_dir, chunk_rows), desc="encoding sq8"):
+            out[start:start + len(chunk)] = np.clip(np.rint((chunk - codebooks[0]) / codebooks[1]), 0, 255)
+    else:
+        sub_dim = dim // pq_m
+        for start, chunk in tqdm(_read_vectors(index_dir, chunk_rows), desc="encoding pq"):
+            for j in range(pq_m):
+                out[start:start + len(chunk), j] = _nearest(chunk[:, j * sub_dim:(j + 1) * sub_dim], codebooks[j])
+    out.flush()
+    del out
+    os.replace(tmp_path, codes_path)
+    print("done writing {} codes: {} bytes per vector instead of {}...".format(name, dim if codes == "sq8" else pq_m,
+                                                                              4 * dim))
+    return name
+
+
+@numba.njit(nogil=True, cache=True)
+def numba_pq_adc(codes, lut):
+    """asymmetric distance computation: score of every pq code row as the sum of its lookup table entries,
+    lut[j, c] is the inner product of sub-query j with centroid c of sub-space j
+    """
+    n, m = codes.shape
+    scores = np.zeros(n, dtype=np.float32)
+    for i in range(n):
+        acc = 0.
+        for j in range(m):
+            acc += lut[j, codes[i, j]]
+        scores[i] = acc
+    return scores
+
+
+class DenseCodes:
+    """compressed vectors of a DenseIVFIndex, `prepare(query)` once per query then `scores(start, end, prepared)`
+    approximates the inner products of the query with vectors[start:end]
+    """
+    def __init__(self, name, codes, codebooks):
+        self.name = name
+        self.codes = codes
+        self.codebooks = codebooks
+
+    @classmethod
+    def load(cls, index_dir, name):
+        return cls(name, np.load(os.path.join(index_dir, DENSE_CODES_FILE.format(name)), mmap_mode="r"),
+                   np.load(os.path.join(index_dir, DENSE_CODEBOOKS_FILE.format(name))))
+
+    def prepare(self, query):
+        if self.name == "sq8":
+            return query * self.codebooks[1], float(query @ self.codebooks[0])
+        m, _, sub_dim = self.codebooks.shape
+        return np.einsum("mcd,md->mc", self.codebooks, query.reshape(m, sub_dim)).astype(np.float32)
+
+    def scores(self, start, end, prepared):
+        if self.name == "sq8":
+            scaled_query, offset = prepared
+            return self.codes[start:end].astype(np.float32) @ scaled_query + offset
+        return numba_pq_adc(np.ascontiguousarray(self.codes[start:end]), prepared)
+
+
+def _topk(positions, scores, k, threshold):
+    """the k best (positions, scores) with score > threshold, sorted by decreasing score
+    """
+    keep = scores > threshold
+    positions, scores = positions[keep], scores[keep]
+    if len(scores) > k:
+        best = np.argpartition(-scores, k - 1)[:k]
+        positions, scores = positions[best], scores[best]
+    order = np.argsort(-scores, kind="stable")
+    return positions[order], scores[order]
+
+
+class DenseIVFIndex:
+    """read-only IVF index memory-mapped from `build_ivf` output. Search results are positions in
+    `vectors`, `ids[position]` is the doc id.
+    With `codes`, lists are scanned on the compressed codes and the best `rerank_factor * topk`
+    candidates are re-scored exactly with the float vectors.
+    """
+    def __init__(self, centroids, list_offsets, vectors, ids, codes=None, rerank_factor=4):
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+        self.vectors = vectors
+        self.ids = ids
+        self.n_lists = len(centroids)
+        self.codes = codes
+        self.rerank_factor = rerank_factor
+
+    @classmethod
+    def load(cls, index_dir, mmap_mode="r", codes=None, rerank_factor=4):
+        """`codes` is the name of codes written by quantize_dense ("sq8", "pq64", ...), None to scan float vectors
+        """
+        return cls(np.load(os.path.join(index_dir, DENSE_CENTROIDS_FILE)),
+                   np.load(os.path.join(index_dir, DENSE_LIST_OFFSETS_FILE)),
+                   np.load(os.path.join(index_dir, DENSE_VECTORS_FILE), mmap_mode=mmap_mode),
+                   np.load(os.path.join(index_dir, DENSE_IDS_FILE), allow_pickle=True),
+                   codes=DenseCodes.load(index_dir, codes) if codes else None,
+                   rerank_factor=rerank_factor)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def search(self, queries, topk=5, nprobe=16, threshold=0.):
+        """(positions, scores) of the approximate top-k of every query [n_queries, dim]
+        """
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        nprobe = min(nprobe, self.n_lists)
+        centroid_scores = queries @ self.centroids.T
+        probes = np.argpartition(-centroid_scores, nprobe - 1, axis=1)[:, :nprobe]
+        results = []
+        for query, lists in zip(queries, probes):
+            prepared = self.codes.prepare(query) if self.codes is not None else None
+            positions, scores = [], []
+            for list_id in lists:
+                start, end = self.list_offsets[list_id], self.list_offsets[list_id + 1]
+                if start == end:
+                    continue
+                positions.append(np.arange(start, end))
+                if prepared is None:
+                    scores.append(self.vectors[start:end] @ query)
+                else:
+                    scores.append(self.codes.scores(start, end, prepared))
+            if not positions:
+                results.append((np.array([], dtype=np.int64), np.array([], dtype=np.float32)))
+                continue
+            positions, scores = np.concatenate(positions), np.concatenate(scores)
+            if prepared is not None:
+                # approximate scores only pick the candidates, the threshold applies to the exact ones
+                candidates, _ = _topk(positions, scores, self.rerank_factor * topk, -np.inf)
+                candidates = np.sort(candidates)
+                positions, scores = candidates, np.asarray(self.vectors[candidates], dtype=np.float32) @ query
+            results.append(_topk(positions, scores, topk, threshold))
+        return results
+
+    def exact_search(self, queries, topk=5, threshold=0., chunk_rows=65536):
+        """(positions, scores) of the exact top-k of every query, one pass over the vectors for all queries
+        """
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        best = [(np.array([], dtype=np.int64), np.array([], dtype=np.float32)) for _ in range(len(queries))]
+        for start in range(0, len(self), chunk_rows):
+            chunk_scores = self.vectors[start:start + chunk_rows] @ queries.T  # [rows, n_queries]
+            positions = np.arange(start, start + len(chunk_scores))
+            for q in range(len(queries)):
+                best[q] = _topk(np.concatenate([best[q][0], positions]),
+                                np.concatenate([best[q][1], chunk_scores[:, q]]), topk, threshold)
+        return best
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--embs_dir", type=str, default=None, help="output directory of store_embs")
+    parser.add_argument("--quantize", type=str, default=None, help="ivf index directory whose vectors get --codes")
+    parser.add_argument("--codes", default="sq8", choices=["sq8", "pq"])
+    parser.add_argument("--pq_m", default=64, type=int, help="number of pq sub-vectors (bytes per vector)")
+    parser.add_argument("--index_dir", type=str, default=None, help="defaults to --embs_dir")
+    parser.add_argument("--n_lists", default=1024, type=int)
+    parser.add_argument("--n_iter", default=20, type=int)
+    parser.add_argument("--sample_size", default=None, type=int)
+    args = parser.parse_args()
+    if args.quantize is not None:
+        quantize_dense(args.quantize, codes=args.codes, pq_m=args.pq_m)
+    else:
+        assert args.embs_dir is not None, "--embs_dir is required to build an ivf index"
+        build_ivf(args.embs_dir, index_dir=args.index_dir, n_lists=args.n_lists, n_iter=args.n_iter,
+                  sample_size=args.sample_size)
@@ -0,0 +1,154 @@
+import argparse
+import array
+import json
+import os
+import shutil
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from tqdm.auto import tqdm
+
+# text of row i is blob[offsets[i]:offsets[i + 1]] (in the uncompressed byte stream),
+# with compression rows are zstd-compressed together in blocks of `block_size` rows
+DOC_STORE_META_FILE = "doc_store_meta.json"
+DOC_STORE_BLOB_FILE = "doc_store_texts.bin"
+DOC_STORE_OFFSETS_FILE = "doc_store_offsets.npy"
+DOC_STORE_BLOCK_OFFSETS_FILE = "doc_store_block_offsets.npy"
+DOC_STORE_IDS_FILE = "doc_store_ids.json"
+
+
+def _zstd():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError("zstd compressed doc stores need the `zstandard` package: pip install zstandard")
+    return zstandard
+
+
+def doc_store_exists(store_dir):
+    return os.path.exists(os.path.join(store_dir, DOC_STORE_META_FILE))
+
+
+def build_doc_store(corpus_path, store_dir, compression=None, block_size=64):
+    """stream a chunked jsonl corpus ({"chunk_id", "contents"} per line) into a doc store. Written to a
+    temporary directory and renamed at the end, so a store is never read half-written
+    """
+    assert compression in [None, "zstd"], compression
+    final_dir = store_dir
+    store_dir = final_dir.rstrip("/") + ".tmp"
+    if os.path.exists(store_dir):
+        shutil.rmtree(store_dir)
+    os.makedirs(store_dir)
+    offsets = array.array("q", [0])
+    block_offsets = array.array("q", [0])
+    chunk_ids = []
+    compressor = _zstd().ZstdCompressor(level=3) if compression == "zstd" else None
+    pending = []
+
+    def flush(blob):
+        data = b"".join(pending)
+        if compressor is not None:
+            data = compressor.compress(data)
+        blob.write(data)
+        block_offsets.append(block_offsets[-1] + len(data))
+        pending.clear()
+
+    with open(corpus_path, "r") as f, open(os.path.join(store_dir, DOC_STORE_BLOB_FILE), "wb") as blob:
+        for line in tqdm(f, desc="building doc store"):
+            chunk = json.loads(line)
+            text = chunk["contents"].encode("utf-8")
+            chunk_ids.append(chunk["chunk_id"])
+            offsets.append(offsets[-1] + len(text))
+            pending.append(text)
+            if len(pending) == block_size:
+                flush(blob)
+        if pending:
+            flush(blob)
+
+    np.save(os.path.join(store_dir, DOC_STORE_OFFSETS_FILE), np.frombuffer(offsets, dtype=np.int64))
+    np.save(os.path.join(store_dir, DOC_STORE_BLOCK_OFFSETS_FILE), np.frombuffer(block_offsets, dtype=np.int64))
+    with open(os.path.join(store_dir, DOC_STORE_IDS_FILE), "w") as f:
+        json.dump(chunk_ids, f)
+    with open(os.path.join(store_dir, DOC_STORE_META_FILE), "w") as f:
+        json.dump({"n_docs": len(chunk_ids), "compression": compression, "block_size": block_size}, f)
+    if os.path.exists(final_dir):
+        shutil.rmtree(final_dir)
+    os.replace(store_dir, final_dir)
+    print(f"doc store with {len(chunk_ids)} chunks written to {final_dir}")
+
+
+class DocStore:
+    """memory-mapped, offset-indexed document texts. Nothing but the chunk_id -> row map is
+    loaded in memory, texts are decoded lazily when `get` is called for the final results.
+    Exposes the `get(chunk_id, default)` interface of the former chunk_id -> text dict.
+    """
+    def __init__(self, store_dir, block_cache_size=256):
+        with open(os.path.join(store_dir, DOC_STORE_META_FILE), "r") as f:
+            meta = json.load(f)
+        self.compression = meta["compression"]
+        self.block_size = meta["block_size"]
+        self.offsets = np.load(os.path.join(store_dir, DOC_STORE_OFFSETS_FILE), mmap_mode="r")
+        self.block_offsets = np.load(os.path.join(store_dir, DOC_STORE_BLOCK_OFFSETS_FILE), mmap_mode="r")
+        blob_path = os.path.join(store_dir, DOC_STORE_BLOB_FILE)
+        if os.path.getsize(blob_path) > 0:
+            self.blob = np.memmap(blob_path, dtype=np.uint8, mode="r")
+        else:
+            self.blob = np.zeros(0, dtype=np.uint8)
+        with open(os.path.join(store_dir, DOC_STORE_IDS_FILE), "r") as f:
+            self.row_of = {chunk_id: row for row, chunk_id in enumerate(json.load(f))}
+
+        if self.compression == "zstd":
+            # zstandard decompressors are not thread-safe, each request thread gets its own
+            self.local = threading.local()
+            self.block_cache = OrderedDict()
+            self.block_cache_size = block_cache_size
+            self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.row_of)
+
+    def __contains__(self, chunk_id):
+        return chunk_id in self.row_of
+
+    def _block(self, block):
+        with self.lock:
+            data = self.block_cache.get(block)
+            if data is not None:
+                self.block_cache.move_to_end(block)
+                return data
+        start, end = self.block_offsets[block], self.block_offsets[block + 1]
+        decompressor = getattr(self.local, "decompressor", None)
+        if decompressor is None:
+            decompressor = self.local.decompressor = _zstd().ZstdDecompressor()
+        data = decompressor.decompress(self.blob[start:end].tobytes())
+        with self.lock:
+            self.block_cache[block] = data
+            while len(self.block_cache) > self.block_cache_size:
+                self.block_cache.popitem(last=False)
+        return data
+
+    def get_row(self, row):
+        start, end = self.offsets[row], self.offsets[row + 1]
+        if self.compression is None:
+            return self.blob[start:end].tobytes().decode("utf-8")
+        block = row // self.block_size
+        block_start = self.offsets[block * self.block_size]
+        return self._block(block)[start - block_start:end - block_start].decode("utf-8")
+
+    def get(self, chunk_id, default=None):
+        row = self.row_of.get(chunk_id)
+        if row is None:
+            return default
+        return self.get_row(row)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--corpus_path", type=str, required=True)
+    parser.add_argument("--store_dir", type=str, required=True)
+    parser.add_argument("--compression", default=None, choices=["zstd"])
+    parser.add_argument("--block_size", default=64, type=int)
+    args = parser.parse_args()
+
+    build_doc_store(args.corpus_path, args.store_dir, compression=args.compression, block_size=args.block_size)
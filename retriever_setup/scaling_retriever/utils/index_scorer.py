@@ -0,0 +1,170 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numba
+import numpy as np
+import requests
+
+from scaling_retriever.utils.sparse_scoring import (numba_score_topk_csr, numba_maxscore_topk,
+                                                   numba_score_batch_topk_csr, numba_score_topk_packed)
+
+
+class IndexScorer:
+    """top-k scoring of sparse query vectors against one IndexCSRArray, picking the kernel that fits the
+    index layout and the retrieval mode. Returned doc ids are global: the index doc ids plus `doc_id_start`
+    (non-zero for a shard of a larger collection).
+    """
+    numba_score_topk_csr = staticmethod(numba_score_topk_csr)
+    numba_maxscore_topk = staticmethod(numba_maxscore_topk)
+    numba_score_batch_topk_csr = staticmethod(numba_score_batch_topk_csr)
+    numba_score_topk_packed = staticmethod(numba_score_topk_packed)
+
+    def __init__(self, sparse_index, batch_tile_budget=1 << 18):
+        self.sparse_index = sparse_index
+        self.doc_id_start = sparse_index.doc_id_start
+        self.batch_tile_budget = batch_tile_budget
+        # packed doc ids have no random access, the batched kernel and maxscore need it
+        self.supports_batch = sparse_index.packed is None
+        self._scratch = threading.local()
+
+    def n_postings(self, col):
+        """number of postings a query with terms `col` walks through in exhaustive scoring
+        """
+        col = col[col < len(self.sparse_index)]
+        return int(np.sum(self.sparse_index.offsets[col + 1] - self.sparse_index.offsets[col]))
+
+    def _get_scratch(self):
+        """per-thread (scores, touched) buffers for numba_score_topk_csr, allocated once per thread
+        """
+        if not hasattr(self._scratch, "scores"):
+            self._scratch.scores = np.zeros(self.sparse_index.nb_docs(), dtype=np.float32)
+            self._scratch.touched = np.empty(self.sparse_index.nb_docs(), dtype=np.int32)
+        return self._scratch.scores, self._scratch.touched
+
+    def score(self, col, values, threshold=0., topk=5, mode="exhaustive"):
+        """top-k doc ids and scores of one sparse query, sorted by decreasing score
+        """
+        values = self.sparse_index.scale_query(col, values)
+        scores_buffer, touched_buffer = self._get_scratch()
+        if self.sparse_index.packed is not None:
+            ids, scores = self.numba_score_topk_packed(
+                self.sparse_index.offsets,
+                *self.sparse_index.packed,
+                self.sparse_index.packed_block_size,
+                self.sparse_index.doc_values,
+                col,
+                values,
+                threshold=threshold,
+                k=topk,
+                scores=scores_buffer,
+                touched=touched_buffer,
+            )
+        elif mode == "maxscore":
+            ids, scores = self.numba_maxscore_topk(
+                self.sparse_index.offsets,
+                self.sparse_index.doc_ids,
+                self.sparse_index.doc_values,
+                self.sparse_index.term_max,
+                self.sparse_index.block_offsets,
+                self.sparse_index.block_max,
+                self.sparse_index.block_last_doc,
+                self.sparse_index.block_size,
+                col,
+                values,
+                threshold=threshold,
+                k=topk,
+            )
+        else:
+            ids, scores = self.numba_score_topk_csr(
+                self.sparse_index.offsets,
+                self.sparse_index.doc_ids,
+                self.sparse_index.doc_values,
+                col,
+                values,
+                threshold=threshold,
+                k=topk,
+                scores=scores_buffer,
+                touched=touched_buffer,
+            )
+        return ids + self.doc_id_start, scores
+
+    def score_batch(self, sparse_query_vecs, threshold=0., topk=5):
+        """exhaustive top-k of several queries in one pass over the posting lists, one (ids, scores) per query
+        """
+        batch_offsets = np.zeros(len(sparse_query_vecs) + 1, dtype=np.int64)
+        batch_offsets[1:] = np.cumsum([len(col) for col, _ in sparse_query_vecs])
+        batch_terms = np.concatenate([col for col, _ in sparse_query_vecs])
+        batch_values = np.concatenate([self.sparse_index.scale_query(col, values) for col, values in sparse_query_vecs])
+        # [tile_size x n_queries] accumulator block sized to stay cache resident
+        tile_size = max(4096, self.batch_tile_budget // len(sparse_query_vecs))
+
+        top_ids, top_scores, n_hits = self.numba_score_batch_topk_csr(
+            self.sparse_index.offsets,
+            self.sparse_index.doc_ids,
+            self.sparse_index.doc_values,
+            batch_offsets,
+            batch_terms,
+            batch_values,
+            threshold=threshold,
+            k=topk,
+            size_collection=self.sparse_index.nb_docs(),
+            tile_size=tile_size,
+            n_chunks=numba.get_num_threads(),
+        )
+        return [(top_ids[q, :n_hits[q]] + self.doc_id_start, top_scores[q, :n_hits[q]])
+                for q in range(len(sparse_query_vecs))]
+
+
+def merge_topk(results, k):
+    """merge (ids, scores) top-k lists of disjoint doc sets into one top-k sorted by decreasing score
+    """
+    ids = np.concatenate([ids for ids, _ in results]) if results else np.array([], dtype=np.int64)
+    scores = np.concatenate([scores for _, scores in results]) if results else np.array([], dtype=np.float32)
+    order = np.argsort(-scores, kind="stable")[:k]
+    return ids[order], scores[order]
+
+
+class ShardedScorer:
+    """scatter-gather scoring over shard workers (sparse_shard_worker.py), each serving one doc-id range of
+    the collection. The sparse query vectors are sent to every shard and the per-shard top-k are merged,
+    which gives the same top-k as scoring the whole index since every shard returns its own top-k.
+    """
+    def __init__(self, shard_urls, timeout=30.0):
+        self.shard_urls = [url.rstrip("/") for url in shard_urls]
+        self.timeout = timeout
+        self.supports_batch = True
+        self.executor = ThreadPoolExecutor(max_workers=4 * len(self.shard_urls))
+        self._sessions = threading.local()
+
+    def n_postings(self, col):
+        # posting list sizes are only known to the shard workers
+        return None
+
+    def _session(self):
+        if not hasattr(self._sessions, "session"):
+            self._sessions.session = requests.Session()
+        return self._sessions.session
+
+    def _post(self, url, payload):
+        response = self._session().post(f"{url}/score", json=payload, timeout=self.timeout)
+        response.raise_for_status()
+        result = response.json()
+        return [(np.asarray(ids, dtype=np.int64), np.asarray(scores, dtype=np.float32))
+                for ids, scores in zip(result["ids"], result["scores"])]
+
+    def _scatter(self, sparse_query_vecs, threshold, topk, mode):
+        payload = {
+            "queries": [{"terms": col.tolist(), "values": values.tolist()} for col, values in sparse_query_vecs],
+            "top_k": topk,
+            "threshold": threshold,
+            "mode": mode,
+        }
+        futures = [self.executor.submit(self._post, url, payload) for url in self.shard_urls]
+        per_shard = [future.result() for future in futures]
+        return [merge_topk([shard[q] for shard in per_shard], topk) for q in range(len(sparse_query_vecs))]
+
+    def score(self, col, values, threshold=0., topk=5, mode="exhaustive"):
+        return self._scatter([(col, values)], threshold, topk, mode)[0]
+
+    def score_batch(self, sparse_query_vecs, threshold=0., topk=5):
+        return self._scatter(sparse_query_vecs, threshold, topk, "exhaustive")
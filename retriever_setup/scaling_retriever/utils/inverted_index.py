@@ -11,6 +11,353 @@ import numpy as np
 from tqdm.auto import tqdm
 import ujson
 
+from scaling_retriever.utils.posting_codec import (pack_doc_ids, posting_block_offsets, unpack_posting,
+                                                   CSR_PACKED_FILE, CSR_PACKED_BLOCK_WORDS_FILE,
+                                                   CSR_PACKED_BLOCK_BITS_FILE, CSR_PACKED_BLOCK_BASE_FILE)
+
+# memory-mapped CSR layout: posting list of term t lives in
+# doc_ids[offsets[t]:offsets[t + 1]] / doc_values[offsets[t]:offsets[t + 1]]
+CSR_META_FILE = "csr_meta.json"
+CSR_OFFSETS_FILE = "csr_offsets.npy"
+CSR_DOC_IDS_FILE = "csr_doc_ids.npy"
+CSR_DOC_VALUES_FILE = "csr_doc_values.npy"
+# dynamic pruning metadata: posting list of term t is cut into blocks of BLOCK_SIZE postings,
+# blocks of t are block_offsets[t]:block_offsets[t + 1] in block_max / block_last_doc
+CSR_TERM_MAX_FILE = "csr_term_max.npy"
+CSR_BLOCK_OFFSETS_FILE = "csr_block_offsets.npy"
+CSR_BLOCK_MAX_FILE = "csr_block_max.npy"
+CSR_BLOCK_LAST_DOC_FILE = "csr_block_last_doc.npy"
+BLOCK_SIZE = 128
+# quantized impacts: csr_doc_values_{dtype}.npy next to the float32 values, the impact of a posting
+# of term t is value * term_scale[t]. The scale is folded into the query weights before scoring.
+CSR_TERM_SCALE_FILE = "csr_term_scale_{}.npy"
+CSR_QUANTIZED_VALUES_FILE = "csr_doc_values_{}.npy"
+QUANTIZED_DTYPES = {"uint8": np.uint8, "uint16": np.uint16}
+# sorted posting runs spilled by IndexCSRBuilder while indexing, each run is a small csr index
+# over the docs it buffered, removed once merged into the final csr index
+CSR_RUN_DIR = "runs"
+CSR_RUN_FILE = "run_{}_{}.npy"
+# [[doc row, doc id], ...] of the documents of run i, and the state of the build after the last complete run
+CSR_RUN_IDS_FILE = "run_{}_ids.json"
+CSR_RUN_MANIFEST_FILE = "manifest.json"
+
+
+def csr_exists(index_path):
+    return all(os.path.exists(os.path.join(index_path, name))
+               for name in [CSR_META_FILE, CSR_OFFSETS_FILE, CSR_DOC_IDS_FILE, CSR_DOC_VALUES_FILE])
+
+
+def nb_docs_from_doc_ids(index_path):
+    """size of the collection as seen by the scorer (max internal doc id + 1)
+    """
+    doc_ids = pickle.load(open(os.path.join(index_path, "doc_ids.pkl"), "rb"))
+    if isinstance(doc_ids, list):
+        return len(doc_ids)
+    min_val = 1000000000 
+    max_val = -100000000
+    for val in doc_ids:
+        min_val = min(min_val, val)
+        max_val = max(max_val, val)
+    print("min_val: ", min_val, "max_val: ", max_val)
+    assert min_val == 0, min_val 
+    return max_val + 1
+
+
+def write_csr_index(index_path, get_posting, posting_lengths, n_docs):
+    """write posting lists to the CSR layout without holding more than one of them in memory.
+    `get_posting(key)` returns the (doc_ids, doc_values) of a term and `posting_lengths[key]` its size.
+    Doc ids are sorted inside each posting list, which later stages rely on.
+    """
+    dim = len(posting_lengths)
+    offsets = np.zeros(dim + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.asarray(posting_lengths, dtype=np.int64))
+    n_postings = int(offsets[-1])
+
+    np.save(os.path.join(index_path, CSR_OFFSETS_FILE), offsets)
+    out_ids = np.lib.format.open_memmap(os.path.join(index_path, CSR_DOC_IDS_FILE), mode="w+",
+                                        dtype=np.int32, shape=(n_postings,))
+    out_values = np.lib.format.open_memmap(os.path.join(index_path, CSR_DOC_VALUES_FILE), mode="w+",
+                                           dtype=np.float32, shape=(n_postings,))
+    for key in tqdm(range(dim), desc="writing csr index"):
+        start, end = offsets[key], offsets[key + 1]
+        if start == end:
+            continue
+        ids, values = get_posting(key)
+        ids = np.asarray(ids, dtype=np.int32)
+        values = np.asarray(values, dtype=np.float32)
+        if len(ids) > 1 and np.any(ids[1:] < ids[:-1]):
+            order = np.argsort(ids, kind="stable")
+            ids, values = ids[order], values[order]
+        out_ids[start:end] = ids
+        out_values[start:end] = values
+    out_ids.flush()
+    out_values.flush()
+    del out_ids, out_values
+
+    write_block_max(index_path)
+    with open(os.path.join(index_path, CSR_META_FILE), "w") as f:
+        json.dump({"dim": dim, "n_docs": int(n_docs), "n_postings": n_postings, "block_size": BLOCK_SIZE}, f)
+
+
+def compute_block_max(offsets, doc_ids, doc_values, block_size=BLOCK_SIZE):
+    """per-term and per-block max impacts (plus the last doc id of every block) of a CSR index
+    """
+    offsets = np.asarray(offsets, dtype=np.int64)
+    lengths = np.diff(offsets)
+    n_blocks = (lengths + block_size - 1) // block_size
+    block_offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    block_offsets[1:] = np.cumsum(n_blocks)
+
+    block_terms = np.repeat(np.arange(len(lengths)), n_blocks)
+    block_starts = offsets[block_terms] + (np.arange(block_offsets[-1]) - block_offsets[block_terms]) * block_size
+    block_ends = np.minimum(block_starts + block_size, offsets[block_terms + 1])
+    if len(block_starts) > 0:
+        block_max = np.maximum.reduceat(doc_values, block_starts).astype(np.float32)
+        block_last_doc = np.asarray(doc_ids[block_ends - 1], dtype=np.int32)
+    else:
+        block_max = np.array([], dtype=np.float32)
+        block_last_doc = np.array([], dtype=np.int32)
+
+    term_max = np.zeros(len(lengths), dtype=np.float32)
+    non_empty = n_blocks > 0
+    if non_empty.any():
+        term_max[non_empty] = np.maximum.reduceat(block_max, block_offsets[:-1][non_empty])
+    return term_max, block_offsets, block_max.astype(np.float32), block_last_doc
+
+
+def write_block_max(index_path, block_size=BLOCK_SIZE):
+    offsets = np.load(os.path.join(index_path, CSR_OFFSETS_FILE), mmap_mode="r")
+    doc_ids = np.load(os.path.join(index_path, CSR_DOC_IDS_FILE), mmap_mode="r")
+    doc_values = np.load(os.path.join(index_path, CSR_DOC_VALUES_FILE), mmap_mode="r")
+    term_max, block_offsets, block_max, block_last_doc = compute_block_max(offsets, doc_ids, doc_values,
+                                                                           block_size=block_size)
+    np.save(os.path.join(index_path, CSR_TERM_MAX_FILE), term_max)
+    np.save(os.path.join(index_path, CSR_BLOCK_OFFSETS_FILE), block_offsets)
+    np.save(os.path.join(index_path, CSR_BLOCK_MAX_FILE), block_max)
+    np.save(os.path.join(index_path, CSR_BLOCK_LAST_DOC_FILE), block_last_doc)
+
+
+def quantize_csr(index_path, dtype="uint8", scale="term"):
+    """write a quantized copy of the csr impacts. `scale="term"` maps every posting list on the full
+    integer range (one scale per term), `scale="global"` uses one scale for the whole index.
+    """
+    assert dtype in QUANTIZED_DTYPES, dtype
+    assert scale in ["term", "global"], scale
+    qtype = QUANTIZED_DTYPES[dtype]
+    qmax = np.iinfo(qtype).max
+    offsets = np.load(os.path.join(index_path, CSR_OFFSETS_FILE), mmap_mode="r")
+    doc_values = np.load(os.path.join(index_path, CSR_DOC_VALUES_FILE), mmap_mode="r")
+    term_max_path = os.path.join(index_path, CSR_TERM_MAX_FILE)
+    if not os.path.exists(term_max_path):
+        write_block_max(index_path)
+    term_max = np.load(term_max_path)
+    if scale == "global":
+        term_max = np.full_like(term_max, term_max.max(initial=0.0))
+    term_scale = np.where(term_max > 0, term_max / qmax, 1.0).astype(np.float32)
+
+    out_values = np.lib.format.open_memmap(os.path.join(index_path, CSR_QUANTIZED_VALUES_FILE.format(dtype)),
+                                           mode="w+", dtype=qtype, shape=(len(doc_values),))
+    for key in tqdm(range(len(offsets) - 1), desc=f"quantizing csr index to {dtype}"):
+        start, end = offsets[key], offsets[key + 1]
+        if start == end:
+            continue
+        # a posting never rounds down to 0, the doc keeps matching the term
+        out_values[start:end] = np.clip(np.rint(doc_values[start:end] / term_scale[key]), 1, qmax)
+    out_values.flush()
+    del out_values
+    np.save(os.path.join(index_path, CSR_TERM_SCALE_FILE.format(dtype)), term_scale)
+    print(f"done quantizing index to {dtype} ({scale} scale)...")
+
+
+def write_packed_doc_ids(index_path, block_size=BLOCK_SIZE):
+    """write the delta + bit-packed copy of the csr doc ids (see posting_codec)
+    """
+    offsets = np.load(os.path.join(index_path, CSR_OFFSETS_FILE), mmap_mode="r")
+    doc_ids = np.load(os.path.join(index_path, CSR_DOC_IDS_FILE), mmap_mode="r")
+    _, block_base, block_bits, block_words, packed = pack_doc_ids(offsets, doc_ids, block_size)
+    np.save(os.path.join(index_path, CSR_PACKED_FILE), packed)
+    np.save(os.path.join(index_path, CSR_PACKED_BLOCK_WORDS_FILE), block_words)
+    np.save(os.path.join(index_path, CSR_PACKED_BLOCK_BITS_FILE), block_bits)
+    np.save(os.path.join(index_path, CSR_PACKED_BLOCK_BASE_FILE), block_base)
+    with open(os.path.join(index_path, CSR_META_FILE), "r") as f:
+        meta = json.load(f)
+    meta["packed_block_size"] = block_size
+    with open(os.path.join(index_path, CSR_META_FILE), "w") as f:
+        json.dump(meta, f)
+    print(f"done packing doc ids: {packed.nbytes + block_words.nbytes + block_bits.nbytes + block_base.nbytes} "
+          f"bytes instead of {doc_ids.nbytes}...")
+
+
+def shard_csr(index_path, n_shards):
+    """split a csr index by doc-id range into `n_shards` csr indexes {index_path}/shard_{i}, one per shard worker.
+    Shards store local doc ids, the global id of a doc is its local id + `doc_id_start` of the shard meta.
+    """
+    with open(os.path.join(index_path, CSR_META_FILE), "r") as f:
+        meta = json.load(f)
+    offsets = np.load(os.path.join(index_path, CSR_OFFSETS_FILE), mmap_mode="r")
+    doc_ids = np.load(os.path.join(index_path, CSR_DOC_IDS_FILE), mmap_mode="r")
+    doc_values = np.load(os.path.join(index_path, CSR_DOC_VALUES_FILE), mmap_mode="r")
+    n_docs, dim = meta["n_docs"], meta["dim"]
+    bounds = np.linspace(0, n_docs, n_shards + 1).astype(np.int64)
+
+    # split[key, i] is the position of the first posting of shard i in the posting list of key
+    split = np.empty((dim, n_shards + 1), dtype=np.int64)
+    for key in tqdm(range(dim), desc="splitting posting lists"):
+        start, end = offsets[key], offsets[key + 1]
+        split[key] = start + np.searchsorted(doc_ids[start:end], bounds)
+
+    shard_dirs = []
+    for i in range(n_shards):
+        shard_dir = os.path.join(index_path, "shard_{}".format(i))
+        os.makedirs(shard_dir, exist_ok=True)
+        doc_id_start = int(bounds[i])
+
+        def get_posting(key):
+            start, end = split[key, i], split[key, i + 1]
+            return doc_ids[start:end] - doc_id_start, doc_values[start:end]
+
+        write_csr_index(shard_dir, get_posting, split[:, i + 1] - split[:, i], bounds[i + 1] - bounds[i])
+        with open(os.path.join(shard_dir, CSR_META_FILE), "r") as f:
+            shard_meta = json.load(f)
+        shard_meta["doc_id_start"] = doc_id_start
+        with open(os.path.join(shard_dir, CSR_META_FILE), "w") as f:
+            json.dump(shard_meta, f)
+        shard_dirs.append(shard_dir)
+    print("done sharding index into {} doc-id ranges...".format(n_shards))
+    return shard_dirs
+
+
+def convert_h5py_to_csr(index_path, filename="array_index.h5py", dim_voc=None):
+    """convert an existing per-term h5py index into the memory-mapped CSR layout (same directory)
+    """
+    with h5py.File(os.path.join(index_path, filename), "r") as file:
+        dim = dim_voc if dim_voc is not None else int(file["dim"][()])
+        posting_lengths = []
+        for key in tqdm(range(dim), desc="reading posting sizes"):
+            name = "index_doc_id_{}".format(key)
+            posting_lengths.append(file[name].shape[0] if name in file else 0)
+
+        def get_posting(key):
+            return file["index_doc_id_{}".format(key)][()], file["index_doc_value_{}".format(key)][()]
+
+        write_csr_index(index_path, get_posting, posting_lengths, nb_docs_from_doc_ids(index_path))
+    print("done converting index to csr...")
+
+
+class IndexCSRArray:
+    """read-only inverted index in the CSR layout, either memory-mapped from disk (`load`)
+    or packed in memory from an IndexDictOfArray (`from_index_dict`).
+    Loading does not touch the postings, so startup is near-instant and
+    processes serving the same index share the page cache.
+    With `values_dtype` in QUANTIZED_DTYPES, impacts are the integer values times `term_scale`.
+    With `packed_doc_ids`, `doc_ids` is None and `packed` holds the (block_offsets, block_base, block_bits,
+    block_words, packed) arrays of the bit-packed doc ids, decoded by the scorer.
+    """
+    def __init__(self, offsets, doc_ids, doc_values, n_docs, index_path=None, term_scale=None):
+        self.index_path = index_path
+        self.offsets = offsets
+        self.doc_ids = doc_ids
+        self.doc_values = doc_values
+        self.term_scale = term_scale
+        self.packed = None
+        self.packed_block_size = BLOCK_SIZE
+        # a shard of a larger collection holds docs [doc_id_start, doc_id_start + n_docs) with local ids
+        self.doc_id_start = 0
+        self.dim = len(offsets) - 1
+        self.n = n_docs
+        self.block_size = BLOCK_SIZE
+        self.term_max = None
+        self.block_offsets = None
+        self.block_max = None
+        self.block_last_doc = None
+
+    @classmethod
+    def load(cls, index_path, mmap_mode="r", values_dtype="float32", packed_doc_ids=False):
+        with open(os.path.join(index_path, CSR_META_FILE), "r") as f:
+            meta = json.load(f)
+        offsets = np.load(os.path.join(index_path, CSR_OFFSETS_FILE), mmap_mode=mmap_mode)
+        if packed_doc_ids:
+            assert "packed_block_size" in meta, "run `inverted_index --pack {}` first".format(index_path)
+            doc_ids = None
+        else:
+            doc_ids = np.load(os.path.join(index_path, CSR_DOC_IDS_FILE), mmap_mode=mmap_mode)
+        if values_dtype == "float32":
+            doc_values = np.load(os.path.join(index_path, CSR_DOC_VALUES_FILE), mmap_mode=mmap_mode)
+            term_scale = None
+        else:
+            assert values_dtype in QUANTIZED_DTYPES, values_dtype
+            doc_values = np.load(os.path.join(index_path, CSR_QUANTIZED_VALUES_FILE.format(values_dtype)),
+                                 mmap_mode=mmap_mode)
+            term_scale = np.load(os.path.join(index_path, CSR_TERM_SCALE_FILE.format(values_dtype)))
+        assert len(offsets) == meta["dim"] + 1, (len(offsets), meta["dim"])
+        index = cls(offsets, doc_ids, doc_values, meta["n_docs"], index_path=index_path, term_scale=term_scale)
+        index.doc_id_start = meta.get("doc_id_start", 0)
+        if packed_doc_ids:
+            index.packed_block_size = meta["packed_block_size"]
+            index.packed = (posting_block_offsets(offsets, index.packed_block_size),
+                            np.load(os.path.join(index_path, CSR_PACKED_BLOCK_BASE_FILE), mmap_mode=mmap_mode),
+                            np.load(os.path.join(index_path, CSR_PACKED_BLOCK_BITS_FILE), mmap_mode=mmap_mode),
+                            np.load(os.path.join(index_path, CSR_PACKED_BLOCK_WORDS_FILE), mmap_mode=mmap_mode),
+                            np.load(os.path.join(index_path, CSR_PACKED_FILE), mmap_mode=mmap_mode))
+        # the stored block maxima are float32 impacts, quantized indexes recompute theirs in their own unit
+        if term_scale is None and os.path.exists(os.path.join(index_path, CSR_BLOCK_MAX_FILE)):
+            index.block_size = meta.get("block_size", BLOCK_SIZE)
+            index.term_max = np.load(os.path.join(index_path, CSR_TERM_MAX_FILE), mmap_mode=mmap_mode)
+            index.block_offsets = np.load(os.path.join(index_path, CSR_BLOCK_OFFSETS_FILE), mmap_mode=mmap_mode)
+            index.block_max = np.load(os.path.join(index_path, CSR_BLOCK_MAX_FILE), mmap_mode=mmap_mode)
+            index.block_last_doc = np.load(os.path.join(index_path, CSR_BLOCK_LAST_DOC_FILE), mmap_mode=mmap_mode)
+        return index
+
+    @classmethod
+    def from_index_dict(cls, index, dim=None):
+        """pack the per-term arrays of an IndexDictOfArray into contiguous CSR arrays
+        """
+        if dim is None:
+            dim = max(index.index_doc_id.keys(), default=-1) + 1
+        lengths = np.array([len(index.index_doc_id[key]) if key in index.index_doc_id else 0
+                            for key in range(dim)], dtype=np.int64)
+        offsets = np.zeros(dim + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(lengths)
+        doc_ids = np.empty(offsets[-1], dtype=np.int32)
+        doc_values = np.empty(offsets[-1], dtype=np.float32)
+        for key in np.nonzero(lengths)[0]:
+            ids = np.asarray(index.index_doc_id[key], dtype=np.int32)
+            values = np.asarray(index.index_doc_value[key], dtype=np.float32)
+            order = np.argsort(ids, kind="stable")
+            doc_ids[offsets[key]:offsets[key + 1]] = ids[order]
+            doc_values[offsets[key]:offsets[key + 1]] = values[order]
+        return cls(offsets, doc_ids, doc_values, index.nb_docs())
+
+    def ensure_block_max(self):
+        """compute the dynamic pruning metadata in memory for indexes built before it was stored
+        """
+        if self.block_max is None and self.doc_ids is None:
+            print("no block max metadata found and doc ids are packed, dynamic pruning is unavailable")
+        elif self.block_max is None:
+            print("no block max metadata found, computing it...")
+            self.term_max, self.block_offsets, self.block_max, self.block_last_doc = compute_block_max(
+                self.offsets, self.doc_ids, self.doc_values, block_size=self.block_size)
+
+    def scale_query(self, col, values):
+        """query weights in the unit of the stored impacts (the per-term scale folded in)
+        """
+        if self.term_scale is None:
+            return values
+        return (values * self.term_scale[col]).astype(np.float32)
+
+    def posting(self, key):
+        start, end = self.offsets[key], self.offsets[key + 1]
+        if self.doc_ids is None:
+            return unpack_posting(self.offsets, *self.packed, self.packed_block_size, key), self.doc_values[start:end]
+        return self.doc_ids[start:end], self.doc_values[start:end]
+
+    def __len__(self):
+        return self.dim
+
+    def nb_docs(self):
+        return self.n
+
+
 class IndexDictOfArray:
     def __init__(self, index_path=None, force_new=False, filename="array_index.h5py", dim_voc=None):
         if index_path is not None:
@@ -18,7 +365,21 @@ class IndexDictOfArray:
             if not os.path.exists(index_path):
                 os.makedirs(index_path)
             self.filename = os.path.join(self.index_path, filename)
-            if os.path.exists(self.filename) and not force_new:
+            if csr_exists(self.index_path) and not force_new:
+                print("csr index already exists, memory-mapping...")
+                self.csr = IndexCSRArray.load(self.index_path)
+                dim = dim_voc if dim_voc is not None else self.csr.dim
+                self.index_doc_id = dict()
+                self.index_doc_value = dict()
+                for key in range(dim):
+                    if key < self.csr.dim:
+                        self.index_doc_id[key], self.index_doc_value[key] = self.csr.posting(key)
+                    else:
+                        self.index_doc_id[key] = np.array([], dtype=np.int32)
+                        self.index_doc_value[key] = np.array([], dtype=np.float32)
+                self.n = self.csr.nb_docs()
+                print("done loading index...")
+            elif os.path.exists(self.filename) and not force_new:
                 print("index already exists, loading...")
                 self.file = h5py.File(self.filename, "r")
                 if dim_voc is not None:
@@ -40,18 +401,9 @@ class IndexDictOfArray:
                 self.file.close()
                 del self.file
                 print("done loading index...")
-                doc_ids = pickle.load(open(os.path.join(self.index_path, "doc_ids.pkl"), "rb"))
-                if isinstance(doc_ids, list):
-                    self.n = len(doc_ids)
-                else:
-                    min_val = 1000000000 
-                    max_val = -100000000
-                    for val in doc_ids:
-                        min_val = min(min_val, val)
-                        max_val = max(max_val, val)
-                    print("min_val: ", min_val, "max_val: ", max_val)
-                    assert min_val == 0, min_val 
-                    self.n = max_val + 1
+                print("hint: run `python -m scaling_retriever.utils.inverted_index --to_csr {}` "
+                      "to memory-map this index instead".format(self.index_path))
+                self.n = nb_docs_from_doc_ids(self.index_path)
             else:
                 self.n = 0
                 print("initializing new index...")
@@ -80,7 +432,7 @@ class IndexDictOfArray:
     def nb_docs(self):
         return self.n
 
-    def save(self, dim=None):
+    def save(self, dim=None, n_docs=None):
         print("converting to numpy")
         for key in tqdm(list(self.index_doc_id.keys())):
             self.index_doc_id[key] = np.array(self.index_doc_id[key], dtype=np.int32)
@@ -102,77 +454,285 @@ class IndexDictOfArray:
         for k, v in self.index_doc_id.items():
             index_dist[int(k)] = len(v)
         json.dump(index_dist, open(os.path.join(self.index_path, "index_dist.json"), "w"))
+        print("saving csr index...")
+        csr_dim = int(dim) if dim else max(self.index_doc_id.keys(), default=-1) + 1
+        write_csr_index(self.index_path,
+                        lambda key: (self.index_doc_id[key], self.index_doc_value[key]),
+                        [len(self.index_doc_id[key]) if key in self.index_doc_id else 0 for key in range(csr_dim)],
+                        n_docs if n_docs is not None else self.n)
         
 
+class IndexCSRBuilder:
+    """streaming construction of a csr index with bounded memory. Postings are buffered flat and, whenever
+    the buffer holds `max_postings` of them, sorted by (term, doc id) and spilled to {index_path}/runs as
+    a csr run. `save` k-way merges the runs term by term into the final csr index, so the build memory
+    is one buffer plus one posting list, whatever the size of the collection.
+    Each spill also writes the doc ids of the run and a manifest (n_runs, dim, n, n_batches and the
+    caller's `build_key`), with `resume` a restarted build keeps the complete runs of a crashed one and
+    `n_batches` tells the caller how many batches of its (deterministic) loader they already cover.
+    `build_key` holds whatever decides those batches (corpus, batch size, ranks...), runs recorded with
+    another key are refused.
+    """
+    def __init__(self, index_path, dim_voc=None, max_postings=50_000_000, resume=True, build_key=None):
+        self.index_path = index_path
+        self.run_dir = os.path.join(index_path, CSR_RUN_DIR)
+        os.makedirs(self.run_dir, exist_ok=True)
+        self.dim_voc = dim_voc
+        self.build_key = build_key
+        self.dim = dim_voc if dim_voc is not None else 0
+        self.max_postings = max_postings
+        self.n = 0
+        self.n_runs = 0
+        self.n_batches = 0
+        manifest = self._read_manifest() if resume else None
+        if manifest is not None:
+            recorded = dict(manifest.get("build_key") or {}, dim_voc=manifest["dim_voc"])
+            expected = dict(build_key or {}, dim_voc=dim_voc)
+            if recorded != expected:
+                changed = sorted(key for key in set(recorded) | set(expected) if recorded.get(key) != expected.get(key))
+                raise ValueError("{} holds spilled runs of a build with different {}, rerun it with the same "
+                                 "arguments or remove the directory".format(self.run_dir, ", ".join(changed)))
+            self.dim, self.n, self.n_runs, self.n_batches = (manifest["dim"], manifest["n"], manifest["n_runs"],
+                                                             manifest["n_batches"])
+            print("resuming from {} spilled runs covering {} batches ({} documents)".format(
+                self.n_runs, self.n_batches, self.n))
+        # files of runs past the manifest come from a spill that did not complete
+        kept = {CSR_RUN_MANIFEST_FILE} if self.n_runs else set()
+        for i in range(self.n_runs):
+            kept.update(CSR_RUN_FILE.format(i, name) for name in ["offsets", "doc_ids", "doc_values"])
+            kept.add(CSR_RUN_IDS_FILE.format(i))
+        for name in os.listdir(self.run_dir):
+            if name not in kept:
+                os.remove(os.path.join(self.run_dir, name))
+        self._reset_buffer()
+
+    def _read_manifest(self):
+        path = os.path.join(self.run_dir, CSR_RUN_MANIFEST_FILE)
+        if not os.path.exists(path):
+            return None
+        with open(path, "r") as f:
+            return json.load(f)
+
+    def _reset_buffer(self):
+        self.buffer_terms = array.array("i")
+        self.buffer_doc_ids = array.array("i")
+        self.buffer_values = array.array("f")
+        self.buffer_ids = []
+        self.buffer_batches = 0
+
+    def add_batch_document(self, row, col, data, n_docs=-1, doc_ids=None):
+        """add a batch of documents to the buffer, spilling it to a run when it is full. `doc_ids`
+        ({doc row: doc id}) is saved with the run, see `resumed_doc_ids`
+        """
+        if n_docs < 0:
+            self.n += len(set(row))
+        else:
+            self.n += n_docs
+        self.buffer_terms.frombytes(np.asarray(col, dtype=np.int32).tobytes())
+        self.buffer_doc_ids.frombytes(np.asarray(row, dtype=np.int32).tobytes())
+        self.buffer_values.frombytes(np.asarray(data, dtype=np.float32).tobytes())
+        if doc_ids:
+            self.buffer_ids.extend([int(doc_row), doc_id] for doc_row, doc_id in doc_ids.items())
+        self.buffer_batches += 1
+        if len(self.buffer_terms) >= self.max_postings:
+            self.spill()
+
+    def spill(self):
+        if len(self.buffer_terms) == 0:
+            return
+        terms = np.frombuffer(self.buffer_terms, dtype=np.int32)
+        doc_ids = np.frombuffer(self.buffer_doc_ids, dtype=np.int32)
+        values = np.frombuffer(self.buffer_values, dtype=np.float32)
+        order = np.lexsort((doc_ids, terms))
+        run_dim = int(terms.max()) + 1
+        offsets = np.zeros(run_dim + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(terms, minlength=run_dim))
+        np.save(os.path.join(self.run_dir, CSR_RUN_FILE.format(self.n_runs, "offsets")), offsets)
+        np.save(os.path.join(self.run_dir, CSR_RUN_FILE.format(self.n_runs, "doc_ids")), doc_ids[order])
+        np.save(os.path.join(self.run_dir, CSR_RUN_FILE.format(self.n_runs, "doc_values")), values[order])
+        with open(os.path.join(self.run_dir, CSR_RUN_IDS_FILE.format(self.n_runs)), "w") as f:
+            json.dump(self.buffer_ids, f)
+        print("spilled run {} with {} postings".format(self.n_runs, len(order)))
+        self.dim = max(self.dim, run_dim)
+        self.n_runs += 1
+        self.n_batches += self.buffer_batches
+        self._write_manifest()
+        del terms, doc_ids, values
+        self._reset_buffer()
+
+    def _write_manifest(self):
+        # written last and renamed into place: the manifest only ever lists complete runs
+        path = os.path.join(self.run_dir, CSR_RUN_MANIFEST_FILE)
+        with open(path + ".tmp", "w") as f:
+            json.dump({"n_runs": self.n_runs, "dim": self.dim, "n": self.n, "n_batches": self.n_batches,
+                       "dim_voc": self.dim_voc, "build_key": self.build_key}, f)
+        os.replace(path + ".tmp", path)
+
+    def resumed_doc_ids(self):
+        """{doc row: doc id} of the documents already in the spilled runs
+        """
+        doc_ids = {}
+        for i in range(self.n_runs):
+            with open(os.path.join(self.run_dir, CSR_RUN_IDS_FILE.format(i)), "r") as f:
+                doc_ids.update({row: doc_id for row, doc_id in json.load(f)})
+        return doc_ids
+
+    def load_runs(self):
+        return [tuple(np.load(os.path.join(self.run_dir, CSR_RUN_FILE.format(i, name)), mmap_mode="r")
+                      for name in ["offsets", "doc_ids", "doc_values"])
+                for i in range(self.n_runs)]
+
+    def __len__(self):
+        return self.dim
+
+    def nb_docs(self):
+        return self.n
+
+    def save(self, dim=None, n_docs=None):
+        self.spill()
+        runs = self.load_runs()
+        csr_dim = int(dim) if dim else self.dim
+        posting_lengths = np.zeros(csr_dim, dtype=np.int64)
+        for offsets, _, _ in runs:
+            run_dim = min(len(offsets) - 1, csr_dim)
+            posting_lengths[:run_dim] += np.diff(offsets[:run_dim + 1])
+
+        def get_posting(key):
+            # every run slice is sorted by doc id, the stable sort (timsort) of write_csr_index merges them as runs
+            parts = [(doc_ids[offsets[key]:offsets[key + 1]], doc_values[offsets[key]:offsets[key + 1]])
+                     for offsets, doc_ids, doc_values in runs if key < len(offsets) - 1]
+            return np.concatenate([ids for ids, _ in parts]), np.concatenate([values for _, values in parts])
+
+        print("merging {} runs into the csr index...".format(len(runs)))
+        write_csr_index(self.index_path, get_posting, posting_lengths, n_docs if n_docs is not None else self.n)
+        index_dist = {int(k): int(v) for k, v in enumerate(posting_lengths) if v > 0}
+        json.dump(index_dist, open(os.path.join(self.index_path, "index_dist.json"), "w"))
+        del runs
+        for name in os.listdir(self.run_dir):
+            os.remove(os.path.join(self.run_dir, name))
+        os.rmdir(self.run_dir)
+
+
+def _open_shard(idx_dir, filename, dim_voc):
+    """(posting lengths [dim_voc], get_posting(key) -> (global doc ids, values), close) of one shard index,
+    read from its csr layout when it has one, else from its h5py file
+    """
+    if csr_exists(idx_dir):
+        shard = IndexCSRArray.load(idx_dir)
+        assert shard.dim <= dim_voc, (shard.dim, dim_voc)
+        lengths = np.zeros(dim_voc, dtype=np.int64)
+        lengths[:shard.dim] = np.diff(np.asarray(shard.offsets, dtype=np.int64))
+
+        def get_posting(key):
+            ids, values = shard.posting(key)
+            return np.asarray(ids, dtype=np.int32) + shard.doc_id_start, values
+
+        return lengths, get_posting, lambda: None
+
+    file = h5py.File(os.path.join(idx_dir, filename), "r")
+    assert file["dim"][()] <= dim_voc, (file["dim"][()], dim_voc)
+    lengths = np.zeros(dim_voc, dtype=np.int64)
+    for key in range(dim_voc):
+        name = "index_doc_id_{}".format(key)
+        if name in file:
+            lengths[key] = file[name].shape[0]
+
+    def get_posting(key):
+        return file["index_doc_id_{}".format(key)][()], file["index_doc_value_{}".format(key)][()]
+
+    return lengths, get_posting, file.close
+
+
 def merge_indexes(model_name_or_path, filename="array_index.h5py", index_name="index", index_dir=None):
+    """merge the shard indexes {index_name}_* (one per indexing worker, any number of them) into a csr index
+    {index_name}. Posting lists are merged term by term and written straight to the output memmaps,
+    so memory holds one merged posting list at a time.
+    """
     with open(os.path.join(model_name_or_path, "config.json")) as fin: 
         config = ujson.load(fin)
     dim_voc = config["vocab_size"]
     print("dim_voc: ", dim_voc)
     
-    if index_dir is not None:
-        index_dirs = [os.path.join(index_dir, d) for d in os.listdir(index_dir)
-                      if d.startswith(index_name)]
-    else:
-        index_dirs = [os.path.join(model_name_or_path, d) for d in os.listdir(model_name_or_path)
-                    if d.startswith(index_name)]
-    assert len(index_dirs) in [1, 2, 4], index_dirs 
+    root_dir = index_dir if index_dir is not None else model_name_or_path
+    index_dirs = sorted(os.path.join(root_dir, d) for d in os.listdir(root_dir)
+                        if d.startswith(index_name) and d != index_name
+                        and os.path.isdir(os.path.join(root_dir, d)))
+    assert len(index_dirs) > 0, "no {}* shard index in {}".format(index_name, root_dir)
     
     if len(index_dirs) == 1:
         print("only one index, no need to merge")
         return
     
-    index_doc_id = dict() 
-    index_doc_value = dict()
     doc_ids = dict()
-    index_dist = {}
-    index_stats = {"L0_d": 0}
+    shard_stats = []
     for idx_dir in index_dirs:
-        file = h5py.File(os.path.join(idx_dir, filename), "r")
-        assert file["dim"][()] <= dim_voc, (file["dim"][()], dim_voc)
-        for key in tqdm(range(dim_voc)):
-            try:
-                new_index_doc_id = np.array(file["index_doc_id_{}".format(key)], dtype=np.int32)
-                new_index_doc_value = np.array(file["index_doc_value_{}".format(key)], dtype=np.float32)
-            except:
-                new_index_doc_id = np.array([], dtype=np.int32)
-                new_index_doc_value = np.array([], dtype=np.float32)
-            if key not in index_doc_id:
-                index_doc_id[key] = new_index_doc_id
-                index_doc_value[key] = new_index_doc_value
-            else:
-                index_doc_id[key] = np.append(index_doc_id[key], new_index_doc_id)
-                index_doc_value[key] = np.append(index_doc_value[key], new_index_doc_value)
-        
         with open(os.path.join(idx_dir, "doc_ids.pkl"), "rb") as f:
-            doc_ids.update(pickle.load(f))
-        with open(os.path.join(idx_dir, "index_dist.json"), "r") as f:
-            index_dist.update(json.load(f))
-        with open(os.path.join(idx_dir, "index_stats.json"), "r") as f:
-            index_stats["L0_d"] += json.load(f)["L0_d"] / len(index_dirs)
-
-    if index_dir is not None:
-        out_index_dir = os.path.join(index_dir, index_name)
-    else:
-        out_index_dir = os.path.join(model_name_or_path, index_name)
+            shard_doc_ids = pickle.load(f)
+        assert not (doc_ids.keys() & shard_doc_ids.keys()), "shards {} overlap".format(index_dirs)
+        doc_ids.update(shard_doc_ids)
+        stats_path = os.path.join(idx_dir, "index_stats.json")
+        if os.path.exists(stats_path):
+            with open(stats_path, "r") as f:
+                shard_stats.append((len(shard_doc_ids), json.load(f)))
+
+    shards = [_open_shard(idx_dir, filename, dim_voc) for idx_dir in tqdm(index_dirs, desc="opening shards")]
+    posting_lengths = np.sum([lengths for lengths, _, _ in shards], axis=0)
+
+    def get_posting(key):
+        # the shards hold disjoint doc ids, the stable sort (timsort) of write_csr_index merges their sorted lists
+        parts = [get_shard_posting(key) for lengths, get_shard_posting, _ in shards if lengths[key] > 0]
+        return np.concatenate([ids for ids, _ in parts]), np.concatenate([values for _, values in parts])
+
+    out_index_dir = os.path.join(root_dir, index_name)
     os.makedirs(out_index_dir, exist_ok=True)
-    with h5py.File(os.path.join(out_index_dir, filename), "w") as f:
-        f.create_dataset("dim", data=int(dim_voc))
-        for key in tqdm(index_doc_id.keys()):
-            f.create_dataset("index_doc_id_{}".format(key), data=index_doc_id[key])
-            f.create_dataset("index_doc_value_{}".format(key), data=index_doc_value[key])
+    write_csr_index(out_index_dir, get_posting, posting_lengths, max(doc_ids) + 1 if doc_ids else 0)
+    for _, _, close in shards:
+        close()
+
+    # stats are per-doc averages, weighted by the shard sizes, throughputs add up as the workers run concurrently
+    index_stats = {}
+    n_stat_docs = sum(n for n, _ in shard_stats)
+    for n, stats in shard_stats:
+        for key, value in stats.items():
+            if key == "docs_per_sec":
+                index_stats[key] = index_stats.get(key, 0.) + value
+            else:
+                index_stats[key] = index_stats.get(key, 0.) + value * n / max(n_stat_docs, 1)
+
     with open(os.path.join(out_index_dir, "doc_ids.pkl"), "wb") as f:
         pickle.dump(doc_ids, f)
     with open(os.path.join(out_index_dir, "index_dist.json"), "w") as f:
-        json.dump(index_dist, f)
+        json.dump({int(k): int(v) for k, v in enumerate(posting_lengths) if v > 0}, f)
     with open(os.path.join(out_index_dir, "index_stats.json"), "w") as f:
         json.dump(index_stats, f)
+    print("done merging {} shard indexes into {}...".format(len(index_dirs), out_index_dir))
         
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument("--model_name_or_path", type=str, required=True)
+    parser.add_argument("--model_name_or_path", type=str, default=None)
     parser.add_argument("--index_name", default="index", type=str)
     parser.add_argument("--index_dir", default=None, type=str)
+    parser.add_argument("--to_csr", default=None, type=str,
+                        help="index directory whose array_index.h5py is converted to the memory-mapped csr layout")
+    parser.add_argument("--shard", default=None, type=str,
+                        help="csr index directory split by doc-id range into --n_shards shard indexes")
+    parser.add_argument("--n_shards", default=2, type=int)
+    parser.add_argument("--pack", default=None, type=str,
+                        help="csr index directory whose doc ids are delta + bit-packed")
+    parser.add_argument("--quantize", default=None, type=str,
+                        help="csr index directory whose impacts are quantized to --quantize_dtype")
+    parser.add_argument("--quantize_dtype", default="uint8", choices=list(QUANTIZED_DTYPES))
+    parser.add_argument("--quantize_scale", default="term", choices=["term", "global"])
     args = parser.parse_args()
     
-    merge_indexes(args.model_name_or_path, index_name=args.index_name, index_dir=args.index_dir)
\ No newline at end of file
+    if args.to_csr is not None:
+        convert_h5py_to_csr(args.to_csr)
+    elif args.shard is not None:
+        shard_csr(args.shard, args.n_shards)
+    elif args.pack is not None:
+        write_packed_doc_ids(args.pack)
+    elif args.quantize is not None:
+        quantize_csr(args.quantize, dtype=args.quantize_dtype, scale=args.quantize_scale)
+    else:
+        assert args.model_name_or_path is not None, "--model_name_or_path is required for merging"
+        merge_indexes(args.model_name_or_path, index_name=args.index_name, index_dir=args.index_dir)
\ No newline at end of file
@@ -0,0 +1,106 @@
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+
+import numpy as np
+
+
+class _Window:
+    """last `size` observations (for quantiles) plus the running sum and count since startup
+    """
+    def __init__(self, size):
+        self.values = deque(maxlen=size)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.values.append(value)
+        self.sum += value
+        self.count += 1
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(k, str(v).replace('"', '\\"')) for k, v in labels) + "}"
+
+
+class Metrics:
+    """thread-safe in-process metrics rendered in the Prometheus text exposition format.
+
+    `observe` feeds summaries (p50 / p95 / p99 over a sliding window of recent observations, plus sum
+    and count), `inc` counters, and `register_gauge` values read from a callable at scrape time.
+    Metric names are prefixed with `prefix`, labels are keyword arguments.
+    """
+    def __init__(self, prefix="retriever", window=10000, quantiles=(0.5, 0.95, 0.99)):
+        self.prefix = prefix
+        self.window = window
+        self.quantiles = quantiles
+        self.lock = threading.Lock()
+        self.help = {}
+        self.summaries = defaultdict(dict)
+        self.counters = defaultdict(lambda: defaultdict(float))
+        self.gauges = {}
+
+    def describe(self, name, help_text):
+        self.help[name] = help_text
+
+    def observe(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            window = self.summaries[name].get(key)
+            if window is None:
+                window = self.summaries[name][key] = _Window(self.window)
+            window.observe(float(value))
+
+    def inc(self, name, value=1, **labels):
+        with self.lock:
+            self.counters[name][tuple(sorted(labels.items()))] += value
+
+    def register_gauge(self, name, fn, help_text=None, metric_type="gauge"):
+        """`fn()` returns the current value; `metric_type="counter"` for monotonic values kept elsewhere
+        """
+        self.gauges[name] = (fn, metric_type)
+        if help_text is not None:
+            self.describe(name, help_text)
+
+    @contextmanager
+    def timer(self, stage):
+        """observe the wall time of the block in the `stage_seconds` summary
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe("stage_seconds", time.perf_counter() - start, stage=stage)
+
+    def _header(self, lines, name, metric_type):
+        full_name = f"{self.prefix}_{name}"
+        if name in self.help:
+            lines.append(f"# HELP {full_name} {self.help[name]}")
+        lines.append(f"# TYPE {full_name} {metric_type}")
+        return full_name
+
+    def render(self):
+        lines = []
+        with self.lock:
+            summaries = {name: {key: (np.array(w.values), w.sum, w.count) for key, w in series.items()}
+                         for name, series in self.summaries.items()}
+            counters = {name: dict(series) for name, series in self.counters.items()}
+        for name, series in sorted(summaries.items()):
+            full_name = self._header(lines, name, "summary")
+            for key, (values, total, count) in sorted(series.items()):
+                for q in self.quantiles:
+                    value = float(np.quantile(values, q)) if len(values) else float("nan")
+                    lines.append(f"{full_name}{_format_labels(key + (('quantile', q),))} {value}")
+                lines.append(f"{full_name}_sum{_format_labels(key)} {total}")
+                lines.append(f"{full_name}_count{_format_labels(key)} {count}")
+        for name, series in sorted(counters.items()):
+            full_name = self._header(lines, name, "counter")
+            for key, value in sorted(series.items()):
+                lines.append(f"{full_name}{_format_labels(key)} {value}")
+        for name, (fn, metric_type) in sorted(self.gauges.items()):
+            full_name = self._header(lines, name, metric_type)
+            lines.append(f"{full_name} {fn()}")
+        return "\n".join(lines) + "\n"
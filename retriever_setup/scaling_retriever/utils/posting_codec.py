@@ -0,0 +1,117 @@
+import numba
+import numpy as np
+
+# block-wise delta + bit-packing of the csr doc ids (BP128-like). Posting list of term t is cut in blocks of
+# `block_size` postings, blocks of t are block_offsets[t]:block_offsets[t + 1]. Block b stores its first doc id
+# in block_base[b] and the gaps to the following docs with block_bits[b] bits each, in the uint32 words
+# packed[block_words[b]:block_words[b + 1]] (least significant bits first).
+CSR_PACKED_FILE = "csr_packed_doc_ids.npy"
+CSR_PACKED_BLOCK_WORDS_FILE = "csr_packed_block_words.npy"
+CSR_PACKED_BLOCK_BITS_FILE = "csr_packed_block_bits.npy"
+CSR_PACKED_BLOCK_BASE_FILE = "csr_packed_block_base.npy"
+
+
+def posting_block_offsets(offsets, block_size):
+    lengths = np.diff(np.asarray(offsets, dtype=np.int64))
+    block_offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    block_offsets[1:] = np.cumsum((lengths + block_size - 1) // block_size)
+    return block_offsets
+
+
+@numba.njit(nogil=True, cache=True)
+def _block_bits(offsets, doc_ids, block_offsets, block_size):
+    """first doc id, gap bit width and number of packed words of every block
+    """
+    n_terms = len(offsets) - 1
+    block_bits = np.zeros(block_offsets[-1], dtype=np.uint8)
+    block_base = np.empty(block_offsets[-1], dtype=np.int32)
+    block_n_words = np.zeros(block_offsets[-1], dtype=np.int64)
+    for t in range(n_terms):
+        for b in range(block_offsets[t], block_offsets[t + 1]):
+            start = offsets[t] + (b - block_offsets[t]) * block_size
+            end = min(start + block_size, offsets[t + 1])
+            block_base[b] = doc_ids[start]
+            max_gap = 0
+            for j in range(start + 1, end):
+                max_gap = max(max_gap, doc_ids[j] - doc_ids[j - 1])
+            bits = 0
+            while max_gap > 0:
+                bits += 1
+                max_gap >>= 1
+            block_bits[b] = bits
+            block_n_words[b] = ((end - start - 1) * bits + 31) // 32
+    return block_bits, block_base, block_n_words
+
+
+@numba.njit(nogil=True, cache=True)
+def _pack(offsets, doc_ids, block_offsets, block_size, block_bits, block_words, packed):
+    n_terms = len(offsets) - 1
+    for t in range(n_terms):
+        for b in range(block_offsets[t], block_offsets[t + 1]):
+            start = offsets[t] + (b - block_offsets[t]) * block_size
+            end = min(start + block_size, offsets[t + 1])
+            bits = np.uint64(block_bits[b])
+            if bits == 0:
+                continue
+            word = block_words[b]
+            bit_pos = np.uint64(0)
+            for j in range(start + 1, end):
+                gap = np.uint64(doc_ids[j] - doc_ids[j - 1])
+                w = word + np.int64(bit_pos >> np.uint64(5))
+                shift = bit_pos & np.uint64(31)
+                packed[w] |= np.uint32((gap << shift) & np.uint64(0xFFFFFFFF))
+                if shift + bits > np.uint64(32):
+                    packed[w + 1] |= np.uint32(gap >> (np.uint64(32) - shift))
+                bit_pos += bits
+
+
+def pack_doc_ids(offsets, doc_ids, block_size):
+    """returns (block_offsets, block_base, block_bits, block_words, packed) of sorted csr posting lists
+    """
+    offsets = np.asarray(offsets, dtype=np.int64)
+    block_offsets = posting_block_offsets(offsets, block_size)
+    block_bits, block_base, block_n_words = _block_bits(offsets, doc_ids, block_offsets, block_size)
+    block_words = np.zeros(len(block_n_words) + 1, dtype=np.int64)
+    block_words[1:] = np.cumsum(block_n_words)
+    packed = np.zeros(block_words[-1], dtype=np.uint32)
+    _pack(offsets, doc_ids, block_offsets, block_size, block_bits, block_words, packed)
+    return block_offsets, block_base, block_bits, block_words, packed
+
+
+@numba.njit(nogil=True, cache=True)
+def unpack_block(packed, word, bits, base, n, out):
+    """decode the `n` doc ids of a block into out[:n]
+    """
+    out[0] = base
+    if bits == 0:
+        for i in range(1, n):
+            out[i] = base
+        return
+    bits = np.uint64(bits)
+    mask = (np.uint64(1) << bits) - np.uint64(1)
+    # bit buffer refilled one 32 bits word at a time
+    buffer = np.uint64(0)
+    available = np.uint64(0)
+    doc = np.int32(base)
+    for i in range(1, n):
+        if available < bits:
+            buffer |= np.uint64(packed[word]) << available
+            available += np.uint64(32)
+            word += 1
+        doc += np.int32(buffer & mask)
+        buffer >>= bits
+        available -= bits
+        out[i] = doc
+
+
+@numba.njit(nogil=True, cache=True)
+def unpack_posting(offsets, block_offsets, block_base, block_bits, block_words, packed, block_size, term):
+    start, end = offsets[term], offsets[term + 1]
+    out = np.empty(end - start, dtype=np.int32)
+    buffer = np.empty(block_size, dtype=np.int32)
+    for b in range(block_offsets[term], block_offsets[term + 1]):
+        block_start = (b - block_offsets[term]) * block_size
+        n = min(block_size, end - start - block_start)
+        unpack_block(packed, block_words[b], block_bits[b], block_base[b], n, buffer)
+        out[block_start:block_start + n] = buffer[:n]
+    return out
@@ -0,0 +1,60 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+
+class QueryBatcher:
+    """merges concurrent single-query requests into one encoder batch.
+
+    Callers block on `encode(query)` from their own request thread. A background thread takes the first
+    pending query, keeps collecting for at most `max_wait_ms` or until `max_batch_size` queries are
+    pending, runs `encode_fn(list_of_queries)` once and hands each caller its own result.
+    `on_batch(waits)`, if given, receives the seconds every query of a batch spent queued before encoding.
+    """
+    def __init__(self, encode_fn, max_batch_size=16, max_wait_ms=5.0, on_batch=None):
+        self.encode_fn = encode_fn
+        self.on_batch = on_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, name="query-batcher", daemon=True)
+        self.thread.start()
+
+    def submit(self, query):
+        future = Future()
+        self.queue.put((query, future, time.monotonic()))
+        return future
+
+    def encode(self, query):
+        return self.submit(query).result()
+
+    def qsize(self):
+        return self.queue.qsize()
+
+    def _collect_batch(self):
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect_batch()
+            try:
+                if self.on_batch is not None:
+                    now = time.monotonic()
+                    self.on_batch([now - enqueued_at for _, _, enqueued_at in batch])
+                results = self.encode_fn([query for query, _, _ in batch])
+                for (_, future, _), result in zip(batch, results):
+                    future.set_result(result)
+            except Exception as e:
+                for _, future, _ in batch:
+                    future.set_exception(e)
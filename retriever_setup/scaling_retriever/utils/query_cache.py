@@ -0,0 +1,45 @@
+import threading
+from collections import OrderedDict
+
+
+class QueryVectorCache:
+    """bounded, thread-safe LRU cache of encoded sparse query vectors keyed by the normalized query text.
+    Cached (col, values) arrays are shared between requests, so they are made read-only.
+    """
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def normalize(query):
+        return " ".join(query.split())
+
+    def get(self, query):
+        key = self.normalize(query)
+        with self.lock:
+            value = self.entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, query, value):
+        if self.max_size <= 0:
+            return
+        for array in value:
+            array.flags.writeable = False
+        key = self.normalize(query)
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            return {"size": len(self.entries), "hits": self.hits, "misses": self.misses}
@@ -0,0 +1,46 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class RankingCache:
+    """keeps recently computed ranked lists for a short TTL so that paginated requests
+    (same query, growing offset) are served by slicing instead of re-ranking from scratch.
+
+    An entry stores the doc ids and scores of the top `depth` docs. A ranked list shorter than
+    its depth is complete: every doc with score > threshold is in it.
+    """
+    def __init__(self, ttl_seconds=300.0, max_entries=10000):
+        self.ttl = ttl_seconds
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, needed_depth):
+        """the cached (ids, scores, depth) if it covers the first `needed_depth` docs, else None
+        """
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires_at, ids, scores, depth = entry
+            if expires_at < now:
+                del self.entries[key]
+                return None
+            if depth < needed_depth and len(ids) == depth:
+                return None
+            self.entries.move_to_end(key)
+            return ids, scores, depth
+
+    def previous_depth(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            return entry[3] if entry is not None else 0
+
+    def put(self, key, ids, scores, depth):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, ids, scores, depth)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
@@ -0,0 +1,447 @@
+import numba
+import numpy as np
+
+from scaling_retriever.utils.posting_codec import unpack_block
+
+
+@numba.njit(nogil=True, parallel=True, cache=True)
+def numba_score_float(inverted_index_ids: numba.typed.Dict,
+                      inverted_index_floats: numba.typed.Dict,
+                      indexes_to_retrieve: np.ndarray,
+                      query_values: np.ndarray,
+                      threshold: float,
+                      size_collection: int):
+    """exhaustive term-at-a-time scoring over posting lists stored in numba typed dicts
+    """
+    scores = np.zeros(size_collection, dtype=np.float32)
+    n = len(indexes_to_retrieve)
+    for _idx in range(n):
+        local_idx = indexes_to_retrieve[_idx]
+        query_float = query_values[_idx]
+        retrieved_indexes = inverted_index_ids[local_idx]
+        retrieved_floats = inverted_index_floats[local_idx]
+        for j in numba.prange(len(retrieved_indexes)):
+            scores[retrieved_indexes[j]] += query_float * retrieved_floats[j]
+    filtered_indexes = np.argwhere(scores > threshold)[:, 0]
+    return filtered_indexes, scores[filtered_indexes]
+
+
+@numba.njit(nogil=True, parallel=True, cache=True)
+def numba_score_csr(offsets: np.ndarray,
+                    doc_ids: np.ndarray,
+                    doc_values: np.ndarray,
+                    indexes_to_retrieve: np.ndarray,
+                    query_values: np.ndarray,
+                    threshold: float,
+                    size_collection: int):
+    """same as `numba_score_float` but reads the posting lists straight from the CSR arrays
+    (see IndexCSRArray), so no per-term dict lookup and no copy of the index is needed
+    """
+    scores = np.zeros(size_collection, dtype=np.float32)
+    n_terms = len(offsets) - 1
+    n = len(indexes_to_retrieve)
+    for _idx in range(n):
+        local_idx = indexes_to_retrieve[_idx]
+        if local_idx >= n_terms:
+            continue
+        query_float = query_values[_idx]
+        retrieved_indexes = doc_ids[offsets[local_idx]:offsets[local_idx + 1]]
+        retrieved_floats = doc_values[offsets[local_idx]:offsets[local_idx + 1]]
+        for j in numba.prange(len(retrieved_indexes)):
+            scores[retrieved_indexes[j]] += query_float * retrieved_floats[j]
+    filtered_indexes = np.argwhere(scores > threshold)[:, 0]
+    return filtered_indexes, scores[filtered_indexes]
+
+
+@numba.njit(nogil=True, cache=True)
+def _heap_sift_down(heap_scores, heap_ids, size, pos):
+    while True:
+        smallest = pos
+        left = 2 * pos + 1
+        right = left + 1
+        if left < size and heap_scores[left] < heap_scores[smallest]:
+            smallest = left
+        if right < size and heap_scores[right] < heap_scores[smallest]:
+            smallest = right
+        if smallest == pos:
+            return
+        heap_scores[pos], heap_scores[smallest] = heap_scores[smallest], heap_scores[pos]
+        heap_ids[pos], heap_ids[smallest] = heap_ids[smallest], heap_ids[pos]
+        pos = smallest
+
+
+@numba.njit(nogil=True, cache=True)
+def _heap_push(heap_scores, heap_ids, size, score, doc):
+    """push into a bounded min-heap of capacity len(heap_scores), returns the new size
+    """
+    if size < len(heap_scores):
+        pos = size
+        heap_scores[pos] = score
+        heap_ids[pos] = doc
+        while pos > 0:
+            parent = (pos - 1) // 2
+            if heap_scores[parent] <= heap_scores[pos]:
+                break
+            heap_scores[pos], heap_scores[parent] = heap_scores[parent], heap_scores[pos]
+            heap_ids[pos], heap_ids[parent] = heap_ids[parent], heap_ids[pos]
+            pos = parent
+        return size + 1
+    if score > heap_scores[0]:
+        heap_scores[0] = score
+        heap_ids[0] = doc
+        _heap_sift_down(heap_scores, heap_ids, size, 0)
+    return size
+
+
+@numba.njit(nogil=True, cache=True)
+def _heap_sorted(heap_scores, heap_ids, size):
+    order = np.argsort(-heap_scores[:size], kind="mergesort")
+    return heap_ids[:size][order], heap_scores[:size][order]
+
+
+@numba.njit(nogil=True, cache=True)
+def numba_maxscore_topk(offsets: np.ndarray,
+                        doc_ids: np.ndarray,
+                        doc_values: np.ndarray,
+                        term_max: np.ndarray,
+                        block_offsets: np.ndarray,
+                        block_max: np.ndarray,
+                        block_last_doc: np.ndarray,
+                        block_size: int,
+                        indexes_to_retrieve: np.ndarray,
+                        query_values: np.ndarray,
+                        threshold: float,
+                        k: int):
+    """safe top-k document-at-a-time retrieval with (block-max) MaxScore dynamic pruning.
+
+    Query terms are sorted by their upper bound `q * term_max`. Terms whose cumulated upper bound cannot
+    beat the current k-th score are non-essential: they never produce candidates and are only probed
+    for docs found in the essential lists, skipping whole blocks by `block_last_doc` and stopping as soon
+    as `block_max` shows the doc cannot enter the top-k. Posting lists must be sorted by doc id and hold
+    a doc at most once, as written by the indexer.
+    Returns the same docs as exhaustive scoring + top-k, sorted by decreasing score.
+    """
+    n_terms = len(offsets) - 1
+    k = max(k, 1)
+    n = 0
+    terms = np.empty(len(indexes_to_retrieve), dtype=np.int64)
+    weights = np.empty(len(indexes_to_retrieve), dtype=np.float32)
+    bounds = np.empty(len(indexes_to_retrieve), dtype=np.float64)
+    for _idx in range(len(indexes_to_retrieve)):
+        term = indexes_to_retrieve[_idx]
+        if term >= n_terms or offsets[term] == offsets[term + 1]:
+            continue
+        terms[n] = term
+        weights[n] = query_values[_idx]
+        bounds[n] = max(0.0, query_values[_idx] * term_max[term])
+        n += 1
+
+    order = np.argsort(bounds[:n])
+    terms, weights, bounds = terms[order], weights[order], bounds[order]
+    cum_bounds = np.cumsum(bounds)
+    pos = np.empty(n, dtype=np.int64)
+    end = np.empty(n, dtype=np.int64)
+    block = np.empty(n, dtype=np.int64)
+    for i in range(n):
+        pos[i] = offsets[terms[i]]
+        end[i] = offsets[terms[i] + 1]
+        block[i] = block_offsets[terms[i]]
+
+    heap_scores = np.empty(k, dtype=np.float32)
+    heap_ids = np.empty(k, dtype=np.int32)
+    size = 0
+    theta = threshold
+    first_essential = 0
+    while first_essential < n and cum_bounds[first_essential] <= theta:
+        first_essential += 1
+
+    no_doc = np.iinfo(np.int32).max
+    while first_essential < n:
+        doc = no_doc
+        for i in range(first_essential, n):
+            if pos[i] < end[i] and doc_ids[pos[i]] < doc:
+                doc = doc_ids[pos[i]]
+        if doc == no_doc:
+            break
+
+        score = np.float32(0.0)
+        for i in range(first_essential, n):
+            if pos[i] < end[i] and doc_ids[pos[i]] == doc:
+                score += weights[i] * doc_values[pos[i]]
+                pos[i] += 1
+
+        for i in range(first_essential - 1, -1, -1):
+            if score + cum_bounds[i] <= theta:
+                break
+            last_block = block_offsets[terms[i] + 1]
+            while block[i] < last_block and block_last_doc[block[i]] < doc:
+                block[i] += 1
+            if block[i] == last_block:
+                pos[i] = end[i]
+                continue
+            rest = cum_bounds[i - 1] if i > 0 else 0.0
+            if score + weights[i] * block_max[block[i]] + rest <= theta:
+                break
+            block_start = offsets[terms[i]] + (block[i] - block_offsets[terms[i]]) * block_size
+            if pos[i] < block_start:
+                pos[i] = block_start
+            while pos[i] < end[i] and doc_ids[pos[i]] < doc:
+                pos[i] += 1
+            if pos[i] < end[i] and doc_ids[pos[i]] == doc:
+                score += weights[i] * doc_values[pos[i]]
+                pos[i] += 1
+
+        if score > theta:
+            size = _heap_push(heap_scores, heap_ids, size, score, doc)
+            if size == k:
+                theta = max(threshold, heap_scores[0])
+                while first_essential < n and cum_bounds[first_essential] <= theta:
+                    first_essential += 1
+
+    return _heap_sorted(heap_scores, heap_ids, size)
+
+
+@numba.njit(nogil=True, cache=True)
+def numba_score_topk_csr(offsets: np.ndarray,
+                         doc_ids: np.ndarray,
+                         doc_values: np.ndarray,
+                         indexes_to_retrieve: np.ndarray,
+                         query_values: np.ndarray,
+                         threshold: float,
+                         k: int,
+                         scores: np.ndarray,
+                         touched: np.ndarray):
+    """exhaustive scoring fused with bounded-heap top-k selection.
+
+    `scores` (float32) and `touched` (int32) are caller-owned scratch buffers of size_collection, `scores`
+    must be all zeros and is reset before returning, so one pair can be reused by every query of a thread.
+    When the query touches few postings compared to the collection, the touched docs are recorded and
+    only they are visited by the selection; otherwise a sequential pass over `scores` is cheaper.
+    Returns the top-k docs with score > threshold, sorted by decreasing score.
+    """
+    n_terms = len(offsets) - 1
+    size_collection = len(scores)
+    n_postings = 0
+    for _idx in range(len(indexes_to_retrieve)):
+        local_idx = indexes_to_retrieve[_idx]
+        if local_idx < n_terms:
+            n_postings += offsets[local_idx + 1] - offsets[local_idx]
+    track_touched = n_postings * 8 < size_collection
+
+    n_touched = 0
+    for _idx in range(len(indexes_to_retrieve)):
+        local_idx = indexes_to_retrieve[_idx]
+        if local_idx >= n_terms:
+            continue
+        query_float = query_values[_idx]
+        if track_touched:
+            for j in range(offsets[local_idx], offsets[local_idx + 1]):
+                contribution = query_float * doc_values[j]
+                if contribution == 0:
+                    continue
+                doc = doc_ids[j]
+                if scores[doc] == 0:
+                    touched[n_touched] = doc
+                    n_touched += 1
+                scores[doc] += contribution
+        else:
+            for j in range(offsets[local_idx], offsets[local_idx + 1]):
+                scores[doc_ids[j]] += query_float * doc_values[j]
+
+    k = max(k, 1)
+    heap_scores = np.empty(k, dtype=np.float32)
+    heap_ids = np.empty(k, dtype=np.int32)
+    size = 0
+    n_candidates = n_touched if track_touched else size_collection
+    for i in range(n_candidates):
+        doc = touched[i] if track_touched else i
+        score = scores[doc]
+        if score != 0:
+            if score > threshold and (size < k or score > heap_scores[0]):
+                size = _heap_push(heap_scores, heap_ids, size, score, doc)
+            scores[doc] = 0
+    return _heap_sorted(heap_scores, heap_ids, size)
+
+
+@numba.njit(nogil=True, cache=True)
+def numba_score_topk_packed(offsets: np.ndarray,
+                            block_offsets: np.ndarray,
+                            block_base: np.ndarray,
+                            block_bits: np.ndarray,
+                            block_words: np.ndarray,
+                            packed: np.ndarray,
+                            block_size: int,
+                            doc_values: np.ndarray,
+                            indexes_to_retrieve: np.ndarray,
+                            query_values: np.ndarray,
+                            threshold: float,
+                            k: int,
+                            scores: np.ndarray,
+                            touched: np.ndarray):
+    """`numba_score_topk_csr` over bit-packed doc ids (see posting_codec): every block of a posting list
+    is decoded into a small buffer that stays in cache, then accumulated like the raw csr postings.
+    """
+    n_terms = len(offsets) - 1
+    size_collection = len(scores)
+    n_postings = 0
+    for _idx in range(len(indexes_to_retrieve)):
+        local_idx = indexes_to_retrieve[_idx]
+        if local_idx < n_terms:
+            n_postings += offsets[local_idx + 1] - offsets[local_idx]
+    track_touched = n_postings * 8 < size_collection
+
+    buffer = np.empty(block_size, dtype=np.int32)
+    n_touched = 0
+    for _idx in range(len(indexes_to_retrieve)):
+        local_idx = indexes_to_retrieve[_idx]
+        if local_idx >= n_terms:
+            continue
+        query_float = query_values[_idx]
+        start, end = offsets[local_idx], offsets[local_idx + 1]
+        for b in range(block_offsets[local_idx], block_offsets[local_idx + 1]):
+            block_start = start + (b - block_offsets[local_idx]) * block_size
+            n = min(block_size, end - block_start)
+            unpack_block(packed, block_words[b], block_bits[b], block_base[b], n, buffer)
+            if track_touched:
+                for i in range(n):
+                    contribution = query_float * doc_values[block_start + i]
+                    if contribution == 0:
+                        continue
+                    doc = buffer[i]
+                    if scores[doc] == 0:
+                        touched[n_touched] = doc
+                        n_touched += 1
+                    scores[doc] += contribution
+            else:
+                for i in range(n):
+                    scores[buffer[i]] += query_float * doc_values[block_start + i]
+
+    k = max(k, 1)
+    heap_scores = np.empty(k, dtype=np.float32)
+    heap_ids = np.empty(k, dtype=np.int32)
+    size = 0
+    n_candidates = n_touched if track_touched else size_collection
+    for i in range(n_candidates):
+        doc = touched[i] if track_touched else i
+        score = scores[doc]
+        if score != 0:
+            if score > threshold and (size < k or score > heap_scores[0]):
+                size = _heap_push(heap_scores, heap_ids, size, score, doc)
+            scores[doc] = 0
+    return _heap_sorted(heap_scores, heap_ids, size)
+
+
+@numba.njit(nogil=True, cache=True)
+def _score_batch_chunk(offsets, doc_ids, doc_values, unique_terms, term_query_offsets, term_queries,
+                       term_weights, n_queries, chunk_start, chunk_end, tile_size, threshold,
+                       heap_scores, heap_ids, heap_sizes):
+    """accumulate docs [chunk_start, chunk_end) tile by tile into a [tile_size x n_queries] block,
+    every posting of a term is read once and added to all the queries sharing that term
+    """
+    n_unique = len(unique_terms)
+    cursors = np.empty(n_unique, dtype=np.int64)
+    for u in range(n_unique):
+        start, end = offsets[unique_terms[u]], offsets[unique_terms[u] + 1]
+        cursors[u] = start + np.searchsorted(doc_ids[start:end], chunk_start)
+    k = heap_scores.shape[1]
+    # a doc enters the heap of query q only if its score beats thetas[q]
+    thetas = np.full(n_queries, threshold, dtype=np.float32)
+    acc = np.zeros(tile_size * n_queries, dtype=np.float32)
+    for tile_start in range(chunk_start, chunk_end, tile_size):
+        tile_end = min(tile_start + tile_size, chunk_end)
+        for u in range(n_unique):
+            start = cursors[u]
+            stop = start + np.searchsorted(doc_ids[start:offsets[unique_terms[u] + 1]], tile_end)
+            # the tile slice of the posting list is fetched from memory once, then stays in cache
+            # while it is added to each query sharing the term
+            for i in range(term_query_offsets[u], term_query_offsets[u + 1]):
+                query = term_queries[i] - tile_start * n_queries
+                weight = term_weights[i]
+                for j in range(start, stop):
+                    acc[doc_ids[j] * n_queries + query] += weight * doc_values[j]
+            cursors[u] = stop
+        for d in range(tile_end - tile_start):
+            row = d * n_queries
+            for q in range(n_queries):
+                score = acc[row + q]
+                if score > thetas[q]:
+                    heap_sizes[q] = _heap_push(heap_scores[q], heap_ids[q], heap_sizes[q], score, tile_start + d)
+                    if heap_sizes[q] == k:
+                        thetas[q] = max(threshold, heap_scores[q, 0])
+        acc[:(tile_end - tile_start) * n_queries] = 0
+
+
+@numba.njit(nogil=True, parallel=True, cache=True)
+def numba_score_batch_topk_csr(offsets: np.ndarray,
+                               doc_ids: np.ndarray,
+                               doc_values: np.ndarray,
+                               batch_offsets: np.ndarray,
+                               batch_terms: np.ndarray,
+                               batch_values: np.ndarray,
+                               threshold: float,
+                               k: int,
+                               size_collection: int,
+                               tile_size: int = 65536,
+                               n_chunks: int = 1):
+    """exhaustive top-k scoring of a batch of queries (sparse query matrix x inverted index).
+
+    Query q is batch_terms / batch_values[batch_offsets[q]:batch_offsets[q + 1]]. The collection is cut
+    into `n_chunks` doc-id ranges scored in parallel, each walked in tiles of `tile_size` docs, so a
+    posting list shared by several queries is read once per batch instead of once per query.
+    Posting lists must be sorted by doc id. Returns [n_queries x k] doc ids (-1 padded), scores and
+    the number of hits per query, sorted by decreasing score.
+    """
+    n_terms = len(offsets) - 1
+    n_queries = len(batch_offsets) - 1
+    k = max(k, 1)
+
+    # invert the query matrix: for every distinct term, the queries using it and their weights
+    query_of = np.empty(len(batch_terms), dtype=np.int32)
+    for q in range(n_queries):
+        query_of[batch_offsets[q]:batch_offsets[q + 1]] = q
+    order = np.argsort(batch_terms, kind="mergesort")
+    unique_terms = np.empty(len(batch_terms), dtype=np.int64)
+    term_query_offsets = np.zeros(len(batch_terms) + 1, dtype=np.int64)
+    term_queries = np.empty(len(batch_terms), dtype=np.int32)
+    term_weights = np.empty(len(batch_terms), dtype=np.float32)
+    n_unique = 0
+    n_entries = 0
+    for i in range(len(order)):
+        term = batch_terms[order[i]]
+        if term >= n_terms or offsets[term] == offsets[term + 1]:
+            continue
+        if n_unique == 0 or unique_terms[n_unique - 1] != term:
+            unique_terms[n_unique] = term
+            n_unique += 1
+        term_queries[n_entries] = query_of[order[i]]
+        term_weights[n_entries] = batch_values[order[i]]
+        n_entries += 1
+        term_query_offsets[n_unique] = n_entries
+    unique_terms = unique_terms[:n_unique]
+    term_query_offsets = term_query_offsets[:n_unique + 1]
+
+    n_chunks = max(1, min(n_chunks, size_collection))
+    chunk_size = (size_collection + n_chunks - 1) // n_chunks
+    chunk_heap_scores = np.empty((n_chunks, n_queries, k), dtype=np.float32)
+    chunk_heap_ids = np.empty((n_chunks, n_queries, k), dtype=np.int32)
+    chunk_heap_sizes = np.zeros((n_chunks, n_queries), dtype=np.int64)
+    for c in numba.prange(n_chunks):
+        _score_batch_chunk(offsets, doc_ids, doc_values, unique_terms, term_query_offsets, term_queries,
+                           term_weights, n_queries, c * chunk_size, min((c + 1) * chunk_size, size_collection),
+                           tile_size, threshold, chunk_heap_scores[c], chunk_heap_ids[c], chunk_heap_sizes[c])
+
+    out_ids = np.full((n_queries, k), -1, dtype=np.int32)
+    out_scores = np.zeros((n_queries, k), dtype=np.float32)
+    out_sizes = np.zeros(n_queries, dtype=np.int64)
+    for q in numba.prange(n_queries):
+        heap_scores = np.empty(k, dtype=np.float32)
+        heap_ids = np.empty(k, dtype=np.int32)
+        size = 0
+        for c in range(n_chunks):
+            for i in range(chunk_heap_sizes[c, q]):
+                size = _heap_push(heap_scores, heap_ids, size, chunk_heap_scores[c, q, i], chunk_heap_ids[c, q, i])
+        ids, scores = _heap_sorted(heap_scores, heap_ids, size)
+        out_ids[q, :size] = ids
+        out_scores[q, :size] = scores
+        out_sizes[q] = size
+    return out_ids, out_scores, out_sizes
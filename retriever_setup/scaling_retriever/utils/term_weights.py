@@ -0,0 +1,100 @@
+import argparse
+import os
+
+import numpy as np
+
+from scaling_retriever.utils.inverted_index import IndexCSRArray
+from scaling_retriever.utils.utils import sparsify_pairs
+
+# [dim_voc] float32 weight of every vocabulary term, used to encode queries without running the encoder
+TERM_WEIGHTS_FILE = "term_weights_{}.npy"
+
+
+def idf_weights(sparse_index):
+    """BM25 idf of every term from the posting list sizes of the index
+    """
+    df = np.diff(np.asarray(sparse_index.offsets, dtype=np.int64)).astype(np.float64)
+    n_docs = sparse_index.nb_docs()
+    return np.log(1.0 + (n_docs - df + 0.5) / (df + 0.5)).astype(np.float32)
+
+
+def fit_term_weights(token_ids, sparse_query_vecs, prior, min_count=1):
+    """distill the encoder into a lookup table: the weight of a term is the mean weight the encoder gives to
+    that term in queries that contain its token (0 when the encoder drops it). Terms seen fewer than
+    `min_count` times keep their `prior` weight rescaled to the encoder range.
+    """
+    dim = len(prior)
+    weight_sum = np.zeros(dim, dtype=np.float64)
+    counts = np.zeros(dim, dtype=np.int64)
+    for ids, (col, values) in zip(token_ids, sparse_query_vecs):
+        ids = np.unique(np.asarray(ids, dtype=np.int64))
+        ids = ids[ids < dim]
+        encoded = np.zeros(len(ids), dtype=np.float64)
+        position = np.searchsorted(col, ids)
+        found = position < len(col)
+        found[found] &= col[position[found]] == ids[found]
+        encoded[found] = values[position[found]]
+        weight_sum[ids] += encoded
+        counts[ids] += 1
+    fitted = counts >= min_count
+    weights = prior.astype(np.float64).copy()
+    if fitted.any():
+        ratio = weight_sum[fitted].sum() / max(prior[fitted].astype(np.float64).sum(), 1e-12)
+        weights *= ratio
+        weights[fitted] = weight_sum[fitted] / counts[fitted]
+    return weights.astype(np.float32)
+
+
+class InferenceFreeQueryEncoder:
+    """query encoding without a forward pass (SPLADE-doc style): the query is tokenized and every token id
+    gets its weight from a [dim_voc] table, summed over repeated tokens. Special tokens are left out.
+    Produces the same (col, values) sparse vectors as the model path, so it plugs into the same scorer.
+    """
+    def __init__(self, tokenizer, weights, max_length=512):
+        self.tokenizer = tokenizer
+        self.weights = np.asarray(weights, dtype=np.float32)
+        self.max_length = max_length
+
+    @classmethod
+    def load(cls, tokenizer, index_dir, name="idf", max_length=512, sparse_index=None):
+        """weights from {index_dir}/term_weights_{name}.npy. A missing idf table is computed in memory
+        (from `sparse_index` if given), nothing is written to the index directory
+        """
+        path = os.path.join(index_dir, TERM_WEIGHTS_FILE.format(name))
+        if os.path.exists(path):
+            weights = np.load(path)
+        elif name == "idf":
+            weights = idf_weights(sparse_index if sparse_index is not None else IndexCSRArray.load(index_dir))
+        else:
+            raise FileNotFoundError(f"{path} does not exist, fit it offline first "
+                                    f"(python eval_query_encoders.py --index_dir {index_dir} for distilled weights, "
+                                    f"python -m scaling_retriever.utils.term_weights --index_dir {index_dir} for idf)")
+        return cls(tokenizer, weights, max_length=max_length)
+
+    def tokenize(self, queries):
+        return self.tokenizer(queries, max_length=self.max_length, truncation=True,
+                              add_special_tokens=False, return_attention_mask=False)["input_ids"]
+
+    def encode(self, queries, top_k=None, min_weight=0.):
+        """(col, values) of every query, capped to top_k terms with weight > min_weight like the model path
+        """
+        sparse_query_vecs = []
+        for ids in self.tokenize(queries):
+            ids = np.asarray(ids, dtype=np.int64)
+            ids = ids[ids < len(self.weights)]
+            col, counts = np.unique(ids, return_counts=True)
+            values = self.weights[col] * counts
+            keep = values > 0
+            col, values = sparsify_pairs(col[keep], values[keep], top_k=top_k, min_weight=min_weight)
+            sparse_query_vecs.append((col.astype(np.int32), values.astype(np.float32)))
+        return sparse_query_vecs
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--index_dir", type=str, required=True)
+    args = parser.parse_args()
+
+    path = os.path.join(args.index_dir, TERM_WEIGHTS_FILE.format("idf"))
+    np.save(path, idf_weights(IndexCSRArray.load(args.index_dir)))
+    print("idf term weights written to {}".format(path))
@@ -1,6 +1,7 @@
 import os 
 import random
 
+import numpy as np
 import ujson 
 import torch.distributed
 import torch
@@ -72,6 +73,31 @@ def supports_bfloat16():
     return False
 
 
+def sparsify(reps, top_k=None, min_weight=0.):
+    """zero the weights of reps [bz, dim] that are <= min_weight, then keep only the top_k largest
+    weights of each row. top_k=None / min_weight=0. leave the rows as they are.
+    """
+    if min_weight > 0:
+        reps = reps * (reps > min_weight)
+    if top_k and top_k < reps.size(-1):
+        values, idxes = torch.topk(reps, top_k, dim=-1)
+        reps = torch.zeros_like(reps).scatter_(-1, idxes, values)
+    return reps
+
+
+def sparsify_pairs(col, values, top_k=None, min_weight=0.):
+    """`sparsify` for one (col, values) sparse vector: drop the terms with weight <= min_weight, then keep only
+    the top_k largest ones. The kept terms stay in col order.
+    """
+    if min_weight > 0:
+        keep = values > min_weight
+        col, values = col[keep], values[keep]
+    if top_k and top_k < len(values):
+        keep = np.sort(np.argpartition(-values, top_k - 1)[:top_k])
+        col, values = col[keep], values[keep]
+    return col, values
+
+
 def batch_to_device(batch, device):
     for k, v in batch.items():
         if isinstance(v, torch.Tensor):
@@ -3,20 +3,27 @@ import json
 import torch
 import pickle
 import logging
-from typing import Optional, List
-from fastapi import FastAPI, HTTPException
+from typing import Optional, List, Literal
+from fastapi import FastAPI, HTTPException, Response
 import traceback
 from pydantic import BaseModel
 from tqdm import tqdm
 import numpy as np
-import numba
 from torch.utils.data import DataLoader
 from transformers import AutoTokenizer
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from scaling_retriever.dataset.data_collator import LlamaSparseCollectionCollator
 from scaling_retriever.modeling.llm_encoder import LlamaBiSparse
-from scaling_retriever.utils.inverted_index import IndexDictOfArray
-from scaling_retriever.utils.utils import is_first_worker, to_list, supports_bfloat16
+from scaling_retriever.modeling.cpu_encoders import load_cpu_encoder, encode_dense, query_parity, PARITY_QUERIES
+from scaling_retriever.utils.inverted_index import IndexDictOfArray, IndexCSRArray, csr_exists
+from scaling_retriever.utils.index_scorer import IndexScorer, ShardedScorer
+from scaling_retriever.utils.query_batcher import QueryBatcher
+from scaling_retriever.utils.query_cache import QueryVectorCache
+from scaling_retriever.utils.ranking_cache import RankingCache
+from scaling_retriever.utils.metrics import Metrics
+from scaling_retriever.utils.term_weights import InferenceFreeQueryEncoder
+from scaling_retriever.utils.doc_store import DocStore, doc_store_exists
+from scaling_retriever.utils.utils import is_first_worker, to_list, supports_bfloat16, sparsify
 from collections import defaultdict
 
 # ==================== LOGGING CONFIG ====================
@@ -35,93 +42,136 @@ logger = logging.getLogger("retriever")
 
 app = FastAPI()
 
+# "exhaustive" scores every posting, "maxscore" uses safe top-k dynamic pruning (same results)
+RetrievalMode = Literal["exhaustive", "maxscore"]
+# "model" runs LlamaBiSparse on the query, "inference_free" looks the query tokens up in a term weight table
+QueryEncoder = Literal["model", "inference_free"]
+
 class QueryRequest(BaseModel):
     query: str
     top_k: Optional[int] = 5
+    # results [offset, offset + top_k) of the ranking, later pages are sliced from a server-side ranked list
+    offset: Optional[int] = 0
     threshold: Optional[float] = 0.0
+    mode: Optional[RetrievalMode] = "exhaustive"
+    query_encoder: Optional[QueryEncoder] = "model"
 
 class BatchQueryRequest(BaseModel):
     queries: List[str]
     top_k: Optional[int] = 5
     threshold: Optional[float] = 0.0
+    mode: Optional[RetrievalMode] = "exhaustive"
+    query_encoder: Optional[QueryEncoder] = "model"
 
 class SparseRetrieval:
-    @staticmethod
-    def select_topk(filtered_indexes, scores, k):
-        scores = np.array(scores)
-        filtered_indexes = np.array(filtered_indexes)
-
-        if len(filtered_indexes) > k:
-            top_k_unsorted_idx = np.argpartition(-scores, k)[:k]
-            top_scores = scores[top_k_unsorted_idx]
-            top_indexes = filtered_indexes[top_k_unsorted_idx]
-            sorted_top_k = np.argsort(-top_scores)
-
-            return top_indexes[sorted_top_k], top_scores[sorted_top_k]  
-        else:
-            sorted_all = np.argsort(-scores)
-            return filtered_indexes[sorted_all], scores[sorted_all]  
-
-
-    @staticmethod
-    @numba.njit(nogil=True, parallel=True, cache=True)
-    def numba_score_float(inverted_index_ids: numba.typed.Dict,
-                          inverted_index_floats: numba.typed.Dict,
-                          indexes_to_retrieve: np.ndarray,
-                          query_values: np.ndarray,
-                          threshold: float,
-                          size_collection: int):
-        scores = np.zeros(size_collection, dtype=np.float32)
-        n = len(indexes_to_retrieve)
-        for _idx in range(n):
-            local_idx = indexes_to_retrieve[_idx]
-            query_float = query_values[_idx]
-            retrieved_indexes = inverted_index_ids[local_idx]
-            retrieved_floats = inverted_index_floats[local_idx]
-            for j in numba.prange(len(retrieved_indexes)):
-                scores[retrieved_indexes[j]] += query_float * retrieved_floats[j]
-        filtered_indexes = np.argwhere(scores > threshold)[:, 0]
-        return filtered_indexes, scores[filtered_indexes]
-
-    def __init__(self, model, config, dim_voc, device, index_d=None, **kwargs):
+    def __init__(self, model, config, dim_voc, device, index_d=None, q_collator=None, **kwargs):
         self.model = model
         self.model.eval()
+        self.q_collator = q_collator
+        self.query_cache = QueryVectorCache(max_size=config.get("query_cache_size", 10000))
+        self.ranking_cache = RankingCache(ttl_seconds=config.get("ranking_cache_ttl", 300.0))
+        self.min_ranking_depth = config.get("min_ranking_depth", 50)
+        # caps on the terms kept per encoded query, the query L0 drives the number of postings scored
+        self.query_top_k = config.get("query_top_k", None)
+        self.query_min_weight = config.get("query_min_weight", 0.)
+        self.metrics = Metrics(prefix="retriever")
+        self.metrics.describe("stage_seconds", "wall time of each request stage")
+        self.metrics.describe("query_l0", "number of non-zero terms of scored query vectors")
+        self.metrics.describe("query_l0_encoder", "number of non-zero terms of encoder outputs, before the query caps")
+        self.metrics.describe("postings_touched", "postings walked to score one query")
 
         assert ("index_dir" in config and index_d is None) or (
                 "index_dir" not in config and index_d is not None)
-        if "index_dir" in config:
-            self.sparse_index = IndexDictOfArray(config["index_dir"], dim_voc=dim_voc)
+        # posting lists are scored straight from the flat CSR arrays (offsets / doc ids / values)
+        compact_layout = config.get("values_dtype", "float32") != "float32" or config.get("packed_doc_ids", False)
+        if config.get("shard_urls"):
+            # the index lives in the shard workers, this process only keeps the doc id mapping and texts
+            self.sparse_index = None
+            self.doc_ids = pickle.load(open(os.path.join(config["index_dir"], "doc_ids.pkl"), "rb"))
+        elif "index_dir" in config:
+            if csr_exists(config["index_dir"]):
+                # "uint8" / "uint16" serve the quantized impacts written by `inverted_index --quantize`
+                # packed doc ids (`inverted_index --pack`) are decoded block by block while scoring
+                self.sparse_index = IndexCSRArray.load(config["index_dir"],
+                                                       values_dtype=config.get("values_dtype", "float32"),
+                                                       packed_doc_ids=config.get("packed_doc_ids", False))
+            else:
+                if compact_layout:
+                    raise ValueError(f"RETRIEVER_VALUES_DTYPE / RETRIEVER_PACKED_DOC_IDS need a csr index, "
+                                     f"{config['index_dir']} has none: convert it with `inverted_index --to_csr`, then "
+                                     f"`--quantize` / `--pack`, or unset them to serve float32 values")
+                self.sparse_index = IndexCSRArray.from_index_dict(
+                    IndexDictOfArray(config["index_dir"], dim_voc=dim_voc), dim=dim_voc)
             self.doc_ids = pickle.load(open(os.path.join(config["index_dir"], "doc_ids.pkl"), "rb"))
         else:
-            self.sparse_index = index_d["index"]
+            if compact_layout:
+                raise ValueError("values_dtype / packed_doc_ids need a csr index directory, not an in-memory index")
+            self.sparse_index = IndexCSRArray.from_index_dict(index_d["index"], dim=dim_voc)
             self.doc_ids = index_d["ids_mapping"]
-            for i in range(dim_voc):
-                if i not in self.sparse_index.index_doc_id:
-                    self.sparse_index.index_doc_id[i] = torch.tensor([], dtype=torch.int32)
-                    self.sparse_index.index_doc_value[i] = torch.tensor([], dtype=torch.float32)
-
-        self.numba_index_doc_ids = numba.typed.Dict()
-        self.numba_index_doc_values = numba.typed.Dict()
-        for key, value in self.sparse_index.index_doc_id.items():
-            self.numba_index_doc_ids[key] = value
-        for key, value in self.sparse_index.index_doc_value.items():
-            self.numba_index_doc_values[key] = value
-
-        self.doc_map = self.load_document_chunks(config.get("document_chunks_file", None))
+
+        if self.sparse_index is None:
+            self.scorer = ShardedScorer(config["shard_urls"], timeout=config.get("shard_timeout", 30.0))
+            logger.info(f"Scoring is scattered over {len(config['shard_urls'])} shard workers")
+        else:
+            self.sparse_index.ensure_block_max()
+            self.scorer = IndexScorer(self.sparse_index, batch_tile_budget=config.get("batch_tile_budget", 1 << 18))
+            if self.sparse_index.packed is not None:
+                logger.info("Doc ids are bit-packed: queries are scored one by one, maxscore falls back to exhaustive")
+
+        # scoring threads live as long as the server, each one keeps its own scratch accumulator
+        self.executor = ThreadPoolExecutor(max_workers=config.get("scoring_threads", 8))
+        # exhaustive multi-query requests walk each posting list once per batch
+        self.batch_scoring = config.get("batch_scoring", True) and self.scorer.supports_batch
+
+        self.doc_store = self.load_doc_store(config)
+        self.inference_free_encoder = self.load_inference_free_encoder(config)
         self.device = device
         self.model.to(device)
 
         logger.info("SparseRetrieval initialized")
 
-    def load_document_chunks(self, file_path):
-        doc_map = {}
-        if file_path:
-            with open(file_path, 'r') as f:
-                for line in f:
-                    chunk = json.loads(line)
-                    doc_map[chunk["chunk_id"]] = chunk["contents"]
-        logger.info(f"Loaded {len(doc_map)} document chunks")
-        return doc_map
+    def load_doc_store(self, config):
+        """memory-mapped chunk texts, built offline with `python -m scaling_retriever.utils.doc_store`.
+        Texts are only read for the docs that end up in a response.
+        """
+        store_dir = config.get("doc_store_dir", None)
+        if store_dir is None:
+            store_dir = os.path.join(config["index_dir"], "doc_store")
+        if not doc_store_exists(store_dir):
+            # the server never writes the index directory, several workers would race on the build
+            logger.warning(f"No doc store at {store_dir}, results will have empty texts. Build it with: "
+                           f"python -m scaling_retriever.utils.doc_store --corpus_path "
+                           f"{config.get('document_chunks_file') or '<chunks.jsonl>'} --store_dir {store_dir}")
+            return {}
+        doc_store = DocStore(store_dir)
+        logger.info(f"Loaded doc store with {len(doc_store)} document chunks from {store_dir}")
+        return doc_store
+
+    def load_inference_free_encoder(self, config):
+        """tokenizer + term weight table ({index_dir}/term_weights_{name}.npy). A missing idf table is computed
+        in memory from the loaded index, the index directory is never written to
+        """
+        name = config.get("term_weights", "idf")
+        try:
+            encoder = InferenceFreeQueryEncoder.load(self.q_collator.tokenizer, config["index_dir"], name=name,
+                                                     sparse_index=self.sparse_index)
+        except (OSError, KeyError) as e:
+            logger.warning(f"Inference-free query encoding unavailable: {e}")
+            return None
+        logger.info(f"Inference-free query encoding with {name} term weights")
+        return encoder
+
+    def encode_queries_inference_free(self, queries):
+        if self.inference_free_encoder is None:
+            raise ValueError("inference-free query encoding is not available on this server")
+        with self.metrics.timer("encode_inference_free"):
+            # the query_top_k / query_min_weight caps apply to every query encoder
+            return self.inference_free_encoder.encode(queries, top_k=self.query_top_k,
+                                                      min_weight=self.query_min_weight)
+
+    def _collate(self, batch):
+        with self.metrics.timer("tokenize"):
+            return self.q_collator(batch)
 
     def _generate_query_vecs(self, q_loader):
         sparse_query_vecs = []
@@ -130,8 +180,12 @@ class SparseRetrieval:
         with torch.inference_mode():
             for t, batch in enumerate(tqdm(q_loader, total=len(q_loader), desc="generate query vecs", disable=not is_first_worker())):
                 inputs = {k: v.to(self.device) for k, v in batch.items() if k not in {"ids"}}
-                with torch.amp.autocast(self.device, dtype=torch.bfloat16 if supports_bfloat16() else torch.float32):
+                with self.metrics.timer("encode"), \
+                        torch.amp.autocast(self.device, dtype=torch.bfloat16 if supports_bfloat16() else torch.float32):
                     batch_sparse_reps = self.model.encode(**inputs)
+                for l0 in torch.count_nonzero(batch_sparse_reps, dim=-1).tolist():
+                    self.metrics.observe("query_l0_encoder", l0)
+                batch_sparse_reps = sparsify(batch_sparse_reps, top_k=self.query_top_k, min_weight=self.query_min_weight)
                 qids.extend(batch["ids"] if isinstance(batch["ids"], list) else to_list(batch["ids"]))
                 for sparse_rep in batch_sparse_reps:
                     sparse_rep = sparse_rep.unsqueeze(0)
@@ -142,28 +196,91 @@ class SparseRetrieval:
         logger.info(f"Generated sparse vectors for {len(qids)} queries")
         return sparse_query_vecs, qids
 
-    def _sparse_retrieve_cpu(self, sparse_query_vecs, qids, threshold=0., topk=5):
+    def encode_queries(self, queries, batch_size=None):
+        """encode a list of query strings, returns one (col, values) pair per query.
+        Queries found in the query cache skip the encoder, the others are encoded together.
+        """
+        sparse_query_vecs = [self.query_cache.get(query) for query in queries]
+        missing = [i for i, vec in enumerate(sparse_query_vecs) if vec is None]
+        if missing:
+            encoded = self.encode_queries_uncached([queries[i] for i in missing], batch_size=batch_size)
+            for i, vec in zip(missing, encoded):
+                sparse_query_vecs[i] = vec
+        return sparse_query_vecs
+
+    def encode_queries_uncached(self, queries, batch_size=None):
+        """run the encoder on every query and store the vectors in the query cache
+        """
+        batch = [(f"q{i}", query) for i, query in enumerate(queries)]
+        q_loader = DataLoader(batch, batch_size=batch_size or len(batch), shuffle=False, collate_fn=self._collate)
+        sparse_query_vecs, _ = self._generate_query_vecs(q_loader)
+        for query, vec in zip(queries, sparse_query_vecs):
+            self.query_cache.put(query, vec)
+        return sparse_query_vecs
+
+    def _sparse_retrieve_batch_cpu(self, sparse_query_vecs, qids, threshold=0., topk=5):
+        res = defaultdict(dict)
+        stats = defaultdict(float)
+
+        with self.metrics.timer("score_batch"):
+            results = self.scorer.score_batch(sparse_query_vecs, threshold=threshold, topk=topk)
+        for col, _ in sparse_query_vecs:
+            self._observe_query(col)
+
+        for q, qid in enumerate(qids):
+            for id_, sc in zip(*results[q]):
+                doc_id = str(self.doc_ids[id_])
+                res[str(qid)][doc_id] = {"score": float(sc)}
+            stats["L0_q"] += len(sparse_query_vecs[q][1]) / len(qids)
+
+        logger.info(f"Retrieved results for {len(qids)} queries (batched)")
+        return res, stats
+
+    def _score_query(self, col, values, threshold=0., topk=5, mode="exhaustive"):
+        """top-k internal doc ids and scores of one sparse query, sorted by decreasing score
+        """
+        self._observe_query(col)
+        with self.metrics.timer("score"):
+            return self.scorer.score(col, values, threshold=threshold, topk=topk, mode=mode)
+
+    def _observe_query(self, col):
+        self.metrics.observe("query_l0", len(col))
+        n_postings = self.scorer.n_postings(col)
+        if n_postings is not None:
+            self.metrics.observe("postings_touched", n_postings)
+
+    def _ranked_page(self, query, encode_fn, offset=0, limit=5, threshold=0., mode="exhaustive", query_encoder="model"):
+        """docs [offset, offset + limit) of the ranking of `query` as (doc ids, scores). The ranked list is kept
+        in the ranking cache and only recomputed, twice as deep, when a page goes past its end, so paging
+        through n results costs O(n) scoring work instead of O(n^2). `encode_fn(query)` is only called
+        when the ranked list has to be recomputed.
+        """
+        key = (QueryVectorCache.normalize(query), float(threshold), mode, query_encoder)
+        needed = offset + limit
+        cached = self.ranking_cache.get(key, needed)
+        self.metrics.inc("ranking_cache_lookups_total", hit=cached is not None)
+        if cached is None:
+            depth = max(needed, 2 * self.ranking_cache.previous_depth(key), self.min_ranking_depth)
+            col, values = encode_fn(query)
+            ids, scores = self.executor.submit(self._score_query, col, values, threshold, depth, mode).result()
+            self.ranking_cache.put(key, ids, scores, depth)
+        else:
+            ids, scores, _ = cached
+        return [str(self.doc_ids[id_]) for id_ in ids[offset:needed]], scores[offset:needed]
+
+    def _sparse_retrieve_cpu(self, sparse_query_vecs, qids, threshold=0., topk=5, mode="exhaustive"):
+        if mode == "exhaustive" and self.batch_scoring and len(qids) > 1:
+            return self._sparse_retrieve_batch_cpu(sparse_query_vecs, qids, threshold=threshold, topk=topk)
+
         def _process_query_threaded(qid, col, values):
             res = defaultdict(dict)
             stats = defaultdict(float)
 
-            filtered_indexes, scores = self.numba_score_float(
-                self.numba_index_doc_ids,
-                self.numba_index_doc_values,
-                col,
-                values,
-                threshold=threshold,
-                size_collection=self.sparse_index.nb_docs(),
-            )
-
-            filtered_indexes, scores = self.select_topk(filtered_indexes, scores, k=topk)
+            filtered_indexes, scores = self._score_query(col, values, threshold=threshold, topk=topk, mode=mode)
 
             for id_, sc in zip(filtered_indexes, scores):
                 doc_id = str(self.doc_ids[id_])
-                res[str(qid)][doc_id] = {
-                    "score": float(sc),
-                    "content": self.doc_map.get(doc_id, "")
-                }
+                res[str(qid)][doc_id] = {"score": float(sc)}
 
             stats["L0_q"] = len(values)
             return res, stats
@@ -171,21 +288,20 @@ class SparseRetrieval:
         res = defaultdict(dict)
         stats = defaultdict(float)
 
-        with ThreadPoolExecutor(max_workers=8) as executor:
-            futures = [
-                executor.submit(_process_query_threaded, qid, col, values)
-                for qid, (col, values) in zip(qids, sparse_query_vecs)
-            ]
-
-            for future in tqdm(
-                as_completed(futures), total=len(futures),
-                desc="retrieval by inverted index", disable=not is_first_worker()
-            ):
-                r, s = future.result()
-                for qid, docs in r.items():
-                    res[qid].update(docs)
-                for k, v in s.items():
-                    stats[k] += v / len(qids)
+        futures = [
+            self.executor.submit(_process_query_threaded, qid, col, values)
+            for qid, (col, values) in zip(qids, sparse_query_vecs)
+        ]
+
+        for future in tqdm(
+            as_completed(futures), total=len(futures),
+            desc="retrieval by inverted index", disable=not is_first_worker()
+        ):
+            r, s = future.result()
+            for qid, docs in r.items():
+                res[qid].update(docs)
+            for k, v in s.items():
+                stats[k] += v / len(qids)
 
         logger.info(f"Retrieved results for {len(qids)} queries")
         return res, stats
@@ -193,6 +309,15 @@ class SparseRetrieval:
 MODEL_PATH = "hzeng/Lion-SP-1B-llama3-marco-mntp"
 INDEX_DIR = "/content/drive/MyDrive/mRAG_and_MSRS_source/index"
 CHUNK_FILE = "/content/drive/MyDrive/mRAG_and_MSRS_source/chunked_data/story_corpus_chunked.jsonl"
+# concurrent /search requests are merged into encoder batches of at most MAX_BATCH_SIZE queries,
+# a batch waits at most MAX_WAIT_MS for more requests after its first one arrives
+MAX_BATCH_SIZE = int(os.environ.get("RETRIEVER_MAX_BATCH_SIZE", 16))
+MAX_WAIT_MS = float(os.environ.get("RETRIEVER_MAX_WAIT_MS", 5))
+# "torch" (float32), "int8" (dynamically quantized decoder) or "onnx" (ONNX Runtime on the export written offline
+# by `python -m scaling_retriever.modeling.cpu_encoders` to RETRIEVER_ONNX_DIR, the server refuses to start without it)
+ENCODER_BACKEND = os.environ.get("RETRIEVER_ENCODER_BACKEND", "torch")
+# the server refuses to start when the backend query vectors drift further than this from the float32 model
+MIN_PARITY_COSINE = float(os.environ.get("RETRIEVER_MIN_PARITY_COSINE", 0.95))
 
 #enforce cpu use
 device = "cpu"
@@ -201,75 +326,144 @@ logger.info(f"Using device: {device}")
 
 tokenizer = AutoTokenizer.from_pretrained(MODEL_PATH)
 model = LlamaBiSparse.load_from_lora(MODEL_PATH)
+# the query encoder max-pools the logits over vocabulary chunks instead of the full [bz, seq_length, vocab_size] tensor, 0 to disable
+model.vocab_chunk_size = int(os.environ.get("RETRIEVER_VOCAB_CHUNK_SIZE", 16384))
+model.eval()
 q_collator = LlamaSparseCollectionCollator(tokenizer=tokenizer, max_length=512)
-config = {"index_dir": INDEX_DIR, "document_chunks_file": CHUNK_FILE}
-
-retriever = SparseRetrieval(model=model, config=config, dim_voc=model.vocab_size, device=device)
+if ENCODER_BACKEND != "torch":
+    reference_reps = encode_dense(model, q_collator, PARITY_QUERIES)
+    model = load_cpu_encoder(model, ENCODER_BACKEND,
+                             onnx_dir=os.environ.get("RETRIEVER_ONNX_DIR", os.path.join(INDEX_DIR, "onnx_encoder")))
+    parity = query_parity(reference_reps, encode_dense(model, q_collator, PARITY_QUERIES))
+    logger.info(f"{ENCODER_BACKEND} query encoder parity with float32: {parity}")
+    if parity["cosine"] < MIN_PARITY_COSINE:
+        raise RuntimeError(f"{ENCODER_BACKEND} query encoder cosine {parity['cosine']:.4f} < {MIN_PARITY_COSINE}")
+config = {"index_dir": INDEX_DIR, "document_chunks_file": CHUNK_FILE,
+          "batch_scoring": os.environ.get("RETRIEVER_BATCH_SCORING", "1") == "1",
+          "query_cache_size": int(os.environ.get("RETRIEVER_QUERY_CACHE_SIZE", 10000)),
+          "ranking_cache_ttl": float(os.environ.get("RETRIEVER_RANKING_CACHE_TTL", 300)),
+          "doc_store_dir": os.environ.get("RETRIEVER_DOC_STORE_DIR", os.path.join(INDEX_DIR, "doc_store")),
+          "values_dtype": os.environ.get("RETRIEVER_VALUES_DTYPE", "float32"),
+          "packed_doc_ids": os.environ.get("RETRIEVER_PACKED_DOC_IDS", "0") == "1",
+          "scoring_threads": int(os.environ.get("RETRIEVER_SCORING_THREADS", 8)),
+          "term_weights": os.environ.get("RETRIEVER_TERM_WEIGHTS", "idf"),
+          # keep at most query_top_k terms with weight > query_min_weight per encoded query, 0 to keep all of them
+          "query_top_k": int(os.environ.get("RETRIEVER_QUERY_TOP_K", 0)),
+          "query_min_weight": float(os.environ.get("RETRIEVER_QUERY_MIN_WEIGHT", 0.)),
+          # comma separated urls of sparse_shard_worker.py processes, empty to score the whole index in-process
+          "shard_urls": [url for url in os.environ.get("RETRIEVER_SHARD_URLS", "").split(",") if url]}
+
+retriever = SparseRetrieval(model=model, config=config, dim_voc=model.vocab_size, device=device,
+                            q_collator=q_collator)
+
+def observe_encoder_batch(waits):
+    retriever.metrics.observe("encoder_batch_size", len(waits))
+    for wait in waits:
+        retriever.metrics.observe("stage_seconds", wait, stage="batch_wait")
+
+query_batcher = QueryBatcher(retriever.encode_queries_uncached, max_batch_size=MAX_BATCH_SIZE, max_wait_ms=MAX_WAIT_MS,
+                             on_batch=observe_encoder_batch)
+retriever.metrics.register_gauge("batcher_queue_depth", query_batcher.qsize,
+                                 "queries waiting for an encoder batch")
+retriever.metrics.register_gauge("query_cache_entries", lambda: retriever.query_cache.stats()["size"])
+retriever.metrics.register_gauge("query_cache_hits_total", lambda: retriever.query_cache.stats()["hits"],
+                                 metric_type="counter")
+retriever.metrics.register_gauge("query_cache_misses_total", lambda: retriever.query_cache.stats()["misses"],
+                                 metric_type="counter")
+
+def encode_query(query):
+    # repeated queries are answered from the cache without waiting for an encoder batch
+    sparse_query_vec = retriever.query_cache.get(query)
+    if sparse_query_vec is None:
+        sparse_query_vec = query_batcher.encode(query)
+    return sparse_query_vec
 
 @app.get("/")
 def root():
-    return {"message": "Sparse Retriever is live!"}
+    return {"message": "Sparse Retriever is live!", "query_cache": retriever.query_cache.stats()}
+
+@app.get("/metrics")
+def metrics():
+    return Response(content=retriever.metrics.render(), media_type="text/plain; version=0.0.4")
+
+def json_response(response):
+    with retriever.metrics.timer("serialize"):
+        return Response(content=json.dumps(response), media_type="application/json")
 
 @app.post("/search")
 def search(request: QueryRequest):
+    retriever.metrics.inc("requests_total", endpoint="search")
     try:
         logger.info(f"Received query: {request.query}")
-        q_loader = DataLoader([(f"q0", request.query)], batch_size=1, shuffle=False, collate_fn=q_collator)
-        results, _ = retriever._sparse_retrieve_cpu(*retriever._generate_query_vecs(q_loader), topk=request.top_k, threshold=request.threshold)
-
-        response = []
-        for qid, docs in results.items():
-            for doc_id, result in docs.items():
-                response.append({
-                    "query_id": qid,
-                    "id": doc_id,
-                    "doc_id":doc_id,
-                    "score": result["score"],
-                    "text": result["content"]
-                })
-
-        if not response:
-            logger.warning("No documents found for query.")
-            raise HTTPException(status_code=404, detail="No documents found matching the query.")
-
-        logger.info(f"Returning {len(response)} results for query q0")
-        return response
+        with retriever.metrics.timer("search"):
+            if request.query_encoder == "inference_free":
+                encode_fn = lambda query: retriever.encode_queries_inference_free([query])[0]
+            else:
+                encode_fn = encode_query
+            doc_ids, scores = retriever._ranked_page(request.query, encode_fn, offset=request.offset,
+                                                     limit=request.top_k, threshold=request.threshold,
+                                                     mode=request.mode, query_encoder=request.query_encoder)
+
+            response = []
+            with retriever.metrics.timer("doc_text"):
+                for doc_id, score in zip(doc_ids, scores):
+                    response.append({
+                        "query_id": "q0",
+                        "id": doc_id,
+                        "doc_id":doc_id,
+                        "score": float(score),
+                        "text": retriever.doc_store.get(doc_id, "")
+                    })
+
+            if not response:
+                logger.warning("No documents found for query.")
+                raise HTTPException(status_code=404, detail="No documents found matching the query.")
+
+            logger.info(f"Returning {len(response)} results for query q0")
+            return json_response(response)
 
     except Exception as e:
+        retriever.metrics.inc("request_errors_total", endpoint="search")
         logger.error("Error occurred in /search endpoint:")
         logger.error(traceback.format_exc())
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/batch_search")
 def batch_search(request: BatchQueryRequest):
+    retriever.metrics.inc("requests_total", endpoint="batch_search")
     try:
         logger.info(f"Received batch of {len(request.queries)} queries")
-        batch = [(f"q{i}", query) for i, query in enumerate(request.queries)]
-        q_loader = DataLoader(batch, batch_size=8, shuffle=False, collate_fn=q_collator)
-        sparse_query_vecs, qids = retriever._generate_query_vecs(q_loader)
-        results, _ = retriever._sparse_retrieve_cpu(
-            sparse_query_vecs, qids, topk=request.top_k, threshold=request.threshold
-        )
-
-        response = []
-        for qid, docs in results.items():
-            for doc_id, result in docs.items():
-                response.append({
-                    "query_id": qid,
-                    "id": doc_id,
-                    "doc_id":doc_id,
-                    "score": result["score"],
-                    "text": result["content"]
-                })
-
-        if not response:
-            logger.warning("No documents found for any of the queries.")
-            raise HTTPException(status_code=404, detail="No documents found matching any of the queries.")
-
-        logger.info(f"Returning {len(response)} total results across batch queries")
-        return response
+        with retriever.metrics.timer("batch_search"):
+            if request.query_encoder == "inference_free":
+                sparse_query_vecs = retriever.encode_queries_inference_free(request.queries)
+            else:
+                sparse_query_vecs = retriever.encode_queries(request.queries, batch_size=8)
+            qids = [f"q{i}" for i in range(len(request.queries))]
+            results, _ = retriever._sparse_retrieve_cpu(
+                sparse_query_vecs, qids, topk=request.top_k, threshold=request.threshold, mode=request.mode
+            )
+
+            response = []
+            with retriever.metrics.timer("doc_text"):
+                for qid, docs in results.items():
+                    for doc_id, result in docs.items():
+                        response.append({
+                            "query_id": qid,
+                            "id": doc_id,
+                            "doc_id":doc_id,
+                            "score": result["score"],
+                            "text": retriever.doc_store.get(doc_id, "")
+                        })
+
+            if not response:
+                logger.warning("No documents found for any of the queries.")
+                raise HTTPException(status_code=404, detail="No documents found matching any of the queries.")
+
+            logger.info(f"Returning {len(response)} total results across batch queries")
+            return json_response(response)
 
     except Exception as e:
+        retriever.metrics.inc("request_errors_total", endpoint="batch_search")
         logger.error("Error occurred in /batch_search endpoint:")
         logger.error(traceback.format_exc())
         raise HTTPException(status_code=500, detail=str(e))
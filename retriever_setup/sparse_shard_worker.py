@@ -0,0 +1,72 @@
+"""Scoring worker for one doc-id range of the sparse index, queried by the retrieval front-end
+(sparse_retrieval_cpu.py with RETRIEVER_SHARD_URLS) which encodes the query once and merges the per-shard top-k.
+
+    python -m scaling_retriever.utils.inverted_index --shard /path/to/index --n_shards 4
+    SHARD_INDEX_DIR=/path/to/index/shard_0 uvicorn sparse_shard_worker:app --port 8101
+"""
+import os
+import logging
+import traceback
+from typing import Optional, List, Literal
+
+import numpy as np
+from fastapi import FastAPI, HTTPException
+from pydantic import BaseModel
+
+from scaling_retriever.utils.index_scorer import IndexScorer
+from scaling_retriever.utils.inverted_index import IndexCSRArray
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s — %(levelname)s — %(name)s — %(message)s")
+logger = logging.getLogger("shard_worker")
+
+app = FastAPI()
+
+SHARD_INDEX_DIR = os.environ["SHARD_INDEX_DIR"]
+
+
+class SparseQuery(BaseModel):
+    terms: List[int]
+    values: List[float]
+
+
+class ScoreRequest(BaseModel):
+    queries: List[SparseQuery]
+    top_k: Optional[int] = 5
+    threshold: Optional[float] = 0.0
+    mode: Optional[Literal["exhaustive", "maxscore"]] = "exhaustive"
+
+
+sparse_index = IndexCSRArray.load(SHARD_INDEX_DIR,
+                                  values_dtype=os.environ.get("RETRIEVER_VALUES_DTYPE", "float32"),
+                                  packed_doc_ids=os.environ.get("RETRIEVER_PACKED_DOC_IDS", "0") == "1")
+sparse_index.ensure_block_max()
+scorer = IndexScorer(sparse_index)
+batch_scoring = os.environ.get("RETRIEVER_BATCH_SCORING", "1") == "1" and scorer.supports_batch
+logger.info(f"Serving docs [{sparse_index.doc_id_start}, {sparse_index.doc_id_start + sparse_index.nb_docs()}) "
+            f"from {SHARD_INDEX_DIR}")
+
+
+@app.get("/")
+def root():
+    return {"message": "Sparse shard worker is live!", "index_dir": SHARD_INDEX_DIR,
+            "doc_id_start": sparse_index.doc_id_start, "n_docs": sparse_index.nb_docs()}
+
+
+@app.post("/score")
+def score(request: ScoreRequest):
+    """global doc ids and scores of the shard top-k of every query, sorted by decreasing score
+    """
+    try:
+        sparse_query_vecs = [(np.asarray(q.terms, dtype=np.int32), np.asarray(q.values, dtype=np.float32))
+                             for q in request.queries]
+        if request.mode == "exhaustive" and batch_scoring and len(sparse_query_vecs) > 1:
+            results = scorer.score_batch(sparse_query_vecs, threshold=request.threshold, topk=request.top_k)
+        else:
+            results = [scorer.score(col, values, threshold=request.threshold, topk=request.top_k, mode=request.mode)
+                       for col, values in sparse_query_vecs]
+        return {"ids": [ids.tolist() for ids, _ in results], "scores": [scores.tolist() for _, scores in results]}
+
+    except Exception as e:
+        logger.error("Error occurred in /score endpoint:")
+        logger.error(traceback.format_exc())
+        raise HTTPException(status_code=500, detail=str(e))